@@ -0,0 +1,378 @@
+"""Headless load generator for the chat server.
+
+Starts a server on each requested engine (or loads one already running
+with --external), connects simulated TCP and UDP clients spread over a few
+processes, and has them send public and private messages at a fixed total
+rate. Every message carries its send time, so the receiving clients measure
+end-to-end delivery latency; deliveries are compared with what each message
+should have reached to get the drop rate. One JSON line per run is printed
+(and appended to --output), with the latency percentiles in milliseconds,
+throughput and drops, overall and per protocol.
+
+    python -m benchmarks.load --tcp-clients 1000 --udp-clients 200 --rate 200 \\
+        --engine threaded eventloop --output results.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from classes.FrameDecoder import FrameDecoder, encode_frame
+from classes.Histogram import Histogram
+
+# Marks the chat text of benchmark messages: marker, sender, send time, padding
+MARKER = 'load|'
+
+# Seconds between two heartbeats of a UDP client
+UDP_HEARTBEAT_INTERVAL = 5
+
+# Bytes read per recv()
+RECV_SIZE = 65536
+
+
+def username(index):
+    return f"load{index}"
+
+
+class LoadClients:
+    """The share of simulated clients run by one process, in one selector loop"""
+
+    def __init__(self, args, first, tcp_count, udp_count, total):
+        self.args = args
+        self.total = total
+        self.rng = random.Random(args.seed + first)
+        self.selector = selectors.DefaultSelector()
+
+        self.clients = []  # [(index, protocol, socket)]
+        self.pending = {}  # {tcp socket: bytearray not sent yet}
+        self.decoders = {}  # {tcp socket: FrameDecoder}
+
+        self.latency = {'tcp': Histogram(), 'udp': Histogram()}
+        self.counts = {
+            'sent_public': 0, 'sent_private': 0, 'send_errors': 0,
+            'received_public': 0, 'received_private': 0,
+        }
+
+        for index in range(first, first + tcp_count):
+            self.connect_tcp(index)
+        for index in range(first + tcp_count, first + tcp_count + udp_count):
+            self.connect_udp(index)
+
+    def connect_tcp(self, index):
+        """Connect a framed TCP client getting presence deltas"""
+        client_socket = socket.create_connection((self.args.host, self.args.tcp_port))
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.sendall(json.dumps({
+            "username": username(index), "framing": "length", "presence": "delta"
+        }).encode('utf-8'))
+        client_socket.setblocking(False)
+        self.decoders[client_socket] = FrameDecoder()
+        self.clients.append((index, 'tcp', client_socket))
+        self.selector.register(client_socket, selectors.EVENT_READ, (index, 'tcp'))
+
+    def connect_udp(self, index):
+        """Register a plain UDP client getting presence deltas"""
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        client_socket.connect((self.args.host, self.args.udp_port))
+        client_socket.setblocking(False)
+        self.clients.append((index, 'udp', client_socket))
+        self.selector.register(client_socket, selectors.EVENT_READ, (index, 'udp'))
+        self.send(index, 'udp', client_socket, {
+            "type": "register", "username": username(index), "presence": "delta"})
+
+    def send(self, index, protocol, client_socket, message):
+        """Send a message as a client, buffering what a TCP socket does not take"""
+        data = json.dumps(message).encode('utf-8')
+        try:
+            if protocol == 'udp':
+                client_socket.send(data)
+                return
+            pending = self.pending.get(client_socket)
+            if pending:
+                pending += encode_frame(data)
+                return
+            data = encode_frame(data)
+            sent = client_socket.send(data)
+            if sent < len(data):
+                self.pending[client_socket] = bytearray(data[sent:])
+                self.selector.modify(client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                     (index, protocol))
+        except BlockingIOError:
+            if protocol == 'tcp':
+                self.pending[client_socket] = bytearray(data)
+                self.selector.modify(client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                     (index, protocol))
+            else:
+                self.counts['send_errors'] += 1
+        except OSError:
+            self.counts['send_errors'] += 1
+
+    def flush(self, index, client_socket):
+        """Send what a TCP client had buffered"""
+        pending = self.pending[client_socket]
+        try:
+            del pending[:client_socket.send(pending)]
+        except BlockingIOError:
+            return
+        except OSError:
+            pending.clear()
+            self.counts['send_errors'] += 1
+        if not pending:
+            del self.pending[client_socket]
+            self.selector.modify(client_socket, selectors.EVENT_READ, (index, 'tcp'))
+
+    def send_chat(self):
+        """Send one public or private message from a random client of this process"""
+        index, protocol, client_socket = self.rng.choice(self.clients)
+        text = f"{MARKER}{index}|{time.monotonic():.6f}|"
+        text += 'x' * max(0, self.args.size - len(text))
+
+        if self.rng.random() < self.args.private_ratio:
+            recipient = self.rng.randrange(self.total - 1)
+            if recipient >= index:
+                recipient += 1
+            self.send(index, protocol, client_socket, {
+                "type": "private", "to": username(recipient), "message": text})
+            self.counts['sent_private'] += 1
+        else:
+            self.send(index, protocol, client_socket, {"type": "message", "message": text})
+            self.counts['sent_public'] += 1
+
+    def receive(self, protocol, client_socket):
+        """Read what a client got and time the benchmark messages in it"""
+        payloads = []
+        try:
+            if protocol == 'udp':
+                while True:
+                    payloads.append(client_socket.recv(RECV_SIZE))
+            else:
+                data = client_socket.recv(RECV_SIZE)
+                payloads = self.decoders[client_socket].feed(data) if data else []
+        except BlockingIOError:
+            pass
+        except OSError:
+            return
+
+        now = time.monotonic()
+        for payload in payloads:
+            if MARKER.encode('utf-8') not in payload:
+                continue
+            try:
+                message = json.loads(payload)
+            except ValueError:
+                continue
+            if message.get('type') not in ('public', 'private'):
+                continue
+            sent_at = float(message['message'].split('|', 3)[2])
+            self.latency[protocol].record((now - sent_at) * 1e6)
+            self.counts[f"received_{message['type']}"] += 1
+
+    def poll(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            index, protocol = key.data
+            if mask & selectors.EVENT_WRITE and key.fileobj in self.pending:
+                self.flush(index, key.fileobj)
+            if mask & selectors.EVENT_READ:
+                self.receive(protocol, key.fileobj)
+
+    def heartbeat(self):
+        for index, protocol, client_socket in self.clients:
+            if protocol == 'udp':
+                self.send(index, protocol, client_socket,
+                          {"type": "heartbeat", "username": username(index)})
+
+    def run(self, until, rate):
+        """Send at rate messages per second until the deadline, reading all along"""
+        next_send = time.monotonic()
+        next_heartbeat = next_send + UDP_HEARTBEAT_INTERVAL
+        while True:
+            now = time.monotonic()
+            if now >= until:
+                return
+            if rate:
+                while next_send <= now:
+                    self.send_chat()
+                    next_send += 1 / rate
+            if now >= next_heartbeat:
+                self.heartbeat()
+                next_heartbeat += UDP_HEARTBEAT_INTERVAL
+            self.poll(max(0, min(next_send if rate else until, until) - time.monotonic()))
+
+    def close(self):
+        for index, protocol, client_socket in self.clients:
+            client_socket.close()
+
+
+def run_process(args, first, tcp_count, udp_count, total, barrier, results):
+    """Connect this process's clients, wait for the others, then generate load"""
+    clients = LoadClients(args, first, tcp_count, udp_count, total)
+
+    # Let every client register and the presence announcements settle
+    clients.run(time.monotonic() + args.warmup, 0)
+    for name in clients.counts:
+        clients.counts[name] = 0
+    clients.latency = {'tcp': Histogram(), 'udp': Histogram()}
+    barrier.wait()
+
+    started = time.monotonic()
+    clients.run(started + args.duration, args.rate * len(clients.clients) / total)
+    clients.run(time.monotonic() + args.drain, 0)
+    results.put((clients.counts, clients.latency))
+    clients.close()
+
+
+def start_server(args, engine):
+    """Start a local server on an engine and wait until it accepts connections"""
+    command = [sys.executable, 'server.py', '--host', '127.0.0.1',
+               '--tcp-port', str(args.tcp_port), '--udp-port', str(args.udp_port),
+               '--engine', engine, '--loops', str(args.loops),
+               '--stats-port', str(args.stats_port), '--stats-interval', '0',
+               '--log-level', 'warning',
+               # Every simulated client connects from the same address
+               '--ip-rate-factor', '0'] + args.server_args.split()
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.tcp_port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server did not start")
+
+
+def server_stats(args):
+    """The local server's own latency histograms and counters, if it serves them"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{args.stats_port}/stats", timeout=2) as response:
+            stats = json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+    return {"latency_ms": stats['latency_ms'], "fanout": stats['fanout'],
+            "counters": stats['counters']}
+
+
+def run(args, engine):
+    """One load run, returning its results"""
+    server = start_server(args, engine) if engine else None
+    try:
+        total = args.tcp_clients + args.udp_clients
+        processes = max(1, min(args.processes, total))
+        barrier = multiprocessing.Barrier(processes)
+        results = multiprocessing.Queue()
+
+        workers = []
+        for worker in range(processes):
+            tcp_share = (args.tcp_clients * (worker + 1) // processes
+                         - args.tcp_clients * worker // processes)
+            udp_share = (args.udp_clients * (worker + 1) // processes
+                         - args.udp_clients * worker // processes)
+            first = args.tcp_clients * worker // processes + args.udp_clients * worker // processes
+            process = multiprocessing.Process(
+                target=run_process,
+                args=(args, first, tcp_share, udp_share, total, barrier, results),
+                daemon=True)
+            process.start()
+            workers.append(process)
+
+        counts = dict.fromkeys(('sent_public', 'sent_private', 'send_errors',
+                                'received_public', 'received_private'), 0)
+        latency = {'tcp': Histogram(), 'udp': Histogram()}
+        for _ in workers:
+            worker_counts, worker_latency = results.get()
+            for name, count in worker_counts.items():
+                counts[name] += count
+            for protocol, histogram in worker_latency.items():
+                latency[protocol].merge(histogram)
+        for process in workers:
+            process.join()
+        stats = server_stats(args) if server else None
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    # Every public message should reach every other client, a private one its recipient
+    expected = counts['sent_public'] * (total - 1) + counts['sent_private']
+    delivered = counts['received_public'] + counts['received_private']
+    overall = Histogram()
+    for histogram in latency.values():
+        overall.merge(histogram)
+
+    result = {
+        "engine": engine or "external",
+        "tcp_clients": args.tcp_clients,
+        "udp_clients": args.udp_clients,
+        "rate": args.rate,
+        "private_ratio": args.private_ratio,
+        "size": args.size,
+        "duration": args.duration,
+        "sent": counts['sent_public'] + counts['sent_private'],
+        "send_errors": counts['send_errors'],
+        "expected_deliveries": expected,
+        "delivered": delivered,
+        "drop_rate": round(1 - delivered / expected, 6) if expected else 0,
+        "sent_per_second": round((counts['sent_public'] + counts['sent_private']) / args.duration, 1),
+        "delivered_per_second": round(delivered / args.duration, 1),
+        "latency_ms": overall.summary(1000),
+        "latency_ms_by_protocol": {protocol: histogram.summary(1000)
+                                   for protocol, histogram in latency.items()},
+    }
+    if stats:
+        result["server"] = stats
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument('--engine', nargs='+', default=['threaded', 'eventloop'],
+                        choices=['threaded', 'eventloop'],
+                        help="engines to start a local server on, one run each")
+    parser.add_argument('--loops', type=int, default=1)
+    parser.add_argument('--server-args', default='',
+                        help="extra options for the local server, e.g. '--backpressure pause'")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--external', action='store_true',
+                        help="load the server already running on --host instead of starting one")
+    parser.add_argument('--tcp-port', type=int, default=19190)
+    parser.add_argument('--udp-port', type=int, default=19191)
+    parser.add_argument('--stats-port', type=int, default=19199)
+    parser.add_argument('--tcp-clients', type=int, default=200)
+    parser.add_argument('--udp-clients', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=100,
+                        help="messages per second sent by all clients together")
+    parser.add_argument('--private-ratio', type=float, default=0.2,
+                        help="fraction of the messages sent privately to a random user")
+    parser.add_argument('--size', type=int, default=100, help="characters of chat text per message")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load")
+    parser.add_argument('--warmup', type=float, default=3,
+                        help="seconds for every client to connect before the load starts")
+    parser.add_argument('--drain', type=float, default=2,
+                        help="seconds to keep reading after the last message was sent")
+    parser.add_argument('--processes', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="processes running the simulated clients")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="file the JSON results are appended to")
+    args = parser.parse_args()
+
+    # Thousands of clients need as many descriptors, here and in the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    for engine in ([None] if args.external else args.engine):
+        result = run(args, engine)
+        line = json.dumps(result)
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, 'a') as output:
+                output.write(line + '\n')
@@ -0,0 +1,113 @@
+"""Append and range-read rates of the message log.
+
+Appends chat-sized messages spread over a number of conversations,
+group-committed the way the server uses the log, then reopens the log, which
+rebuilds its index from the segments, and reads the last messages of random
+conversations and pages after random sequence numbers. With --compare, also
+appends while waiting for each message to be written and synced on its own.
+
+    python -m benchmarks.message_log --messages 200000 --compare
+"""
+import argparse
+import json
+import logging
+import random
+import shutil
+import tempfile
+import time
+
+from classes.MessageLog import DEFAULT_FLUSH_INTERVAL, MessageLog
+
+
+def payloads(args):
+    """The formatted messages to append, with their conversation keys"""
+    rng = random.Random(args.seed)
+    for index in range(args.messages):
+        key = f"#channel-{rng.randrange(args.conversations)}"
+        yield key, json.dumps({
+            "type": "public", "from": f"user{index % 1000}",
+            "channel": key[1:], "message": 'x' * args.size
+        }).encode('utf-8')
+
+
+def append(args, directory, group_commit):
+    """Append every message and return the rate, counting the final flush"""
+    log = MessageLog(directory, segment_bytes=args.segment_bytes, fsync=not args.no_fsync,
+                     flush_interval=DEFAULT_FLUSH_INTERVAL if group_commit else 0)
+    messages = list(payloads(args))
+    if not group_commit:
+        # Synchronous commits are much slower, keep the run short
+        messages = messages[:args.sync_messages]
+
+    started = time.perf_counter()
+    for key, payload in messages:
+        log.append(key, payload)
+        if not group_commit:
+            log.flush()
+    log.flush()
+    elapsed = time.perf_counter() - started
+    stats = dict(log.stats)
+    log.close()
+
+    return {
+        "mode": "group_commit" if group_commit else "commit_each",
+        "messages": len(messages),
+        "seconds": round(elapsed, 3),
+        "appends_per_second": round(len(messages) / elapsed),
+        "megabytes_per_second": round(stats['log_bytes'] / elapsed / 1e6, 1),
+        "batches": stats['log_batches'],
+    }
+
+
+def read(args, directory):
+    """Reopen the log and time history reads"""
+    started = time.perf_counter()
+    log = MessageLog(directory, segment_bytes=args.segment_bytes)
+    recovery = time.perf_counter() - started
+
+    rng = random.Random(args.seed)
+    keys = list(log.conversations)
+    results = {"recovery_seconds": round(recovery, 3), "segments": len(log.segments)}
+
+    for name, after in (("last", False), ("after", True)):
+        returned = 0
+        started = time.perf_counter()
+        for _ in range(args.reads):
+            key = rng.choice(keys)
+            seqs = log.conversations[key]
+            position = rng.choice(seqs) if after else None
+            returned += len(log.read(key, args.limit, position))
+        elapsed = time.perf_counter() - started
+        results[f"{name}_reads_per_second"] = round(args.reads / elapsed)
+        results[f"{name}_messages_per_second"] = round(returned / elapsed)
+
+    log.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Message log benchmark")
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=80, help="characters of chat text per message")
+    parser.add_argument('--conversations', type=int, default=300)
+    parser.add_argument('--segment-bytes', type=int, default=16 << 20)
+    parser.add_argument('--reads', type=int, default=5000)
+    parser.add_argument('--limit', type=int, default=50, help="messages per history read")
+    parser.add_argument('--no-fsync', action='store_true', help="only write, never fsync")
+    parser.add_argument('--compare', action='store_true',
+                        help="also commit every append on its own")
+    parser.add_argument('--sync-messages', type=int, default=2000,
+                        help="messages appended when committing each one")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    directory = tempfile.mkdtemp(prefix='chatter-wave-log-')
+    try:
+        print(json.dumps(append(args, directory, True)))
+        print(json.dumps(read(args, directory)))
+        if args.compare:
+            shutil.rmtree(directory)
+            print(json.dumps(append(args, directory, False)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,132 @@
+"""Join/leave storm benchmark.
+
+Connects a set of observers to an in-process server, then lets a burst of
+clients join and leave, and counts what the server had to send while
+presence announcements go out immediately and while they are coalesced.
+
+    python -m benchmarks.presence_storm --observers 200 --storm 500
+"""
+import argparse
+import json
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from server import ChatServer
+
+
+def open_client(port, username, delta=True):
+    """Connect a framed TCP client, with or without presence deltas"""
+    client_socket = socket.create_connection(('127.0.0.1', port))
+    handshake = {"username": username, "framing": "length"}
+    if delta:
+        handshake["presence"] = "delta"
+    client_socket.sendall(json.dumps(handshake).encode('utf-8'))
+    return client_socket
+
+
+def drain(selector, received, stop):
+    """Read and count everything the observers receive"""
+    while not stop.is_set():
+        for key, mask in selector.select(0.1):
+            try:
+                data = key.fileobj.recv(65536)
+            except BlockingIOError:
+                continue
+            received['bytes'] += len(data)
+
+
+def run_storm(args, presence_interval):
+    """Run one storm and return what the server sent"""
+    server = ChatServer('127.0.0.1', 0, 0, presence_interval=presence_interval)
+    port = server.tcp_socket.getsockname()[1]
+    threading.Thread(target=server.run, args=(args.engine,), daemon=True).start()
+    time.sleep(0.3)
+
+    # Observers stay connected for the whole storm
+    selector = selectors.DefaultSelector()
+    observers = []
+    for index in range(args.observers):
+        observer = open_client(port, f"observer{index}",
+                               delta=index >= args.observers * args.legacy)
+        observer.setblocking(False)
+        selector.register(observer, selectors.EVENT_READ)
+        observers.append(observer)
+
+    received = {'bytes': 0}
+    stop = threading.Event()
+    drainer = threading.Thread(target=drain, args=(selector, received, stop), daemon=True)
+    drainer.start()
+    wait_quiet(server)
+
+    before = dict(server.stats)
+    received['bytes'] = 0
+    started = time.monotonic()
+
+    # Everyone joins, then everyone leaves
+    storm = [open_client(port, f"storm{index}") for index in range(args.storm)]
+    wait_online(server, args.observers + args.storm)
+    wait_quiet(server)
+    for client_socket in storm:
+        client_socket.close()
+    wait_online(server, args.observers)
+    wait_quiet(server)
+    elapsed = time.monotonic() - started
+
+    stop.set()
+    drainer.join()
+    for observer in observers:
+        observer.close()
+
+    def sent(key):
+        return server.stats[key] - before.get(key, 0)
+
+    return {
+        "presence_interval": presence_interval,
+        "observers": args.observers,
+        "storm": args.storm,
+        "seconds": round(elapsed, 3),
+        "messages_sent": sent('tcp_messages_out'),
+        "bytes_sent": sent('tcp_bytes_out'),
+        "bytes_received": received['bytes'],
+        "presence_batches": sent('presence_batches'),
+    }
+
+
+def wait_online(server, count, timeout=30):
+    """Wait until the server knows about exactly count users"""
+    deadline = time.monotonic() + timeout
+    while len(server.online_users) != count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def wait_quiet(server, timeout=30):
+    """Wait until pending announcements went out and every queue drained"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        idle = not server.presence_events and all(
+            not session.outbound.pending_bytes
+            for session in server.tcp_clients.values())
+        if idle:
+            # Let the last writes reach the observers
+            time.sleep(0.2)
+            return
+        time.sleep(0.01)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Join/leave storm benchmark")
+    parser.add_argument('--engine', choices=['threaded', 'eventloop'], default='eventloop')
+    parser.add_argument('--observers', type=int, default=200)
+    parser.add_argument('--storm', type=int, default=500,
+                        help="clients joining then leaving during the storm")
+    parser.add_argument('--legacy', type=float, default=0.25,
+                        help="share of observers without presence deltas")
+    parser.add_argument('--presence-interval', type=float, default=0.25)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for interval in (0, args.presence_interval):
+        print(json.dumps(run_storm(args, interval)))
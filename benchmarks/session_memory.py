@@ -0,0 +1,141 @@
+"""Memory per connection of the client bookkeeping.
+
+Registers simulated sessions, half over TCP and half over UDP by default,
+once the way the server used to keep them (plain dicts of a username and
+address dict per TCP client and a username per UDP address, username maps
+for each protocol and a set of online users) and once in the ClientRegistry
+of TcpSession and UdpSession objects, and reports the memory each layout
+allocates per session as traced by tracemalloc, along with the cost of
+finding a user's endpoint for a private message. The registry keeps its
+lock-striped maps and the fields the server now needs per session (user id,
+codec flags, counters, outbound queue), so the comparison is against what
+the server used to hold, not like for like. Sockets, addresses and usernames
+are created beforehand and shared by both layouts, so only the bookkeeping
+is counted.
+
+    python -m benchmarks.session_memory --sessions 10000 50000
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from classes.ClientRegistry import ClientRegistry
+from classes.Session import TCP, UDP, TcpSession, UdpSession
+
+
+class FakeSocket:
+    """Stands in for a client socket as a dict key"""
+
+    __slots__ = ('fd',)
+
+    def __init__(self, fd):
+        self.fd = fd
+
+
+def endpoints(count, udp_share):
+    """The (protocol, endpoint, username, address) of each simulated session"""
+    udp_count = int(count * udp_share)
+    clients = []
+    for index in range(count):
+        username = f"user{index:06d}"
+        address = ('10.0.%d.%d' % (index // 250 % 250, index % 250), 20000 + index % 40000)
+        if index < udp_count:
+            clients.append((UDP, address, username, address))
+        else:
+            clients.append((TCP, FakeSocket(index), username, address))
+    return clients
+
+
+class LegacyClients:
+    """The dict-of-dicts layout sessions were kept in before ClientRegistry"""
+
+    def __init__(self):
+        self.tcp_clients = {}  # {client_socket: {'username': username, 'address': address}}
+        self.udp_clients = {}  # {address: username}
+        self.username_to_tcp_socket = {}  # {username: client_socket}
+        self.username_to_udp_address = {}  # {username: address}
+        self.online_users = set()
+
+    def add(self, protocol, endpoint, username, address, outbound, readable):
+        if protocol == TCP:
+            self.tcp_clients[endpoint] = {'username': username, 'address': address}
+            self.username_to_tcp_socket[username] = endpoint
+        else:
+            self.udp_clients[endpoint] = username
+            self.username_to_udp_address[username] = endpoint
+        self.online_users.add(username)
+
+    def route(self, username):
+        """Try TCP then UDP, as private messages did"""
+        if username in self.username_to_tcp_socket:
+            return self.username_to_tcp_socket[username]
+        if username in self.username_to_udp_address:
+            return self.username_to_udp_address[username]
+        return None
+
+
+class RegistryClients:
+    """Sessions in a ClientRegistry"""
+
+    def __init__(self):
+        self.registry = ClientRegistry()
+
+    def add(self, protocol, endpoint, username, address, outbound, readable):
+        if protocol == TCP:
+            session = TcpSession(endpoint, username, None, address, outbound=outbound,
+                                 readable=readable, presence_deltas=True)
+        else:
+            session = UdpSession(endpoint, username, None, presence_deltas=True)
+        self.registry.add(session)
+        self.registry.online_users.add(username)
+
+    def route(self, username):
+        session = self.registry.route(username)
+        return session.endpoint if session is not None else None
+
+
+def measure(layout, clients, lookups):
+    """Memory traced while registering every client, and the lookup rate"""
+    # One placeholder outbound queue and event: their own size is the same
+    # in both layouts
+    outbound, readable = object(), object()
+
+    tracemalloc.start()
+    started = tracemalloc.get_traced_memory()[0]
+    store = layout()
+    for protocol, endpoint, username, address in clients:
+        store.add(protocol, endpoint, username, address, outbound, readable)
+    allocated = tracemalloc.get_traced_memory()[0] - started
+    tracemalloc.stop()
+
+    began = time.perf_counter()
+    for username in lookups:
+        store.route(username)
+    elapsed = time.perf_counter() - began
+
+    return {
+        "layout": layout.__name__,
+        "sessions": len(clients),
+        "megabytes": round(allocated / 1e6, 2),
+        "bytes_per_session": round(allocated / len(clients)),
+        "routes_per_second": round(len(lookups) / elapsed),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Session memory benchmark")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--udp-share', type=float, default=0.5,
+                        help="fraction of sessions connected over UDP")
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for count in args.sessions:
+        clients = endpoints(count, args.udp_share)
+        lookups = [clients[rng.randrange(count)][2] for _ in range(args.lookups)]
+        for layout in (LegacyClients, RegistryClients):
+            print(json.dumps(measure(layout, clients, lookups)))
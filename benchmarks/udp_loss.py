@@ -0,0 +1,199 @@
+"""Loss-injection harness for the reliable UDP mode.
+
+Runs an in-process server and two UDP clients, each talking to it through a
+loopback proxy that drops, duplicates and reorders datagrams in both
+directions. One client publishes numbered messages, some large enough to be
+fragmented, and the other checks that it receives every one of them exactly
+once and in order.
+
+    python -m benchmarks.udp_loss --loss 0.2 --messages 300
+"""
+import argparse
+import json
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+
+from classes.ChatClient import ChatClient
+from server import ChatServer
+
+
+class LossyProxy:
+    """Relays datagrams between one client and the server, misbehaving on purpose"""
+
+    def __init__(self, server_address, loss, duplicate, reorder, rng):
+        self.server_address = server_address
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.rng = rng
+
+        # The client talks to front, the server sees back
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(('127.0.0.1', 0))
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.back.bind(('127.0.0.1', 0))
+        self.client_address = None
+
+        self.address = self.front.getsockname()
+        self.counts = {'relayed': 0, 'dropped': 0, 'duplicated': 0, 'reordered': 0}
+
+    def start(self):
+        threading.Thread(target=self.relay, args=(self.front, self.back, True), daemon=True).start()
+        threading.Thread(target=self.relay, args=(self.back, self.front, False), daemon=True).start()
+
+    def relay(self, source, destination, upstream):
+        """Forward one direction, holding back a datagram now and then"""
+        held = None
+        source.settimeout(0.05)
+        while True:
+            try:
+                data, address = source.recvfrom(65535)
+            except socket.timeout:
+                if held is not None:
+                    self.forward(destination, held, upstream)
+                    held = None
+                continue
+
+            if upstream:
+                self.client_address = address
+
+            if self.rng.random() < self.loss:
+                self.counts['dropped'] += 1
+                continue
+            if self.rng.random() < self.duplicate:
+                self.counts['duplicated'] += 1
+                self.forward(destination, data, upstream)
+            if held is None and self.rng.random() < self.reorder:
+                self.counts['reordered'] += 1
+                held = data
+                continue
+
+            self.forward(destination, data, upstream)
+            if held is not None:
+                self.forward(destination, held, upstream)
+                held = None
+
+    def forward(self, destination, data, upstream):
+        target = self.server_address if upstream else self.client_address
+        if target is None:
+            return
+        self.counts['relayed'] += 1
+        destination.sendto(data, target)
+
+
+class Signal:
+    """Stand-in for a Qt signal appending the first argument to a list"""
+
+    def __init__(self, sink=None):
+        self.sink = sink
+
+    def emit(self, *args):
+        if self.sink is not None:
+            self.sink.append(args[0])
+
+
+class Inbox:
+    """Signal handler stand-in collecting what a client receives"""
+
+    def __init__(self):
+        self.messages = []
+        self.errors = []
+        self.message_received = Signal(self.messages)
+        self.connection_error = Signal(self.errors)
+        self.user_list_updated = Signal()
+        self.user_joined = Signal()
+        self.user_left = Signal()
+
+
+def run(args, reliable):
+    """Publish through lossy proxies and return what arrived"""
+    rng = random.Random(args.seed)
+    # One client publishes as fast as it can, do not throttle it
+    server = ChatServer('127.0.0.1', 0, 0, presence_interval=0, public_rate=0)
+    server_address = server.udp_socket.getsockname()
+    threading.Thread(target=server.run, args=(args.engine,), daemon=True).start()
+    time.sleep(0.2)
+
+    clients = []
+    proxies = []
+    for username in ('sender', 'receiver'):
+        proxy = LossyProxy(server_address, args.loss, args.duplicate, args.reorder, rng)
+        proxy.start()
+        inbox = Inbox()
+        client = ChatClient('UDP', proxy.address[0], proxy.address[1], username,
+                            inbox, reliable=reliable)
+        client.connect()
+        proxies.append(proxy)
+        clients.append((client, inbox))
+
+    # Registration itself may be lost without the reliable mode
+    deadline = time.monotonic() + 5
+    while len(server.udp_clients) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    (sender, _), (receiver, inbox) = clients
+    started = time.monotonic()
+    expected = []
+    for index in range(args.messages):
+        # Every tenth message needs several fragments
+        padding = 'x' * (args.large if index % 10 == 0 else 16)
+        text = f"{index} {padding}"
+        expected.append(text)
+        sender.send_message(text)
+        time.sleep(args.pace)
+
+    def received():
+        return [message['message'] for message in inbox.messages
+                if message.get('type') == 'public']
+
+    deadline = time.monotonic() + args.timeout
+    while len(received()) < len(expected) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+
+    got = received()
+    for client, _ in clients:
+        client.disconnect()
+
+    return {
+        "reliable": reliable,
+        "loss": args.loss,
+        "sent": len(expected),
+        "received": len(got),
+        "exact": got == expected,
+        "seconds": round(elapsed, 3),
+        "retransmits": server.stats['reliable_retransmits']
+                       + sender.channel.stats['reliable_retransmits'] if reliable else 0,
+        "duplicates_suppressed": server.stats['reliable_duplicates']
+                                 + receiver.channel.stats['reliable_duplicates'] if reliable else 0,
+        "proxy": {key: sum(proxy.counts[key] for proxy in proxies) for key in proxies[0].counts},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reliable UDP loss-injection harness")
+    parser.add_argument('--engine', choices=['threaded', 'eventloop'], default='eventloop')
+    parser.add_argument('--loss', type=float, default=0.1, help="share of datagrams dropped")
+    parser.add_argument('--duplicate', type=float, default=0.05, help="share of datagrams sent twice")
+    parser.add_argument('--reorder', type=float, default=0.05, help="share of datagrams delayed")
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--large', type=int, default=5000, help="size of every tenth message")
+    parser.add_argument('--pace', type=float, default=0.002, help="seconds between two messages")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compare', action='store_true', help="also run with raw UDP")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = [run(args, True)]
+    if args.compare:
+        results.append(run(args, False))
+    for result in results:
+        print(json.dumps(result))
+
+    # Non-zero exit when the reliable mode lost, duplicated or reordered anything
+    sys.exit(0 if results[0]['exact'] else 1)
@@ -0,0 +1,189 @@
+"""Latency and CPU cost of Unix domain sockets against loopback TCP and UDP.
+
+Runs an in-process server listening on TCP, UDP and both Unix sockets, and
+for each transport connects two ChatClient instances that send private
+messages to each other one at a time, waiting for each to arrive before
+sending the next. Reports the round-trip percentiles in microseconds and
+the CPU time of the whole process (server and both clients) per message.
+The same measure over a bare echo connection, TCP loopback and Unix stream,
+shows what the transport alone costs without the chat server.
+
+    python -m benchmarks.unix_socket --messages 5000 --engine eventloop
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from classes.ChatClient import ChatClient
+from classes.Histogram import Histogram
+from server import ChatServer
+
+
+class Signal:
+    """Stand-in for a Qt signal calling a function with the first argument"""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+
+    def emit(self, *args):
+        if self.callback is not None:
+            self.callback(args[0])
+
+
+class Inbox:
+    """Signal handler stand-in waking the benchmark on each private message"""
+
+    def __init__(self):
+        self.arrived = threading.Event()
+        self.errors = []
+        self.message_received = Signal(self.received)
+        self.connection_error = Signal(self.errors.append)
+        self.user_list_updated = Signal()
+        self.user_joined = Signal()
+        self.user_left = Signal()
+
+    def received(self, message):
+        if isinstance(message, dict) and message.get('type') == 'private':
+            self.arrived.set()
+
+
+def echo(listening_socket):
+    """Send back everything received on the first connection accepted"""
+    connection, _ = listening_socket.accept()
+    with connection:
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                return
+            connection.sendall(data)
+
+
+def run_echo(args, family, address):
+    """Round trips of message-sized writes over a bare stream connection"""
+    listening_socket = socket.socket(family, socket.SOCK_STREAM)
+    listening_socket.bind(address)
+    listening_socket.listen(1)
+    threading.Thread(target=echo, args=(listening_socket,), daemon=True).start()
+
+    client = socket.socket(family, socket.SOCK_STREAM)
+    client.connect(listening_socket.getsockname())
+    if family == socket.AF_INET:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    latency = Histogram()
+    data = b'x' * args.size
+    cpu_started = time.process_time()
+    for _ in range(args.messages):
+        sent = time.perf_counter()
+        client.sendall(data)
+        received = 0
+        while received < len(data):
+            received += len(client.recv(65536))
+        latency.record((time.perf_counter() - sent) * 1e6)
+    cpu = time.process_time() - cpu_started
+    client.close()
+    listening_socket.close()
+
+    return {
+        "protocol": 'UNIX' if family == socket.AF_UNIX else 'TCP',
+        "echo": True,
+        "messages": args.messages,
+        "round_trip_us": {"p50": round(latency.percentile(50), 1),
+                          "p99": round(latency.percentile(99), 1)},
+        "cpu_us_per_message": round(cpu / args.messages * 1e6, 1),
+    }
+
+
+def run(args, protocol, host, port):
+    """Send messages back and forth between two clients over one transport"""
+    clients = []
+    for username in (f"{protocol.lower()}-a", f"{protocol.lower()}-b"):
+        inbox = Inbox()
+        client = ChatClient(protocol, host, port, username, inbox)
+        if not client.connect():
+            raise RuntimeError(f"Could not connect over {protocol}: {inbox.errors}")
+        clients.append((client, inbox))
+
+    # Wait for both welcomes so the messages go out in the negotiated codec
+    deadline = time.monotonic() + 5
+    while (not all(client.binary for client, _ in clients)
+           and time.monotonic() < deadline):
+        time.sleep(0.01)
+
+    latency = Histogram()
+    lost = 0
+    text = 'x' * args.size
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    for index in range(args.warmup + args.messages):
+        (sender, _), (receiver, inbox) = clients[index % 2], clients[1 - index % 2]
+        inbox.arrived.clear()
+        sent = time.perf_counter()
+        sender.send_message(text, receiver.username)
+        if not inbox.arrived.wait(args.timeout):
+            lost += 1
+            continue
+        if index == args.warmup - 1:
+            cpu_started = time.process_time()
+            started = time.perf_counter()
+        elif index >= args.warmup:
+            latency.record((time.perf_counter() - sent) * 1e6)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    for client, _ in clients:
+        client.disconnect()
+
+    return {
+        "protocol": protocol,
+        "echo": False,
+        "engine": args.engine,
+        "messages": args.messages,
+        "lost": lost,
+        "round_trip_us": {"p50": round(latency.percentile(50), 1),
+                          "p99": round(latency.percentile(99), 1)},
+        "messages_per_second": round(args.messages / elapsed),
+        "cpu_us_per_message": round(cpu / args.messages * 1e6, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Unix domain socket benchmark")
+    parser.add_argument('--engine', choices=['threaded', 'eventloop'], default='eventloop')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--size', type=int, default=100, help="characters per message text")
+    parser.add_argument('--timeout', type=float, default=1,
+                        help="seconds to wait for a message before counting it lost")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    directory = tempfile.mkdtemp(prefix='chatter-bench-')
+    try:
+        print(json.dumps(run_echo(args, socket.AF_INET, ('127.0.0.1', 0))))
+        print(json.dumps(run_echo(args, socket.AF_UNIX, os.path.join(directory, 'echo.sock'))))
+
+        unix_path = os.path.join(directory, 'chat.sock')
+        unix_datagram_path = os.path.join(directory, 'chat.dgram')
+        # Both clients send as fast as they can from the same address
+        server = ChatServer('127.0.0.1', 0, 0, presence_interval=0, stats_interval=0,
+                            private_rate=0, ip_rate_factor=0, unix_path=unix_path,
+                            unix_datagram_path=unix_datagram_path)
+        threading.Thread(target=server.run, args=(args.engine,), daemon=True).start()
+        time.sleep(0.2)
+
+        tcp_port = server.tcp_socket.getsockname()[1]
+        udp_port = server.udp_socket.getsockname()[1]
+        for protocol, host, port in (('TCP', '127.0.0.1', tcp_port),
+                                     ('UNIX', unix_path, None),
+                                     ('UDP', '127.0.0.1', udp_port),
+                                     ('UNIX_DGRAM', unix_datagram_path, None)):
+            print(json.dumps(run(args, protocol, host, port)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,99 @@
+"""Cost and size of chat messages in the JSON and binary codecs.
+
+Encodes and decodes the same set of chat messages (public, channel and
+private lines sent by the server, and the requests clients send) with
+json.dumps/json.loads as the server and client always did, with the
+binary codec of classes/WireCodec.py, in binary with sender names replaced
+by their announced user ids, and with JSON or binary compressed with
+the shared zlib dictionary, and reports the time per message each way and
+the bytes each takes on the wire. --sizes sets the lengths of the message
+texts; compression applies from --threshold bytes as on the server.
+
+    python -m benchmarks.wire_codec --sizes 20 100 1000 --threshold 0
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+from classes.WireCodec import (DEFAULT_COMPRESSION_THRESHOLD, Compressor, decode_binary,
+                               decode_message, encode_binary)
+
+
+def sample_messages(count, size, rng):
+    """Chat messages of every binary shape, with texts of size characters"""
+    words = ''.join(rng.choice(string.ascii_lowercase + ' ') for _ in range(size * 4))
+    shapes = (
+        lambda name, text: {"type": "public", "from": name, "message": text},
+        lambda name, text: {"type": "public", "from": name, "channel": "general",
+                            "message": text},
+        lambda name, text: {"type": "private", "from": name, "message": text},
+        lambda name, text: {"type": "message", "message": text},
+        lambda name, text: {"type": "private", "to": name, "message": text},
+    )
+    messages = []
+    for index in range(count):
+        start = rng.randrange(len(words) - size)
+        messages.append(shapes[index % len(shapes)](
+            f"user{rng.randrange(10000):04d}", words[start:start + size]))
+    return messages
+
+
+def timed(function, items, rounds):
+    """Seconds per call of function over items, best of rounds"""
+    best = None
+    for _ in range(rounds):
+        began = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed = (time.perf_counter() - began) / len(items)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(messages, rounds, threshold):
+    """Encode and decode times and wire sizes of both codecs, plain and compressed"""
+    compressor = Compressor(threshold)
+    encode_json = lambda message: json.dumps(message).encode('utf-8')
+    encode_compact = lambda message: encode_binary(message, 42)
+
+    results = {}
+    for codec, encode, decode in (
+            ('json', encode_json, json.loads),
+            ('binary', encode_compact, decode_binary),
+            ('binary_interned', lambda message: encode_binary(message, 42, interned=True),
+             decode_binary),
+            ('json_zlib', lambda message: compressor.compress(encode_json(message)),
+             decode_message),
+            ('binary_zlib', lambda message: compressor.compress(encode_compact(message)),
+             decode_message)):
+        payloads = [encode(message) for message in messages]
+        assert all(decode(payload)['message'] == message['message']
+                   for payload, message in zip(payloads, messages))
+        results[codec] = {
+            "encode_us": round(timed(encode, messages, rounds) * 1e6, 3),
+            "decode_us": round(timed(decode, payloads, rounds) * 1e6, 3),
+            "bytes": round(sum(len(payload) for payload in payloads) / len(payloads), 1),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wire codec benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 100, 1000],
+                        help="characters per message text")
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--threshold', type=int, default=DEFAULT_COMPRESSION_THRESHOLD,
+                        help="bytes from which messages are compressed")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        results = measure(sample_messages(args.messages, size, rng), args.rounds,
+                          args.threshold)
+        print(json.dumps(dict(size=size, **results, bytes_saved={
+            codec: round(1 - result['bytes'] / results['json']['bytes'], 3)
+            for codec, result in results.items() if codec != 'json'})))
@@ -0,0 +1,86 @@
+import threading
+
+# Longest channel name accepted
+MAX_CHANNEL_NAME = 64
+
+
+def valid_channel_name(name):
+    """Whether name can be used as a channel name"""
+    return (isinstance(name, str) and 0 < len(name) <= MAX_CHANNEL_NAME
+            and name == name.strip())
+
+
+class ChannelIndex:
+    """Subscription index of the named channels.
+
+    Keeps both directions, channel -> members and member -> channels, so
+    fanning a message out touches only the members of its channel and a
+    disconnecting member leaves all of its channels without scanning the
+    others. Members are whatever identifies a client endpoint (a TCP socket
+    or a UDP address); a channel exists while it has members.
+    """
+
+    def __init__(self):
+        self.members_of = {}  # {channel: {member}}
+        self.channels_of = {}  # {member: {channel}}
+        self.lock = threading.Lock()
+
+    def __contains__(self, channel):
+        return channel in self.members_of
+
+    def join(self, channel, member):
+        """Subscribe member to channel, returning True if this opened the channel"""
+        with self.lock:
+            members = self.members_of.get(channel)
+            opened = members is None
+            if opened:
+                members = self.members_of[channel] = set()
+            members.add(member)
+            self.channels_of.setdefault(member, set()).add(channel)
+            return opened
+
+    def leave(self, channel, member):
+        """Unsubscribe member from channel, returning True if this closed the channel"""
+        with self.lock:
+            return self._leave(channel, member)
+
+    def _leave(self, channel, member):
+        channels = self.channels_of.get(member)
+        if channels is None or channel not in channels:
+            return False
+
+        channels.discard(channel)
+        if not channels:
+            del self.channels_of[member]
+
+        members = self.members_of[channel]
+        members.discard(member)
+        if members:
+            return False
+        del self.members_of[channel]
+        return True
+
+    def remove(self, member):
+        """Unsubscribe member from every channel, returning the channels this closed"""
+        with self.lock:
+            return [channel for channel in list(self.channels_of.get(member, ()))
+                    if self._leave(channel, member)]
+
+    def is_member(self, channel, member):
+        """Whether member is subscribed to channel"""
+        return channel in self.channels_of.get(member, ())
+
+    def members(self, channel):
+        """Snapshot of a channel's members, safe to iterate while they change"""
+        with self.lock:
+            return tuple(self.members_of.get(channel, ()))
+
+    def subscriptions(self, member):
+        """Sorted names of the channels member is subscribed to"""
+        with self.lock:
+            return sorted(self.channels_of.get(member, ()))
+
+    def counts(self):
+        """{channel: number of members} for every open channel"""
+        with self.lock:
+            return {channel: len(members) for channel, members in self.members_of.items()}
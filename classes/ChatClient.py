@@ -1,11 +1,34 @@
 import json
+import os
+import shutil
 import socket
+import struct
+import tempfile
 import threading
 import time
 
+from classes.FrameDecoder import FrameDecoder, encode_frame
+from classes.ReliableChannel import ReliableChannel, is_reliable
+from classes.WireCodec import (BINARY_CODEC, ZLIB_COMPRESSION, Compressor, decode_binary,
+                               decompress, encode_binary, is_binary, is_compressed)
+
+# Bytes read per recv() on the client socket
+RECV_SIZE = 65536
+
+# Seconds between retransmission checks in reliable UDP mode
+RETRANSMIT_INTERVAL = 0.05
+
+# Protocols over a connected stream, served like TCP (UNIX is a Unix domain
+# stream socket whose path is given as the host), and over datagrams,
+# served like UDP (UNIX_DGRAM is a Unix domain datagram socket)
+STREAM_PROTOCOLS = ("TCP", "UNIX")
+DATAGRAM_PROTOCOLS = ("UDP", "UNIX_DGRAM")
+
 
 class ChatClient:
-    def __init__(self, protocol, host, port, username, signal_handler):
+    def __init__(self, protocol, host, port, username, signal_handler,
+                 reliable=False, codec=BINARY_CODEC, compression=ZLIB_COMPRESSION,
+                 multicast=True):
         self.protocol = protocol
         self.host = host
         self.port = port
@@ -14,30 +37,82 @@ class ChatClient:
         self.connected = False
         self.socket = None
         self.udp_heartbeat_interval = 5  # seconds
+        self.handshake_timeout = 5  # seconds
+        self.decoder = None  # FrameDecoder once the server accepted framing
+
+        # Codec asked for in the handshake; chat messages are sent in the
+        # binary one once the server's welcome accepted it
+        self.codec = codec
+        self.binary = False
+
+        # Compression asked for in the handshake (None for none); large
+        # messages are compressed once the welcome accepted it
+        self.compression = compression
+        self.compressor = None
+
+        # Sequenced, acknowledged and fragmented UDP instead of raw datagrams
+        self.reliable = reliable
+        self.channel = None  # ReliableChannel while connected in reliable mode
+
+        # UDP only: receive public messages and presence through the
+        # server's multicast group if it has one (never in reliable mode)
+        self.multicast = multicast and not reliable and protocol == "UDP"
+        self.multicast_socket = None
+
+        # Whether the server answers history requests (told in its welcome)
+        self.history_available = False
+
+        # Version of the last user list or presence delta applied
+        self.presence_version = None
+        self.presence_sync_pending = False
+
+        # Names of the users whose ids the server announced: {user_id: username}
+        self.user_names = {}
 
     def connect(self):
         try:
-            if self.protocol == "TCP":
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((self.host, self.port))
+            if self.protocol in STREAM_PROTOCOLS:
+                if self.protocol == "UNIX":
+                    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.socket.connect(self.host)
+                else:
+                    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self.socket.connect((self.host, self.port))
                 self.connected = True
 
                 self.socket.send(json.dumps({
-                    "username": self.username
+                    "username": self.username,
+                    "framing": "length",
+                    "presence": "delta",
+                    "codec": self.codec,
+                    "compression": self.compression
                 }).encode('utf-8'))
 
+                # Framed replies start with a zero byte, older servers answer in bare JSON
+                self.socket.settimeout(self.handshake_timeout)
+                first_byte = self.socket.recv(1, socket.MSG_PEEK)
+                self.socket.settimeout(None)
+                if first_byte == b'\0':
+                    self.decoder = FrameDecoder()
+
                 threading.Thread(target=self.receive_tcp, daemon=True).start()
 
-            elif self.protocol == "UDP":
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.server_address = (self.host, self.port)
+            elif self.protocol in DATAGRAM_PROTOCOLS:
+                if self.protocol == "UNIX_DGRAM":
+                    # The server replies to the path we send from
+                    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    self.socket.bind(os.path.join(tempfile.mkdtemp(prefix='chatter-'),
+                                                  'client.sock'))
+                    self.server_address = self.host
+                else:
+                    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    self.server_address = (self.host, self.port)
                 self.connected = True
+                if self.reliable:
+                    self.channel = ReliableChannel()
 
                 # Register with server
-                self.socket.sendto(json.dumps({
-                    "type": "register",
-                    "username": self.username
-                }).encode('utf-8'), self.server_address)
+                self.register_udp()
 
                 # Start listener and heartbeat
                 threading.Thread(target=self.receive_udp, daemon=True).start()
@@ -54,86 +129,285 @@ class ChatClient:
         if self.connected and self.socket:
             self.connected = False
             try:
-                if self.protocol == "TCP":
+                if self.protocol in STREAM_PROTOCOLS:
                     self.socket.close()
+                elif self.protocol == "UNIX_DGRAM":
+                    shutil.rmtree(os.path.dirname(self.socket.getsockname()))
                 # For UDP, just stop sending heartbeats
             except:
                 pass
+            if self.multicast_socket:
+                # Closing the socket leaves the group
+                self.multicast_socket.close()
+                self.multicast_socket = None
+
+    def register_udp(self):
+        """Send the UDP registration, again after the server reaped our session"""
+        self.send_udp(json.dumps({
+            "type": "register",
+            "username": self.username,
+            "presence": "delta",
+            "codec": self.codec,
+            "compression": self.compression,
+            "multicast": self.multicast
+        }).encode('utf-8'))
+
+    def send_tcp(self, data):
+        """Send encoded data over TCP, framed if the server supports it"""
+        if self.decoder:
+            data = encode_frame(data)
+        self.socket.sendall(data)
+
+    def send_udp(self, data):
+        """Send encoded data over UDP, through the reliable channel if enabled"""
+        if not self.channel:
+            self.socket.sendto(data, self.server_address)
+            return
+
+        datagrams = self.channel.send(data)
+        if datagrams is None:
+            raise ConnectionError("Server stopped acknowledging messages")
+        for datagram in datagrams:
+            self.socket.sendto(datagram, self.server_address)
+
+    def send_message(self, message, recipient=None, channel=None):
+        if channel is not None:  # Message to a channel
+            return self.send_request({
+                "type": "message",
+                "channel": channel,
+                "message": message
+            })
+
+        if recipient:  # Private message
+            return self.send_request({
+                "type": "private",
+                "to": recipient,
+                "message": message
+            })
+
+        # Public message
+        return self.send_request({
+            "type": "message",
+            "message": message
+        })
+
+    def encode(self, request):
+        """Encode a request in the negotiated codec (JSON if it has no binary
+        form), compressed if negotiated and large enough"""
+        data = encode_binary(request) if self.binary else None
+        data = data or json.dumps(request).encode('utf-8')
+        if self.compressor:
+            data = self.compressor.compress(data)
+        return data
 
-    def send_message(self, message, recipient=None):
+    def send_request(self, request):
+        """Send a request to the server over the connected protocol"""
         if not self.connected or not self.socket:
             return False
 
+        data = self.encode(request)
         try:
-            if recipient:  # Private message
-                if self.protocol == "TCP":
-                    data = json.dumps({
-                        "type": "private",
-                        "to": recipient,
-                        "message": message
-                    }).encode('utf-8')
-                    self.socket.send(data)
-
-                elif self.protocol == "UDP":
-                    data = json.dumps({
-                        "type": "private",
-                        "to": recipient,
-                        "message": message
-                    }).encode('utf-8')
-                    self.socket.sendto(data, self.server_address)
-
-            else:  # Public message
-                if self.protocol == "TCP":
-                    data = json.dumps({
-                        "type": "message",
-                        "message": message
-                    }).encode('utf-8')
-                    self.socket.send(data)
-
-                elif self.protocol == "UDP":
-                    data = json.dumps({
-                        "type": "message",
-                        "message": message
-                    }).encode('utf-8')
-                    self.socket.sendto(data, self.server_address)
-
+            if self.protocol in STREAM_PROTOCOLS:
+                self.send_tcp(data)
+            elif self.protocol in DATAGRAM_PROTOCOLS:
+                self.send_udp(data)
             return True
-
         except Exception as e:
             self.signal_handler.connection_error.emit(
                 f"Error sending message: {str(e)}")
             self.connected = False
             return False
 
-    def process_message(self, data_str):
-        """Process received message and emit appropriate signals"""
+    def join_channel(self, channel):
+        """Subscribe to a channel; the server answers with a 'joined' message"""
+        return self.send_request({"type": "join", "channel": channel})
+
+    def leave_channel(self, channel):
+        """Unsubscribe from a channel; the server answers with a 'left' message"""
+        return self.send_request({"type": "leave", "channel": channel})
+
+    def list_channels(self):
+        """Ask for the open channels; the server answers with a 'channel_list' message"""
+        return self.send_request({"type": "list"})
+
+    def request_history(self, channel=None, with_user=None, limit=None, after=None):
+        """Ask for the last messages of the public room, a channel or a private
+        conversation; the server answers with a 'history' message"""
+        request = {"type": "history"}
+        if channel is not None:
+            request['channel'] = channel
+        if with_user is not None:
+            request['with'] = with_user
+        if limit is not None:
+            request['limit'] = limit
+        if after is not None:
+            request['after'] = after
+        return self.send_request(request)
+
+    def request_user_list(self):
+        """Ask the server for a full user list after missing a presence update"""
+        if self.presence_sync_pending:
+            return
+        self.presence_sync_pending = True
+
+        data = json.dumps({"type": "presence_sync"}).encode('utf-8')
         try:
-            data = json.loads(data_str)
+            if self.protocol in STREAM_PROTOCOLS:
+                self.send_tcp(data)
+            elif self.protocol in DATAGRAM_PROTOCOLS:
+                self.send_udp(data)
+        except Exception:
+            self.presence_sync_pending = False
+
+    def process_presence_delta(self, data):
+        """Apply a user_joined/user_left/presence event, resyncing on a version gap"""
+        # Ids are never reused, so even a delta out of order tells the right ones
+        self.learn_user_ids(data)
+
+        version = data.get('version')
+        if self.presence_version is not None and version <= self.presence_version:
+            # Already reflected in our list
+            return
+
+        if self.presence_version is None or version != self.presence_version + 1:
+            self.request_user_list()
+            return
+
+        self.presence_version = version
+        if data['type'] == 'user_joined':
+            self.signal_handler.user_joined.emit(data.get('user', ''))
+        elif data['type'] == 'user_left':
+            self.forget_user_ids({data.get('user')})
+            self.signal_handler.user_left.emit(data.get('user', ''))
+        else:
+            # Coalesced batch of joins and leaves
+            self.forget_user_ids(set(data.get('left', [])))
+            for username in data.get('left', []):
+                self.signal_handler.user_left.emit(username)
+            for username in data.get('joined', []):
+                self.signal_handler.user_joined.emit(username)
 
-            # Handle user list updates
-            if data.get('type') == 'user_list':
-                user_list = data.get('users', [])
-                self.signal_handler.user_list_updated.emit(user_list)
+    def learn_user_ids(self, data):
+        """Note the user ids announced by a user list, a presence delta or the welcome"""
+        if data['type'] == 'user_list':
+            self.user_names = {}
+        elif data['type'] == 'server':
+            self.user_names[data['user_id']] = self.username
+        elif 'id' in data:
+            self.user_names[data['id']] = data['user']
+        for username, user_id in data.get('ids', {}).items():
+            self.user_names[user_id] = username
+
+    def forget_user_ids(self, usernames):
+        """Drop the ids of users who left"""
+        for user_id, username in list(self.user_names.items()):
+            if username in usernames:
+                del self.user_names[user_id]
+
+    def process_payload(self, payload, multicast=False):
+        """Process a received message in either codec, compressed or not"""
+        if is_compressed(payload):
+            try:
+                payload = decompress(payload)
+            except ValueError:
                 return
 
-            # Handle all other messages
-            self.signal_handler.message_received.emit(data)
+        if not is_binary(payload):
+            self.process_message(payload.decode('utf-8'))
+            return
+
+        try:
+            data = decode_binary(payload)
+        except ValueError:
+            return
+        if isinstance(data, str):
+            # Bare text notice
+            self.signal_handler.message_received.emit({
+                "type": "legacy",
+                "message": data
+            })
+            return
+
+        if not data.get('from') and data.get('from_id'):
+            # Interned envelope: the sender's name was announced with their id
+            data['from'] = self.user_names.get(data['from_id'], '')
+        if multicast and data.get('type') == 'public' and data.get('from') == self.username:
+            # The group hands our own messages back to us
+            return
+        self.handle_message(data)
 
+    def process_message(self, data_str):
+        """Process received message and emit appropriate signals"""
+        try:
+            data = json.loads(data_str)
         except json.JSONDecodeError:
             self.signal_handler.message_received.emit({
                 "type": "legacy",
                 "message": data_str
             })
+            return
+        self.handle_message(data)
+
+    def handle_message(self, data):
+        """Emit the signals for a decoded message"""
+        # Handle user list updates
+        if data.get('type') == 'user_list':
+            user_list = data.get('users', [])
+            self.learn_user_ids(data)
+            self.presence_version = data.get('version')
+            self.presence_sync_pending = False
+            self.signal_handler.user_list_updated.emit(user_list)
+            return
+
+        # Handle incremental presence updates
+        if data.get('type') in ('user_joined', 'user_left', 'presence'):
+            self.process_presence_delta(data)
+
+            # A batch carries one summary notice for the whole storm
+            if data.get('message'):
+                self.signal_handler.message_received.emit({
+                    "type": "server",
+                    "message": data['message']
+                })
+            return
+
+        if data.get('type') == 'error' and data.get('expired'):
+            # Missed the reap window: come back as a new session
+            try:
+                self.register_udp()
+            except Exception:
+                pass
+
+        if data.get('type') == 'server':
+            if data.get('history'):
+                self.history_available = True
+            if data.get('user_id'):
+                self.learn_user_ids(data)
+            if 'codec' in data:
+                # Welcome telling which codec we may send in and whether we may compress
+                self.binary = data['codec'] == BINARY_CODEC
+                self.compressor = (Compressor() if data.get('compression') == ZLIB_COMPRESSION
+                                   else None)
+            if data.get('multicast') and not self.multicast_socket:
+                self.join_multicast(*data['multicast'])
+
+        # Handle all other messages
+        self.signal_handler.message_received.emit(data)
 
     def receive_tcp(self):
         while self.connected:
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(RECV_SIZE)
                 if not data:
                     break
 
-                message = data.decode('utf-8')
-                self.process_message(message)
+                if self.decoder:
+                    # One read may carry several messages
+                    for payload in self.decoder.feed(data):
+                        self.process_payload(payload)
+                else:
+                    message = data.decode('utf-8')
+                    self.process_message(message)
 
             except Exception as e:
                 if self.connected:  # Only show error if we're supposed to be connected
@@ -144,14 +418,30 @@ class ChatClient:
         self.connected = False
 
     def receive_udp(self):
-        # 10 seconds timeout to check connected flag
-        self.socket.settimeout(10)
+        # 10 seconds timeout to check connected flag, much less to drive
+        # retransmissions in reliable mode
+        self.socket.settimeout(RETRANSMIT_INTERVAL if self.channel else 10)
 
         while self.connected:
             try:
-                data, addr = self.socket.recvfrom(1024)
-                message = data.decode('utf-8')
-                self.process_message(message)
+                if self.channel:
+                    for datagram in self.channel.poll():
+                        self.socket.sendto(datagram, self.server_address)
+                    if self.channel.failed:
+                        self.signal_handler.connection_error.emit(
+                            "Connection lost: server stopped acknowledging messages")
+                        break
+
+                data, addr = self.socket.recvfrom(RECV_SIZE)
+                if self.channel and is_reliable(data):
+                    messages, datagrams = self.channel.receive(data)
+                    for datagram in datagrams:
+                        self.socket.sendto(datagram, self.server_address)
+                    for message in messages:
+                        self.process_payload(message)
+                    continue
+
+                self.process_payload(data)
 
             except socket.timeout:
                 # Timeout
@@ -164,13 +454,56 @@ class ChatClient:
 
         self.connected = False
 
+    def join_multicast(self, group, port):
+        """Join the server's multicast group, on the interface that reaches the server"""
+        try:
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                probe.connect(self.server_address)
+                interface = probe.getsockname()[0]
+            finally:
+                probe.close()
+
+            # Every client on this host binds the group port
+            self.multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.multicast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.multicast_socket.bind((group, port))
+            self.multicast_socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(interface)))
+        except OSError as e:
+            self.signal_handler.connection_error.emit(f"Multicast error: {str(e)}")
+            self.multicast_socket = None
+            # The server leaves us out of unicast sends to the group members
+            # until we register again without it
+            self.multicast = False
+            self.register_udp()
+            return
+
+        threading.Thread(target=self.receive_multicast, args=(self.multicast_socket,),
+                         daemon=True).start()
+
+    def receive_multicast(self, multicast_socket):
+        # 10 seconds timeout to check connected flag
+        multicast_socket.settimeout(10)
+
+        while self.connected:
+            try:
+                data, addr = multicast_socket.recvfrom(RECV_SIZE)
+                self.process_payload(data, multicast=True)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Closed by disconnect()
+                break
+
     def udp_heartbeat(self):
         while self.connected:
             try:
-                self.socket.sendto(json.dumps({
+                self.send_udp(json.dumps({
                     "type": "heartbeat",
                     "username": self.username
-                }).encode('utf-8'), self.server_address)
+                }).encode('utf-8'))
             except:
                 pass
 
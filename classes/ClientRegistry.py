@@ -0,0 +1,255 @@
+import itertools
+import threading
+
+from classes.Session import TCP
+
+# Default number of independently locked shards per map
+DEFAULT_SHARDS = 16
+
+
+class ShardedMap:
+    """Dict split over shards that each have their own lock.
+
+    Writers only lock the shard of their key, so handlers registering and
+    removing different clients do not contend. Reading one key takes no lock:
+    a single dict lookup is atomic. Iteration goes through a snapshot that
+    is built once per change and shared by every reader until the next one,
+    so a broadcast never sees the map change under it and, while membership
+    is stable, costs no copy at all.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+        # Bumped on every change; next() on a counter is atomic
+        self.changes = itertools.count(1)
+        self.version = 0
+        self.cached = (None, (), ())  # (version, items, keys)
+
+    def shard_of(self, key):
+        return hash(key) % len(self.shards)
+
+    def __getitem__(self, key):
+        return self.shards[self.shard_of(key)][key]
+
+    def get(self, key, default=None):
+        return self.shards[self.shard_of(key)].get(key, default)
+
+    def __contains__(self, key):
+        return key in self.shards[self.shard_of(key)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __setitem__(self, key, value):
+        index = self.shard_of(key)
+        with self.locks[index]:
+            self.shards[index][key] = value
+            self.version = next(self.changes)
+
+    def __delitem__(self, key):
+        index = self.shard_of(key)
+        with self.locks[index]:
+            del self.shards[index][key]
+            self.version = next(self.changes)
+
+    def pop(self, key, default=None):
+        """Remove key and return its value, or default if it was absent"""
+        index = self.shard_of(key)
+        with self.locks[index]:
+            if key not in self.shards[index]:
+                return default
+            value = self.shards[index].pop(key)
+            self.version = next(self.changes)
+            return value
+
+    def replace(self, key, old, new):
+        """Set key to new, or remove it if new is None, if it currently maps to old"""
+        index = self.shard_of(key)
+        with self.locks[index]:
+            if key not in self.shards[index] or self.shards[index][key] != old:
+                return False
+            if new is None:
+                del self.shards[index][key]
+            else:
+                self.shards[index][key] = new
+            self.version = next(self.changes)
+            return True
+
+    def snapshot(self):
+        """The (items, keys) tuples as of the last change"""
+        version, items, keys = self.cached
+        if version == self.version:
+            return items, keys
+
+        # Changes made while copying bump the version past this one
+        version = self.version
+        items = []
+        for index, shard in enumerate(self.shards):
+            with self.locks[index]:
+                items.extend(shard.items())
+        items = tuple(items)
+        keys = tuple(key for key, _ in items)
+        self.cached = (version, items, keys)
+        return items, keys
+
+    def items(self):
+        return self.snapshot()[0]
+
+    def keys(self):
+        return self.snapshot()[1]
+
+    def values(self):
+        return tuple(value for _, value in self.snapshot()[0])
+
+    def __iter__(self):
+        return iter(self.snapshot()[1])
+
+
+class ShardedSet(ShardedMap):
+    """ShardedMap used as a set"""
+
+    def add(self, key):
+        if key not in self:
+            self[key] = True
+
+    def discard(self, key):
+        self.pop(key)
+
+
+class ClientRegistry:
+    """Who is connected to this server.
+
+    Holds the TCP sessions by socket, the UDP sessions by address, the
+    online users, and one route per connected user: their TCP session,
+    else their UDP session, with a TCP session pointing at the user's UDP
+    session as its fallback. Each is a ShardedMap; updates that touch a
+    user's route run under a lock striped by username.
+
+    Routes are keyed by username rather than by the integer user id the
+    session carries: clients address users by name, so an id-keyed table
+    would cost a name-to-id lookup before every route lookup. Keeping the
+    session itself as the route also spares a route object and an id map
+    entry per user. The ids are interned for the wire (see WireCodec).
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self.tcp_clients = ShardedMap(shards)  # {client_socket: TcpSession}
+        self.udp_clients = ShardedMap(shards)  # {address: UdpSession}
+        self.online_users = ShardedSet(shards)  # {username}
+
+        self.routes = ShardedMap(shards)  # {username: TcpSession, else UdpSession}
+        self.next_user_id = itertools.count(1)
+        self.user_locks = [threading.Lock() for _ in range(shards)]
+
+    def user_lock(self, username):
+        return self.user_locks[hash(username) % len(self.user_locks)]
+
+    def add(self, session):
+        """Register a session; a newer one takes over its user's route for the protocol"""
+        clients = self.tcp_clients if session.protocol == TCP else self.udp_clients
+        previous = clients.get(session.endpoint)
+        if previous is not None:
+            # A UDP address registering again, possibly as someone else
+            self.detach(previous)
+        clients[session.endpoint] = session
+        self.attach(session)
+
+    def sessions_of(self, username):
+        """The (TCP session, UDP session) a user's messages may go to"""
+        session = self.routes.get(username)
+        if session is None:
+            return None, None
+        if session.protocol == TCP:
+            return session, session.fallback
+        return None, session
+
+    def set_route(self, username, tcp, udp):
+        """Route a user to their TCP session, else their UDP session"""
+        if tcp is not None:
+            tcp.fallback = udp
+            self.routes[username] = tcp
+        elif udp is not None:
+            self.routes[username] = udp
+        else:
+            self.routes.pop(username)
+
+    def attach(self, session):
+        """Make a session its user's route for its protocol"""
+        with self.user_lock(session.username):
+            tcp, udp = self.sessions_of(session.username)
+
+            # Connected users keep their id until their last session ends
+            current = tcp or udp
+            session.user_id = current.user_id if current else next(self.next_user_id)
+
+            if session.protocol == TCP:
+                if tcp is not None:
+                    tcp.fallback = None
+                tcp = session
+            else:
+                udp = session
+            self.set_route(session.username, tcp, udp)
+
+    def detach(self, session):
+        """Take a session out of its user's route, returning whether it was routed to.
+
+        The user id is released with the last session.
+        """
+        with self.user_lock(session.username):
+            tcp, udp = self.sessions_of(session.username)
+            if tcp is session:
+                tcp = session.fallback = None
+            elif udp is session:
+                udp = None
+            else:
+                return False
+            self.set_route(session.username, tcp, udp)
+            return True
+
+    def remove_tcp(self, client_socket):
+        """Unregister a TCP session, returning it or None if it was gone already"""
+        session = self.tcp_clients.pop(client_socket)
+        if session is not None:
+            self.detach(session)
+        return session
+
+    def remove_udp(self, address):
+        """Unregister a UDP session.
+
+        Returns (session, current) where current tells whether it was still
+        its user's UDP route, or None if it was gone.
+        """
+        session = self.udp_clients.pop(address)
+        if session is None:
+            return None
+        return session, self.detach(session)
+
+    def rename_udp(self, address, username):
+        """Move a UDP session to another username, returning the previous one"""
+        session = self.udp_clients.get(address)
+        if session is None:
+            return None
+        old_username = session.username
+        self.detach(session)
+        session.username = username
+        self.attach(session)
+        return old_username
+
+    def route(self, username):
+        """The session a user's messages go to (TCP first), or None"""
+        return self.routes.get(username)
+
+    def user_id(self, username, default=None):
+        """The id of a connected user, or default"""
+        session = self.routes.get(username)
+        return session.user_id if session is not None else default
+
+    def connected(self, username):
+        """Whether a user is connected over TCP or UDP"""
+        return username in self.routes
+
+    def usernames(self):
+        """The users connected over TCP or UDP"""
+        return set(self.routes)
@@ -0,0 +1,245 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from classes.FrameDecoder import FrameDecoder, encode_frame
+from classes.OutboundQueue import OutboundQueue
+
+# Bytes read per recv() on links
+LINK_RECV_SIZE = 65536
+
+# Seconds between two attempts to reach a node
+RECONNECT_INTERVAL = 1.0
+
+# Bytes queued for a node before its link is dropped (and later resynced)
+LINK_MAX_BYTES = 16 << 20
+
+# Random bytes of the challenge each end of a link sends
+NONCE_SIZE = 16
+
+
+def hello_proof(secret, nonce, node):
+    """HMAC of a peer's challenge and our node id under the cluster secret"""
+    return hmac.new(secret, f"{nonce}\0{node}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+class ClusterBus:
+    """Links this server node to the other nodes of a cluster.
+
+    Every pair of nodes shares one TCP link carrying length-prefixed JSON
+    messages, the same ones the worker bus relays, so a public message is
+    sent once per node whatever the number of users there. A node only needs
+    the address of one other node: links exchange the nodes they know and
+    every node connects to the ones it has no link with yet. When two nodes
+    connect to each other at once, both keep the link opened by the node
+    with the smaller id.
+
+    Both ends of a link first send a random challenge, and each answers the
+    other's with a hello carrying an HMAC of it under the shared cluster
+    secret. Nothing else is accepted from a link until its hello checks out,
+    and every later message is attributed to the node that proved itself.
+
+    The server gets {"op": "hello"} when a node is linked and {"op": "gone"}
+    when its link is lost, on behalf of that node.
+    """
+
+    def __init__(self, node, host, port, peers, on_message, secret):
+        self.node = node
+        self.port = port
+        self.on_message = on_message
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+
+        self.links = {}  # {node: link}
+        self.addresses = set(peers)  # 'host:port' of the nodes we keep connecting to
+        self.node_at = {}  # {address: node}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Accept links and start connecting to the known nodes"""
+        threading.Thread(target=self.accept, daemon=True).start()
+        for address in self.addresses:
+            threading.Thread(target=self.connect, args=(address,), daemon=True).start()
+
+    def add_address(self, address):
+        """Keep a link to the node at address"""
+        with self.lock:
+            if address in self.addresses:
+                return
+            self.addresses.add(address)
+        threading.Thread(target=self.connect, args=(address,), daemon=True).start()
+
+    def accept(self):
+        """Serve the links other nodes open"""
+        while True:
+            link_socket, _ = self.listener.accept()
+            threading.Thread(target=self.serve_link, args=(link_socket, None),
+                             daemon=True).start()
+
+    def connect(self, address):
+        """Keep a link to the node at address, reconnecting when it drops"""
+        host, port = address.rsplit(':', 1)
+        while True:
+            if self.node_at.get(address) not in self.links:
+                try:
+                    link_socket = socket.create_connection((host, int(port)), timeout=5)
+                    link_socket.settimeout(None)
+                except OSError:
+                    pass
+                else:
+                    self.serve_link(link_socket, address)
+            time.sleep(RECONNECT_INTERVAL)
+
+    def serve_link(self, link_socket, address):
+        """Introduce ourselves, then read a link until it closes"""
+        link_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = {
+            'socket': link_socket,
+            'node': None,
+            'outgoing': address is not None,
+            'outbound': OutboundQueue(max_bytes=LINK_MAX_BYTES,
+                                      high_watermark=LINK_MAX_BYTES,
+                                      low_watermark=LINK_MAX_BYTES),
+            'nonce': os.urandom(NONCE_SIZE).hex(),  # challenge the peer must answer
+            'challenged': False,  # whether we answered the peer's challenge
+        }
+        threading.Thread(target=self.write_link, args=(link,), daemon=True).start()
+        self.send(link, encode_frame(json.dumps({
+            "op": "challenge", "nonce": link['nonce']}).encode('utf-8')))
+
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = link_socket.recv(LINK_RECV_SIZE)
+                if not data:
+                    break
+
+                for payload in decoder.feed(data):
+                    message = json.loads(payload.decode('utf-8'))
+                    if not isinstance(message, dict):
+                        raise ValueError("Not a message object")
+                    if link['node'] is not None:
+                        # Peers speak for themselves only
+                        message['node'] = link['node']
+                        self.on_message(message)
+                    elif not link['challenged']:
+                        if not self.answer(link, message):
+                            return
+                    elif not self.attach(link, message, address):
+                        return
+        except (OSError, ValueError) as e:
+            logging.error(f"Cluster link error: {str(e)}")
+        finally:
+            link['outbound'].close()
+            link_socket.close()
+            self.detach(link)
+
+    def answer(self, link, challenge):
+        """Prove we know the cluster secret, False if the link must be closed"""
+        nonce = challenge.get('nonce')
+        if challenge.get('op') != 'challenge' or not isinstance(nonce, str):
+            return False
+        link['challenged'] = True
+        self.send(link, encode_frame(json.dumps({
+            "op": "hello", "node": self.node, "port": self.port,
+            "proof": hello_proof(self.secret, nonce, self.node),
+            "nodes": self.known_nodes()
+        }).encode('utf-8')))
+        return True
+
+    def attach(self, link, hello, address):
+        """Register a link from the node's hello, False if it must be closed"""
+        peer = hello.get('node')
+        if (hello.get('op') != 'hello' or not isinstance(peer, str) or peer == self.node
+                or not isinstance(hello.get('port'), int)):
+            return False
+        proof = hello.get('proof')
+        if not isinstance(proof, str) or not hmac.compare_digest(
+                proof, hello_proof(self.secret, link['nonce'], peer)):
+            logging.error(f"Cluster link from {link['socket'].getpeername()[0]} "
+                          f"failed authentication")
+            return False
+
+        if address is None:
+            address = f"{link['socket'].getpeername()[0]}:{hello['port']}"
+
+        with self.lock:
+            self.node_at[address] = peer
+            existing = self.links.get(peer)
+            if existing is not None:
+                # Linked both ways: keep the link the smaller node id opened
+                if (self.node if existing['outgoing'] else peer) == min(self.node, peer):
+                    return False
+                try:
+                    existing['socket'].shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            link['node'] = peer
+            self.links[peer] = link
+
+        logging.info(f"Cluster node linked: {peer} at {address}")
+        self.add_address(address)
+        for node, node_address in hello.get('nodes', []):
+            if node != self.node and node not in self.links:
+                self.add_address(node_address)
+
+        self.on_message({"op": "hello", "node": peer})
+        return True
+
+    def detach(self, link):
+        """Forget a closed link, reporting its node gone if it was the live one"""
+        with self.lock:
+            node = link['node']
+            if node is None or self.links.get(node) is not link:
+                return
+            del self.links[node]
+
+        logging.error(f"Cluster node lost: {node}")
+        self.on_message({"op": "gone", "node": node})
+
+    def known_nodes(self):
+        """The [node, address] pairs this node is linked with"""
+        with self.lock:
+            return [[node, address] for address, node in self.node_at.items()
+                    if node in self.links]
+
+    def send(self, link, frame):
+        """Queue a frame on one link, dropping the link if it cannot keep up"""
+        if not link['outbound'].put(frame):
+            logging.error(f"Cluster link to {link['node']} overflowed, dropping it")
+            try:
+                link['socket'].shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def write_link(self, link):
+        """Send what is queued for a link"""
+        outbound = link['outbound']
+        try:
+            while outbound.wait():
+                data = outbound.front()
+                if data is not None:
+                    outbound.consume(link['socket'].send(data))
+        except OSError:
+            pass
+
+    def publish(self, message, to_node=None):
+        """Send a message to one node, or once to every other node"""
+        frame = encode_frame(json.dumps(dict(message, node=self.node)).encode('utf-8'))
+        with self.lock:
+            if to_node is not None:
+                links = [self.links[to_node]] if to_node in self.links else []
+            else:
+                links = list(self.links.values())
+
+        for link in links:
+            self.send(link, frame)
@@ -0,0 +1,79 @@
+from classes.FrameDecoder import encode_frame
+from classes.Metrics import message_kind
+from classes.WireCodec import compact
+
+
+class EncodedMessage:
+    """A message serialized once and shared by every recipient of a broadcast"""
+
+    def __init__(self, message, droppable=False, delivery=None, sender_id=0,
+                 sender_announced=False):
+        self.payload = message.encode('utf-8')
+
+        # Forms other than the plain payload, built the first time a client
+        # needs them: {(binary, compressed, framed, interned): bytes}. The
+        # binary codec carries the user id of the sender in its header, and
+        # interned envelopes leave the sender's name out once every client
+        # was told their id (over TCP, where nothing overtakes that news)
+        self.sender_id = sender_id
+        self.sender_announced = sender_announced
+        self.variants = {}
+
+        # Whether slow recipients may skip this message (public chat lines)
+        self.droppable = droppable
+
+        # Type counted in the metrics, and the Delivery following a client's
+        # message to its recipients, if any
+        self.kind = message_kind(self.payload)
+        self.delivery = delivery
+
+    def encoded(self, binary=False, compressor=None, framed=False, interned=False):
+        """Return the message in a codec, compressed by compressor if any, framed if asked"""
+        interned = interned and binary and self.sender_announced
+        key = (binary, compressor is not None, framed, interned)
+        data = self.variants.get(key)
+        if data is None:
+            if framed:
+                data = encode_frame(self.encoded(binary, compressor, interned=interned))
+            elif compressor is not None:
+                data = compressor.compress(self.encoded(binary, interned=interned))
+            elif binary:
+                data = compact(self.payload, self.kind, self.sender_id, interned)
+            else:
+                data = self.payload
+            self.variants[key] = data
+        return data
+
+    def for_tcp(self, framed, binary=False, compressor=None):
+        """Return the buffer to queue for a framed or legacy TCP client"""
+        if not framed:
+            return self.payload
+        return self.encoded(binary, compressor, framed=True, interned=True)
+
+    def for_udp(self, binary=False, compressor=None):
+        """Return the datagram to send to UDP clients"""
+        return self.encoded(binary, compressor)
+
+
+class EncodedBatch:
+    """Several messages queued as one buffer for a framed TCP client"""
+
+    def __init__(self, messages):
+        self.payloads = [message.encode('utf-8') for message in messages]
+
+        # Never shed: the messages were waiting for this recipient
+        self.droppable = False
+
+        self.kind = 'mailbox'
+        self.delivery = None
+
+    def for_tcp(self, framed, binary=False, compressor=None):
+        """Return the frames of every message back to back"""
+        if not framed:
+            raise ValueError("Unframed clients need one write per message")
+        payloads = self.payloads
+        if binary:
+            payloads = [compact(payload, message_kind(payload)) for payload in payloads]
+        if compressor is not None:
+            payloads = [compressor.compress(payload) for payload in payloads]
+        return b''.join(encode_frame(payload) for payload in payloads)
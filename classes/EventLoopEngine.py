@@ -0,0 +1,409 @@
+import collections
+import functools
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from classes.FrameDecoder import split_handshake
+from classes.OutboundQueue import send_front
+from classes.Session import TCP_RECV_SIZE, UDP_RECV_SIZE
+
+
+class _EventLoop:
+    """One selector loop owning a subset of the TCP connections"""
+
+    def __init__(self, engine, index):
+        self.engine = engine
+        self.index = index
+        self.selector = selectors.DefaultSelector()
+        self.thread_ident = None
+
+        # {client_socket: {'address': address, 'handshake': bytes or None once registered,
+        #                  'outbound': OutboundQueue, 'coalesce': bool, 'paused': bool,
+        #                  'blocked': bool, 'flush_scheduled': bool}}
+        self.connections = {}
+
+        # Connections to flush at a deadline, in deadline order: (deadline, client_socket)
+        self.delayed_flushes = collections.deque()
+
+        # Callbacks scheduled from other loops, run on this loop's thread
+        self.pending = collections.deque()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ,
+                               self.handle_wake)
+
+    def call_soon(self, callback, *args):
+        """Schedule a callback on this loop, waking it up if needed"""
+        self.pending.append((callback, args))
+        if threading.get_ident() != self.thread_ident:
+            try:
+                self.wake_writer.send(b'\0')
+            except BlockingIOError:
+                # A wake-up is already pending
+                pass
+
+    def handle_wake(self, wake_socket, mask):
+        """Drain the wake-up socket"""
+        try:
+            while wake_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run_pending(self):
+        """Run the callbacks scheduled so far"""
+        for _ in range(len(self.pending)):
+            callback, args = self.pending.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                # One failing callback must not stop the loop and its connections
+                logging.exception(f"Error in scheduled {getattr(callback, '__name__', callback)}")
+
+    def add_connection(self, client_socket, address):
+        """Start watching a freshly accepted TCP connection"""
+        client_socket.setblocking(False)
+        self.engine.server.configure_tcp_client(client_socket)
+        self.connections[client_socket] = {
+            'address': address, 'handshake': b'', 'outbound': None, 'coalesce': False,
+            'paused': False, 'blocked': False, 'flush_scheduled': False}
+        self.selector.register(client_socket, selectors.EVENT_READ,
+                               self.handle_connection)
+
+    def handle_connection(self, client_socket, mask):
+        """Dispatch readiness events of a TCP connection"""
+        if mask & selectors.EVENT_WRITE:
+            self.flush(client_socket)
+        if mask & selectors.EVENT_READ and client_socket in self.connections:
+            self.read(client_socket)
+
+    def read(self, client_socket):
+        """Read from a TCP connection and hand every complete message to the server"""
+        server = self.engine.server
+        connection = self.connections[client_socket]
+
+        try:
+            data = client_socket.recv(TCP_RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.error(f"TCP client error: {str(e)}")
+            self.close(client_socket)
+            return
+
+        if not data:
+            self.close(client_socket)
+            return
+
+        if connection['handshake'] is not None:
+            # First message carries the username, possibly followed by more
+            try:
+                buffer = connection['handshake'] + data
+                username_info, data = split_handshake(buffer)
+                if username_info is None:
+                    connection['handshake'] = buffer
+                    return
+
+                connection['handshake'] = None
+                server.register_tcp_client(
+                    client_socket, connection['address'], username_info)
+
+                # Drain the server's outbound queue whenever it gets data
+                session = server.tcp_clients[client_socket]
+                outbound = session.outbound
+                connection['outbound'] = outbound
+                # Legacy clients read one JSON message per write
+                connection['coalesce'] = session.decoder is not None
+                outbound.on_ready = functools.partial(
+                    self.engine.schedule_flush, client_socket)
+            except Exception as e:
+                logging.error(f"Error handling TCP client: {str(e)}")
+                self.close(client_socket)
+                return
+
+            self.flush(client_socket)
+
+            if not data:
+                return
+
+        try:
+            server.receive_tcp_data(client_socket, data)
+        except Exception as e:
+            logging.error(f"TCP client error: {str(e)}")
+            self.close(client_socket)
+
+    def schedule_flush(self, client_socket):
+        """Flush a connection after the callbacks of this iteration, or at its flush deadline.
+
+        Everything queued meanwhile goes out in the same write.
+        """
+        connection = self.connections.get(client_socket)
+        if connection is None or connection['flush_scheduled'] or connection['blocked']:
+            return
+
+        connection['flush_scheduled'] = True
+        flush_delay = self.engine.server.flush_delay
+        if flush_delay:
+            self.delayed_flushes.append(
+                (connection['outbound'].queued_at + flush_delay, client_socket))
+        else:
+            self.call_soon(self.flush, client_socket)
+
+    def run_delayed_flushes(self):
+        """Flush the connections whose deadline passed"""
+        now = time.monotonic()
+        while self.delayed_flushes and self.delayed_flushes[0][0] <= now:
+            self.flush(self.delayed_flushes.popleft()[1])
+
+    def flush(self, client_socket):
+        """Send queued data without blocking, waiting for writability if needed"""
+        connection = self.connections.get(client_socket)
+        if connection is None or connection['outbound'] is None:
+            return
+
+        server = self.engine.server
+        outbound = connection['outbound']
+        connection['blocked'] = False
+        connection['flush_scheduled'] = False
+        try:
+            while True:
+                written = send_front(client_socket, outbound, connection['coalesce'])
+                if not written:
+                    break
+                server.stats['tcp_writes'] += 1
+                server.stats['tcp_buffers_written'] += written
+        except BlockingIOError:
+            connection['blocked'] = True
+        except OSError:
+            # Close later so broadcasts iterating the clients are not disturbed
+            self.call_soon(self.close, client_socket)
+            return
+
+        self.update_events(client_socket)
+
+    def set_paused(self, client_socket, paused):
+        """Stop or restart reading from a TCP connection"""
+        connection = self.connections.get(client_socket)
+        if connection is None:
+            return
+
+        connection['paused'] = paused
+        self.update_events(client_socket)
+
+    def update_events(self, client_socket):
+        """Watch a connection for reads unless paused, and for writes while blocked"""
+        connection = self.connections[client_socket]
+        events = 0
+        if not connection['paused']:
+            events |= selectors.EVENT_READ
+        if connection['blocked']:
+            events |= selectors.EVENT_WRITE
+
+        try:
+            key = self.selector.get_key(client_socket)
+        except KeyError:
+            if events:
+                self.selector.register(client_socket, events,
+                                       self.handle_connection)
+            return
+
+        if not events:
+            self.selector.unregister(client_socket)
+        elif key.events != events:
+            self.selector.modify(client_socket, events, self.handle_connection)
+
+    def close(self, client_socket):
+        """Forget a TCP connection and let the server clean up after it"""
+        if self.connections.pop(client_socket, None) is None:
+            return
+
+        try:
+            self.selector.unregister(client_socket)
+        except KeyError:
+            # Paused and not blocked, so not watched at all
+            pass
+        self.engine.loop_of.pop(client_socket, None)
+        self.engine.server.remove_tcp_client(client_socket)
+        client_socket.close()
+
+    def run(self, tick=None, tick_interval=None):
+        """Run the loop forever, calling tick every tick_interval seconds if given"""
+        self.thread_ident = threading.get_ident()
+        next_tick = time.monotonic() + tick_interval if tick else None
+        while True:
+            # Do not sleep while callbacks scheduled from this thread are waiting
+            if self.pending:
+                timeout = 0
+            elif tick:
+                timeout = max(0, next_tick - time.monotonic())
+            else:
+                timeout = None
+            if self.delayed_flushes:
+                deadline = max(0, self.delayed_flushes[0][0] - time.monotonic())
+                timeout = deadline if timeout is None else min(timeout, deadline)
+
+            for key, mask in self.selector.select(timeout):
+                key.data(key.fileobj, mask)
+            self.run_pending()
+            self.run_delayed_flushes()
+
+            if tick and time.monotonic() >= next_tick:
+                next_tick = time.monotonic() + tick_interval
+                try:
+                    tick()
+                except Exception as e:
+                    logging.error(f"Housekeeping error: {str(e)}")
+
+
+class EventLoopEngine:
+    """Event-driven engine multiplexing all TCP connections and the UDP socket"""
+
+    def __init__(self, server, loops=1):
+        self.server = server
+        self.loops = [_EventLoop(self, index) for index in range(max(1, loops))]
+        self.next_loop = itertools.cycle(self.loops)
+
+        # {client_socket: owning loop}
+        self.loop_of = {}
+
+    def call_soon(self, callback, *args):
+        """Run a callback on the first loop, which owns the UDP socket"""
+        self.loops[0].call_soon(callback, *args)
+
+    def schedule_flush(self, client_socket):
+        """Flush a TCP connection's outbound queue on its owning loop, coalescing writes"""
+        self.run_on_owner(client_socket, 'schedule_flush')
+
+    def pause_reading(self, client_socket):
+        """Stop reading from a TCP connection (backpressure)"""
+        self.run_on_owner(client_socket, 'set_paused', True)
+
+    def resume_reading(self, client_socket):
+        """Restart reading from a paused TCP connection"""
+        self.run_on_owner(client_socket, 'set_paused', False)
+
+    def run_on_owner(self, client_socket, method, *args):
+        """Call a loop method for a TCP connection on the loop owning it"""
+        loop = self.loop_of.get(client_socket)
+        if loop is None:
+            return
+
+        callback = getattr(loop, method)
+        if threading.get_ident() == loop.thread_ident:
+            callback(client_socket, *args)
+        else:
+            loop.call_soon(callback, client_socket, *args)
+
+    def schedule_udp_flush(self):
+        """Flush the UDP outbound queue on the first loop"""
+        main_loop = self.loops[0]
+        if threading.get_ident() == main_loop.thread_ident:
+            self.flush_udp()
+        else:
+            main_loop.call_soon(self.flush_udp)
+
+    def flush_udp(self):
+        """Send queued datagrams without blocking, waiting for writability if needed"""
+        server = self.server
+        outbound = server.udp_outbound
+        blocked = None
+
+        while True:
+            item = outbound.front()
+            if item is None:
+                break
+
+            data, address = item
+            datagram_socket = server.datagram_socket(address)
+            try:
+                datagram_socket.sendto(data, address)
+            except BlockingIOError:
+                blocked = datagram_socket
+                break
+            except OSError as e:
+                logging.error(f"UDP send error to {address}: {str(e)}")
+            outbound.pop()
+
+        selector = self.loops[0].selector
+        for datagram_socket in (server.udp_socket, server.unix_datagram_socket):
+            if datagram_socket is None:
+                continue
+            events = selectors.EVENT_READ
+            if datagram_socket is blocked:
+                events |= selectors.EVENT_WRITE
+            if selector.get_key(datagram_socket).events != events:
+                selector.modify(datagram_socket, events, self.handle_udp)
+
+    def handle_accept(self, listening_socket, mask):
+        """Accept pending TCP or Unix stream connections and spread them over the loops"""
+        while True:
+            try:
+                client_socket, address = listening_socket.accept()
+            except BlockingIOError:
+                return
+            if listening_socket is self.server.unix_socket:
+                # Unix clients have no address of their own
+                address = self.server.unix_address
+
+            loop = next(self.next_loop)
+            self.loop_of[client_socket] = loop
+            loop.call_soon(loop.add_connection, client_socket, address)
+
+    def handle_udp(self, udp_socket, mask):
+        """Dispatch readiness events of the UDP or Unix datagram socket"""
+        if mask & selectors.EVENT_WRITE:
+            self.flush_udp()
+        if mask & selectors.EVENT_READ:
+            self.read_udp(udp_socket)
+
+    def read_udp(self, udp_socket):
+        """Process every datagram waiting on the UDP socket"""
+        while True:
+            try:
+                data, address = udp_socket.recvfrom(UDP_RECV_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on Windows
+                logging.error(f"UDP error: {str(e)}")
+                continue
+
+            try:
+                self.server.process_udp_datagram(data, address)
+            except Exception as e:
+                logging.error(f"UDP error: {str(e)}")
+
+    def serve_forever(self):
+        """Run the listening sockets on the first loop and start the others"""
+        server = self.server
+        main_loop = self.loops[0]
+
+        server.tcp_socket.listen(128)
+        server.tcp_socket.setblocking(False)
+        server.udp_socket.setblocking(False)
+        main_loop.selector.register(server.tcp_socket, selectors.EVENT_READ,
+                                    self.handle_accept)
+        main_loop.selector.register(server.udp_socket, selectors.EVENT_READ,
+                                    self.handle_udp)
+        if server.unix_socket:
+            server.unix_socket.listen(128)
+            server.unix_socket.setblocking(False)
+            main_loop.selector.register(server.unix_socket, selectors.EVENT_READ,
+                                        self.handle_accept)
+        if server.unix_datagram_socket:
+            server.unix_datagram_socket.setblocking(False)
+            main_loop.selector.register(server.unix_datagram_socket, selectors.EVENT_READ,
+                                        self.handle_udp)
+        server.udp_outbound.on_ready = self.schedule_udp_flush
+
+        for loop in self.loops[1:]:
+            threading.Thread(target=loop.run, daemon=True).start()
+
+        logging.info(
+            f"Server is running on {len(self.loops)} event loop(s) and listening for connections...")
+        main_loop.run(server.tick, server.tick_interval)
@@ -0,0 +1,70 @@
+import json
+import struct
+
+# 4-byte big-endian payload length in front of every message
+FRAME_HEADER = struct.Struct('!I')
+
+# Frames stay below 16 MiB so the first header byte is always zero, which
+# can never start a legacy (unframed) JSON or text message
+MAX_FRAME_SIZE = 0xFFFFFF
+
+# Largest initial {"username": ...} message we wait for
+MAX_HANDSHAKE_SIZE = 4096
+
+
+def encode_frame(payload):
+    """Prefix a payload with its length"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def split_handshake(buffer):
+    """Split the leading JSON handshake off a buffer.
+
+    Returns (handshake, rest) where rest holds any bytes the client
+    pipelined after it. While the object is still incomplete, handshake is
+    None and rest is the whole buffer, to be extended with the next read.
+    """
+    # surrogateescape keeps framed bytes following the handshake intact
+    text = bytes(buffer).decode('utf-8', 'surrogateescape')
+    try:
+        handshake, end = json.JSONDecoder().raw_decode(text)
+    except json.JSONDecodeError:
+        if len(buffer) >= MAX_HANDSHAKE_SIZE:
+            raise
+        return None, bytes(buffer)
+
+    return handshake, text[end:].encode('utf-8', 'surrogateescape')
+
+
+class FrameDecoder:
+    """Per-connection receive buffer splitting a byte stream into frames"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return the payload of every complete frame"""
+        buffer = self.buffer
+        buffer += data
+
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(buffer) - offset >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise ValueError(
+                    f"Frame of {length} bytes exceeds {self.max_frame_size}")
+
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+
+            frames.append(bytes(buffer[offset + header_size:end]))
+            offset = end
+
+        del buffer[:offset]
+        return frames
@@ -0,0 +1,99 @@
+# Sub-buckets per power of two, as a power of two: 2**7 = 128 keeps every
+# recorded value within 1% of its bucket (two significant digits)
+DEFAULT_PRECISION_BITS = 7
+
+# Values above this are counted as this (about 1 hour in microseconds)
+DEFAULT_HIGHEST_VALUE = 1 << 32
+
+# Percentiles listed by summary()
+SUMMARY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+    """HDR-style histogram of non-negative integers.
+
+    Buckets are linear up to 2 * 2**precision_bits and then split every
+    power of two into 2**precision_bits sub-buckets, so the relative error
+    is bounded whatever the magnitude and recording is one index
+    computation and one increment. Percentiles are read back from the
+    counts without keeping the values.
+
+    Recording takes no lock: like the server's counters, a concurrent
+    increment may rarely be lost, which percentiles do not notice.
+    """
+
+    def __init__(self, precision_bits=DEFAULT_PRECISION_BITS,
+                 highest_value=DEFAULT_HIGHEST_VALUE):
+        self.precision_bits = precision_bits
+        self.half = 1 << precision_bits
+        self.highest_value = highest_value
+        self.counts = [0] * (self.index_of(highest_value) + 1)
+        self.reset()
+
+    def reset(self):
+        """Forget every recorded value"""
+        self.counts = [0] * len(self.counts)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def index_of(self, value):
+        """The bucket counting value"""
+        shift = max(0, value.bit_length() - self.precision_bits - 1)
+        return shift * self.half + (value >> shift)
+
+    def value_at(self, index):
+        """The middle of the values counted by a bucket"""
+        shift = max(0, index // self.half - 1)
+        low = (index - shift * self.half) << shift
+        return low + ((1 << shift) - 1) // 2
+
+    def record(self, value, count=1):
+        """Count value, clamped to [0, highest_value], count times"""
+        value = min(max(int(value), 0), self.highest_value)
+        self.counts[self.index_of(value)] += count
+        self.total += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the counts of a histogram with the same precision"""
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """The value below which percent of the recorded values fall"""
+        if not self.total:
+            return 0
+        rank = max(1, round(self.total * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0
+
+    def summary(self, scale=1):
+        """Count, min, mean, percentiles and max, values divided by scale"""
+        result = {
+            "count": self.total,
+            "min": (self.min or 0) / scale,
+            "mean": round(self.mean() / scale, 3),
+        }
+        for percent in SUMMARY_PERCENTILES:
+            result[f"p{percent:g}".replace('.', '')] = self.percentile(percent) / scale
+        result["max"] = self.max / scale
+        return result
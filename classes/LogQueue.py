@@ -0,0 +1,157 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Name of the logger for per-message lines (chat messages relayed)
+MESSAGE_LOGGER = 'chatter.messages'
+
+# Default bound on records waiting for the writer thread
+DEFAULT_QUEUE_SIZE = 10000
+
+# Default per-message lines written per second (0 writes them all)
+DEFAULT_MESSAGE_RATE = 50
+
+# Default 1 in N per-message lines kept before rate limiting
+DEFAULT_MESSAGE_SAMPLE = 1
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def log_chat(logger, text, *args, body=None):
+    """Log a relayed chat message, with its body only at debug level.
+
+    text is a %-format string: arguments are only formatted by the writer,
+    for lines that are kept.
+    """
+    if body is not None and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(text + ': %s', *args, body)
+    else:
+        logger.info(text, *args)
+
+
+class MessageLogFilter(logging.Filter):
+    """Keeps 1 in sample records, then at most rate records per second.
+
+    The next record kept tells how many were skipped since the previous one.
+    """
+
+    def __init__(self, rate=DEFAULT_MESSAGE_RATE, sample=DEFAULT_MESSAGE_SAMPLE):
+        super().__init__()
+        self.rate = rate
+        self.sample = max(1, sample)
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.seen = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            self.seen += 1
+            if self.seen % self.sample:
+                self.skipped += 1
+                return False
+
+            if self.rate:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.tokens < 1:
+                    self.skipped += 1
+                    return False
+                self.tokens -= 1
+
+            if self.skipped:
+                record.msg = f"{record.msg} (%d similar lines skipped)"
+                record.args = tuple(record.args or ()) + (self.skipped,)
+                self.skipped = 0
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the thread logging.
+
+    Records are handed over unformatted, formatting and writing happen on
+    the writer thread; when the queue is full they are dropped, and the
+    next record that fits is preceded by a warning with the count.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Arguments are plain values, safe to format on another thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': "Log queue full, dropped %d records", 'args': (self.dropped,)}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogQueue:
+    """Root logging through a bounded queue drained by a writer thread.
+
+    The handler threads only append records to the queue; a QueueListener
+    formats them and writes them to stderr. Per-message lines go through
+    MESSAGE_LOGGER, sampled and rate-limited by a MessageLogFilter. With a
+    queue_size of 0, records are written synchronously as before.
+    """
+
+    def __init__(self, level=logging.INFO, queue_size=DEFAULT_QUEUE_SIZE,
+                 message_rate=DEFAULT_MESSAGE_RATE, message_sample=DEFAULT_MESSAGE_SAMPLE):
+        self.queue_size = queue_size
+        self.stream_handler = logging.StreamHandler()
+        self.stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.handler = None
+        self.listener = None
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+
+        message_logger = logging.getLogger(MESSAGE_LOGGER)
+        for old_filter in list(message_logger.filters):
+            message_logger.removeFilter(old_filter)
+        message_logger.addFilter(MessageLogFilter(message_rate, message_sample))
+
+        if not queue_size:
+            root.addHandler(self.stream_handler)
+            return
+
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        root.addHandler(self.handler)
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        """Start the writer thread, with a new queue after a fork"""
+        if self.handler is None:
+            return
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.stream_handler)
+        self.listener.start()
+
+    def stop(self):
+        """Write what is queued and stop the writer thread"""
+        if self.listener is None:
+            return
+        while True:
+            try:
+                self.listener.stop()
+                break
+            except queue.Full:
+                # No room for the end marker yet, the writer is draining
+                time.sleep(0.01)
+        self.listener = None
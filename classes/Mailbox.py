@@ -0,0 +1,230 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+# Default seconds a stored message waits for its recipient
+DEFAULT_TTL = 7 * 24 * 3600
+
+# Default number of messages stored per recipient
+DEFAULT_MAX_MESSAGES = 1000
+
+# Recipients with stored messages before new ones are refused
+MAX_RECIPIENTS = 100000
+
+# Default bytes of stored messages, over all recipients, before new ones are refused
+DEFAULT_MAX_STORED_BYTES = 64 << 20
+
+# Journal lines beyond twice the live messages before the journal is rewritten
+COMPACT_SLACK = 10000
+
+
+class Mailbox:
+    """Private messages kept for recipients who are offline.
+
+    Each recipient has a bounded queue of messages, each with an expiry
+    time, and all queues together hold at most max_bytes. Messages are
+    taken all at once when their recipient connects. Only users that were
+    remember()ed (they connected at some point) get a mailbox, so mistyped
+    or made-up names are refused.
+
+    With a path, every change is appended to a journal file as one JSON
+    line, replayed on startup, so stored messages survive a restart; the
+    journal is rewritten with only the live messages once it grew well past
+    them.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_messages=DEFAULT_MAX_MESSAGES,
+                 path=None, stats=None, max_bytes=DEFAULT_MAX_STORED_BYTES):
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.path = path
+
+        # Counters, possibly shared with the owner
+        self.stats = stats if stats is not None else collections.Counter()
+
+        self.boxes = {}  # {recipient: deque of (expires, message)}
+        self.lock = threading.Lock()
+
+        # Users who may receive mail, and the bytes of every stored message
+        # (serialized JSON, ASCII so one byte per character)
+        self.known_users = set()
+        self.stored_bytes = 0
+
+        self.journal = None
+        self.journal_lines = 0
+        if path:
+            self.replay()
+            self.compact()
+
+    def __contains__(self, recipient):
+        return recipient in self.boxes
+
+    def remember(self, username):
+        """Accept mail for a user from now on"""
+        if username in self.known_users:
+            return
+        with self.lock:
+            self.known_users.add(username)
+            self.log({"known": username})
+
+    def put(self, recipient, message):
+        """Store a message for recipient, returning False if they are unknown
+        or the mailbox is full"""
+        now = time.time()
+        with self.lock:
+            if recipient not in self.known_users:
+                self.stats['mailbox_unknown'] += 1
+                return False
+            if self.stored_bytes + len(message) > self.max_bytes:
+                self.stats['mailbox_refused'] += 1
+                return False
+
+            box = self.boxes.get(recipient)
+            if box is None:
+                if len(self.boxes) >= MAX_RECIPIENTS:
+                    self.stats['mailbox_refused'] += 1
+                    return False
+                box = self.boxes[recipient] = collections.deque()
+
+            self.drop_expired(recipient, box, now)
+            if len(box) >= self.max_messages:
+                self.stats['mailbox_refused'] += 1
+                if not box:
+                    del self.boxes[recipient]
+                return False
+
+            box.append((now + self.ttl, message))
+            self.stored_bytes += len(message)
+            self.log({"put": recipient, "expires": now + self.ttl, "message": message})
+            self.stats['mailbox_stored'] += 1
+            return True
+
+    def take(self, recipient):
+        """Remove and return the (expires, message) pairs still valid for recipient"""
+        with self.lock:
+            box = self.boxes.pop(recipient, None)
+            if box is None:
+                return []
+
+            self.drop_expired(recipient, box, time.time())
+            self.stored_bytes -= sum(len(message) for expires, message in box)
+            self.log({"take": recipient})
+            return list(box)
+
+    def restore(self, recipient, entries):
+        """Put back (expires, message) pairs taken but not delivered, ahead of newer ones.
+
+        Messages stored meanwhile beyond max_messages are dropped.
+        """
+        with self.lock:
+            box = self.boxes.setdefault(recipient, collections.deque())
+            had = len(box)
+            box.extendleft(reversed(entries))
+            self.stored_bytes += sum(len(message) for expires, message in entries)
+            while len(box) > self.max_messages:
+                self.stored_bytes -= len(box.pop()[1])
+                self.stats['mailbox_trimmed'] += 1
+
+            if len(box) < had + len(entries):
+                # The journal cannot drop single messages: write the box anew
+                self.log({"take": recipient})
+                entries = list(box)
+            for expires, message in entries:
+                self.log({"put": recipient, "expires": expires, "message": message})
+
+    def expire(self):
+        """Drop every expired message, returning how many there were"""
+        now = time.time()
+        expired = 0
+        with self.lock:
+            for recipient, box in list(self.boxes.items()):
+                expired += self.drop_expired(recipient, box, now)
+                if not box:
+                    del self.boxes[recipient]
+
+            # The journal still holds them until it is rewritten
+            if expired:
+                self.maybe_compact()
+        return expired
+
+    def drop_expired(self, recipient, box, now):
+        """Drop the expired messages at the front of a recipient's queue"""
+        expired = 0
+        while box and box[0][0] <= now:
+            self.stored_bytes -= len(box.popleft()[1])
+            expired += 1
+        self.stats['mailbox_expired'] += expired
+        return expired
+
+    def replay(self):
+        """Rebuild the mailboxes from the journal"""
+        if not os.path.exists(self.path):
+            return
+
+        now = time.time()
+        with open(self.path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line
+                    continue
+                if 'known' in entry:
+                    self.known_users.add(entry['known'])
+                elif 'take' in entry:
+                    self.boxes.pop(entry['take'], None)
+                elif entry['expires'] > now:
+                    # Journals from before known users were kept
+                    self.known_users.add(entry['put'])
+                    self.boxes.setdefault(entry['put'], collections.deque()).append(
+                        (entry['expires'], entry['message']))
+
+        stored = sum(len(box) for box in self.boxes.values())
+        self.stored_bytes = sum(len(message) for box in self.boxes.values()
+                                for expires, message in box)
+        logging.info(f"Mailbox: {stored} stored messages for {len(self.boxes)} users")
+
+    def log(self, entry):
+        """Append a change to the journal"""
+        if self.journal is None:
+            return
+        try:
+            self.journal.write(json.dumps(entry) + '\n')
+            self.journal.flush()
+        except OSError as e:
+            logging.error(f"Mailbox journal error: {str(e)}")
+        self.journal_lines += 1
+        self.maybe_compact()
+
+    def maybe_compact(self):
+        """Rewrite the journal if most of its lines are obsolete"""
+        if self.journal is None:
+            return
+        live = sum(len(box) for box in self.boxes.values()) + len(self.known_users)
+        if self.journal_lines > 2 * live + COMPACT_SLACK:
+            self.compact()
+
+    def compact(self):
+        """Replace the journal with one line per known user and live message"""
+        if self.journal is not None:
+            self.journal.close()
+
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as journal:
+            for username in self.known_users:
+                journal.write(json.dumps({"known": username}) + '\n')
+            for recipient, box in self.boxes.items():
+                for expires, message in box:
+                    journal.write(json.dumps(
+                        {"put": recipient, "expires": expires, "message": message}) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary, self.path)
+
+        self.journal = open(self.path, 'a', encoding='utf-8')
+        self.journal_lines = (sum(len(box) for box in self.boxes.values())
+                              + len(self.known_users))
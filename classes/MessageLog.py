@@ -0,0 +1,311 @@
+import array
+import bisect
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# crc32 of the rest of the record, sequence number, key length, payload length
+RECORD_HEADER = struct.Struct('!IQHI')
+
+# Size at which the active segment is closed and a new one started
+DEFAULT_SEGMENT_BYTES = 64 << 20
+
+# Bytes of records between two entries of a segment's sparse offset index
+INDEX_INTERVAL = 4096
+
+# Seconds appends are gathered before being written as one batch
+DEFAULT_FLUSH_INTERVAL = 0.005
+
+# Bytes waiting for the writer before appends block
+MAX_PENDING_BYTES = 16 << 20
+
+SEGMENT_SUFFIX = '.log'
+
+
+class Segment:
+    """One append-only file of the log, named after its first sequence number.
+
+    Records are located through a sparse index holding the offset of one
+    record every INDEX_INTERVAL bytes, then by walking forward from there,
+    and read through a memory map of the file.
+    """
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.path = os.path.join(directory, f"{base_seq:020d}{SEGMENT_SUFFIX}")
+        self.file = open(self.path, 'a+b')
+        self.size = 0
+
+        # Sparse index: sequence numbers and offsets of every INDEX_INTERVAL bytes
+        self.index_seqs = array.array('Q')
+        self.index_offsets = array.array('Q')
+
+        self.map = None
+
+    def recover(self):
+        """Scan the file, yielding (seq, key) for every intact record.
+
+        A torn or corrupt tail, left by a crash in the middle of a write, is
+        cut off.
+        """
+        self.file.seek(0)
+        data = self.file.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, seq, key_length, payload_length = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + key_length + payload_length
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+
+            self.add_to_index(seq, offset)
+            key_start = offset + RECORD_HEADER.size
+            yield seq, data[key_start:key_start + key_length].decode('utf-8')
+            offset = end
+
+        if offset < len(data):
+            logging.warning(
+                f"Message log: dropped {len(data) - offset} bytes of torn records from {self.path}")
+            self.file.truncate(offset)
+        self.size = offset
+
+    def add_to_index(self, seq, offset):
+        """Index a record if it starts INDEX_INTERVAL bytes past the last indexed one"""
+        if not self.index_offsets or offset - self.index_offsets[-1] >= INDEX_INTERVAL:
+            self.index_seqs.append(seq)
+            self.index_offsets.append(offset)
+
+    def write(self, records, fsync):
+        """Append encoded (seq, record) pairs with a single write"""
+        offset = self.size
+        for seq, record in records:
+            self.add_to_index(seq, offset)
+            offset += len(record)
+
+        try:
+            self.file.write(b''.join(record for _, record in records))
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+        except OSError:
+            # Leave no partial record behind the last good one
+            self.file.truncate(self.size)
+            raise
+        self.size = offset
+
+    def read(self, seq):
+        """Return the payload of the record with sequence number seq"""
+        if self.map is None or len(self.map) < self.size:
+            # The file grew since it was last mapped
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+
+        position = bisect.bisect_right(self.index_seqs, seq) - 1
+        offset = self.index_offsets[position]
+        while offset < self.size:
+            _, record_seq, key_length, payload_length = RECORD_HEADER.unpack_from(self.map, offset)
+            start = offset + RECORD_HEADER.size + key_length
+            if record_seq == seq:
+                return self.map[start:start + payload_length]
+            offset = start + payload_length
+        raise KeyError(seq)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class MessageLog:
+    """Durable, append-only log of chat messages.
+
+    Every message is stored under a conversation key (the public room, a
+    channel, a pair of users) and gets a sequence number that grows across
+    the whole log. Records go to segment files of about segment_bytes each.
+
+    append() only queues the record: a writer thread gathers everything
+    appended within flush_interval and writes it with one write() and at
+    most one fsync, so logging costs senders next to nothing. Reads see
+    queued records as well as written ones.
+
+    An in-memory index lists the sequence numbers of each conversation,
+    rebuilt by scanning the segments on startup, so a history read only
+    touches the records it returns.
+    """
+
+    def __init__(self, directory, stats=None, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        # Counters, possibly shared with the owner
+        self.stats = stats if stats is not None else collections.Counter()
+
+        self.conversations = {}  # {key: array of sequence numbers}
+        self.segments = []  # oldest first
+        self.segment_bases = []  # first sequence number of each segment
+        self.next_seq = 0
+
+        # Appended records the writer has not written yet
+        self.pending = []  # [(seq, key bytes, payload)]
+        self.pending_bytes = 0
+        self.unwritten = {}  # {seq: payload}
+        self.writing = False  # a batch is being written
+        self.closed = False
+
+        # lock guards the pending records and the indexes, io_lock the segments
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+        self.written = threading.Condition(self.lock)
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+        self.writer = threading.Thread(target=self.write_pending, daemon=True)
+        self.writer.start()
+
+    def recover(self):
+        """Open the existing segments and rebuild the conversation index"""
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        for base in bases:
+            segment = Segment(self.directory, base)
+            for seq, key in segment.recover():
+                self.conversation(key).append(seq)
+                self.next_seq = seq + 1
+            self.segments.append(segment)
+            self.segment_bases.append(base)
+
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+            self.segment_bases.append(0)
+        logging.info(f"Message log opened in {self.directory} at sequence {self.next_seq}")
+
+    def conversation(self, key):
+        """The sequence numbers of a conversation, created empty if needed"""
+        seqs = self.conversations.get(key)
+        if seqs is None:
+            seqs = self.conversations[key] = array.array('Q')
+        return seqs
+
+    def append(self, key, payload):
+        """Queue a message for a conversation, returning its sequence number"""
+        with self.lock:
+            while self.pending_bytes > MAX_PENDING_BYTES and not self.closed:
+                # The disk cannot keep up, wait for the writer
+                self.written.wait()
+
+            seq = self.next_seq
+            self.next_seq += 1
+            self.pending.append((seq, key.encode('utf-8'), payload))
+            self.pending_bytes += len(payload)
+            self.unwritten[seq] = payload
+            self.conversation(key).append(seq)
+            if len(self.pending) == 1:
+                self.appended.notify()
+        return seq
+
+    def write_pending(self):
+        """Write the queued records in batches (writer thread)"""
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.appended.wait()
+                if not self.pending:
+                    return
+
+                # Let the batch grow for one flush interval
+                if not self.closed:
+                    self.appended.wait(self.flush_interval)
+                batch, self.pending = self.pending, []
+                self.pending_bytes = 0
+                self.writing = True
+
+            try:
+                self.write_batch(batch)
+                written = True
+            except OSError as e:
+                # Records that did not make it to disk stay readable from memory
+                logging.error(f"Message log write error: {str(e)}")
+                written = False
+
+            with self.lock:
+                self.writing = False
+                if written:
+                    for seq, _, _ in batch:
+                        del self.unwritten[seq]
+                self.written.notify_all()
+
+    def write_batch(self, batch):
+        """Encode a batch of records and append it to the active segment"""
+        records = []
+        for seq, key, payload in batch:
+            body = RECORD_HEADER.pack(0, seq, len(key), len(payload))[4:] + key + payload
+            records.append((seq, struct.pack('!I', zlib.crc32(body)) + body))
+
+        with self.io_lock:
+            if self.segments[-1].size >= self.segment_bytes:
+                self.segments.append(Segment(self.directory, batch[0][0]))
+                self.segment_bases.append(batch[0][0])
+                self.stats['log_segments'] += 1
+            self.segments[-1].write(records, self.fsync)
+
+        self.stats['log_batches'] += 1
+        self.stats['log_records'] += len(records)
+        self.stats['log_bytes'] += sum(len(record) for _, record in records)
+
+    def read(self, key, limit, after=None):
+        """Return up to limit (seq, payload) pairs of a conversation, oldest first.
+
+        These are the last messages, or the first ones after sequence number
+        after.
+        """
+        with self.lock:
+            seqs = self.conversations.get(key, ())
+            if after is None:
+                selected = seqs[-limit:] if limit else seqs[:0]
+            else:
+                start = bisect.bisect_right(seqs, after)
+                selected = seqs[start:start + limit]
+            queued = {seq: self.unwritten[seq] for seq in selected if seq in self.unwritten}
+
+        messages = []
+        with self.io_lock:
+            for seq in selected:
+                payload = queued.get(seq)
+                if payload is None:
+                    payload = self.segment_of(seq).read(seq)
+                messages.append((seq, payload))
+
+        self.stats['log_reads'] += 1
+        return messages
+
+    def segment_of(self, seq):
+        """The segment holding sequence number seq"""
+        return self.segments[bisect.bisect_right(self.segment_bases, seq) - 1]
+
+    def flush(self):
+        """Wait until everything appended so far is written"""
+        with self.lock:
+            while self.pending or self.writing:
+                self.appended.notify()
+                self.written.wait()
+
+    def close(self):
+        """Write what is queued and close the segment files"""
+        with self.lock:
+            self.closed = True
+            self.appended.notify()
+            self.written.notify_all()
+        self.writer.join()
+
+        with self.io_lock:
+            for segment in self.segments:
+                segment.close()
@@ -0,0 +1,216 @@
+import collections
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import time
+
+from classes.Histogram import Histogram
+
+# Message types counted on their own, anything else a client sends is 'other'
+INPUT_TYPES = {'message', 'private', 'join', 'leave', 'list', 'history',
+               'presence_sync', 'register', 'heartbeat'}
+
+# Kinds of delivered message whose latency is tracked
+LATENCY_KINDS = ('public', 'channel', 'private')
+
+# Default seconds between two summary lines in the log (0 disables them)
+DEFAULT_SUMMARY_INTERVAL = 60
+
+
+def message_kind(payload):
+    """The type of an encoded server message, sniffed without parsing it.
+
+    Every JSON message the server builds starts with its type; bare text
+    messages are notices.
+    """
+    if payload.startswith(b'{"type": "'):
+        end = payload.find(b'"', 10)
+        if end != -1:
+            return payload[10:end].decode('utf-8', 'replace')
+    return 'notice'
+
+
+class Delivery:
+    """One received message followed until its last recipient write.
+
+    Every queue the message is put on adds a pending write, and calls
+    done() once the write left (or the buffer was dropped). The publisher
+    seals the delivery after the fan-out; whichever of the two comes last
+    records the latency and the fan-out.
+    """
+
+    __slots__ = ('latency', 'recent', 'fanout', 'received', 'queued',
+                 'completed', 'sealed', 'lock')
+
+    def __init__(self, latency, recent, fanout, received):
+        self.latency = latency
+        self.recent = recent
+        self.fanout = fanout
+        self.received = received
+        self.queued = 0
+        self.completed = 0
+        self.sealed = False
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            self.queued += 1
+
+    def done(self):
+        with self.lock:
+            self.completed += 1
+            finished = self.sealed and self.completed == self.queued
+        if finished:
+            self.finish()
+
+    def seal(self):
+        """The publisher queued the message for every recipient"""
+        with self.lock:
+            self.sealed = True
+            finished = self.completed == self.queued
+        self.fanout.record(self.queued)
+        if finished and self.queued:
+            self.finish()
+
+    def finish(self):
+        # Microseconds
+        latency = (time.monotonic() - self.received) * 1e6
+        self.latency.record(latency)
+        self.recent.record(latency)
+
+
+class Metrics:
+    """Throughput counters and latency histograms of a server.
+
+    Messages and bytes are counted per protocol, direction and message
+    type; the event counters of the server and its components are kept in
+    the shared stats Counter. Histograms record the number of recipients
+    of each delivered message and its latency from receipt to the write
+    to its last recipient, per kind of message. gauges() returns the
+    current queue depths when a snapshot is taken.
+    """
+
+    def __init__(self, stats, gauges=None):
+        self.stats = stats
+        self.gauges = gauges
+        self.started = time.monotonic()
+
+        self.traffic = collections.Counter()  # {(protocol, direction, type, 'messages' or 'bytes'): count}
+        self.fanout = Histogram()
+        self.latency = {kind: Histogram() for kind in LATENCY_KINDS}
+
+        # Latencies since the previous summary line, and the totals at that
+        # line, for its percentiles and rates
+        self.recent_latency = Histogram()
+        self.last_summary = (self.started, 0, 0, 0)
+
+        self.http_server = None
+
+    def received(self, protocol, message_type, size):
+        """Count a message read from a client"""
+        if message_type not in INPUT_TYPES:
+            message_type = 'other'
+        self.traffic[(protocol, 'in', message_type, 'messages')] += 1
+        self.traffic[(protocol, 'in', message_type, 'bytes')] += size
+
+    def sent(self, protocol, kind, size):
+        """Count a message queued for a client"""
+        self.traffic[(protocol, 'out', kind, 'messages')] += 1
+        self.traffic[(protocol, 'out', kind, 'bytes')] += size
+
+    def track(self, kind, received):
+        """Start following a message of a latency kind received at received"""
+        if received is None:
+            return None
+        return Delivery(self.latency[kind], self.recent_latency, self.fanout, received)
+
+    def totals(self, direction):
+        """Messages and bytes over every protocol and type in one direction"""
+        messages = size = 0
+        for (protocol, way, kind, unit), count in list(self.traffic.items()):
+            if way != direction:
+                continue
+            if unit == 'messages':
+                messages += count
+            else:
+                size += count
+        return messages, size
+
+    def snapshot(self):
+        """Everything measured so far, as JSON-serializable data"""
+        traffic = {}
+        for (protocol, direction, kind, unit), count in sorted(list(self.traffic.items())):
+            entry = traffic.setdefault(protocol.lower(), {}).setdefault(
+                direction, {}).setdefault(kind, {"messages": 0, "bytes": 0})
+            entry[unit] = count
+
+        return {
+            "uptime": round(time.monotonic() - self.started, 3),
+            "traffic": traffic,
+            "fanout": self.fanout.summary(),
+            "latency_ms": {kind: histogram.summary(1000)
+                           for kind, histogram in self.latency.items()},
+            "queues": self.gauges() if self.gauges else {},
+            "compression": self.compression(),
+            "counters": dict(self.stats),
+        }
+
+    def compression(self):
+        """Compressed size over original size, and milliseconds spent compressing"""
+        bytes_in = self.stats.get('compression_bytes_in', 0)
+        bytes_out = self.stats.get('compression_bytes_out', 0)
+        return {
+            "messages": self.stats.get('compressed_messages', 0),
+            "ratio": round(bytes_out / bytes_in, 3) if bytes_in else None,
+            "compress_ms": self.stats.get('compression_us', 0) / 1000,
+            "decompress_ms": self.stats.get('decompression_us', 0) / 1000,
+        }
+
+    def summary_line(self):
+        """One log line with the rates and latencies since the previous one"""
+        now = time.monotonic()
+        messages_in, _ = self.totals('in')
+        messages_out, bytes_out = self.totals('out')
+        then, last_in, last_out, last_bytes = self.last_summary
+        self.last_summary = (now, messages_in, messages_out, bytes_out)
+        elapsed = max(now - then, 1e-9)
+
+        latency, self.recent_latency = self.recent_latency, Histogram()
+        queues = self.gauges() if self.gauges else {}
+
+        return (f"Stats: {(messages_in - last_in) / elapsed:.1f} msg/s in, "
+                f"{(messages_out - last_out) / elapsed:.1f} msg/s out "
+                f"({(bytes_out - last_bytes) / elapsed / 1e3:.1f} kB/s), "
+                f"fan-out p50 {self.fanout.percentile(50)} max {self.fanout.max}, "
+                f"latency p50 {latency.percentile(50) / 1000:.2f} ms "
+                f"p99 {latency.percentile(99) / 1000:.2f} ms "
+                f"p99.9 {latency.percentile(99.9) / 1000:.2f} ms, "
+                + ', '.join(f"{name} {value}" for name, value in queues.items()))
+
+    def serve(self, host, port):
+        """Answer GET /stats with the snapshot as JSON on host:port"""
+        metrics = self
+
+        class StatsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/stats'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(metrics.snapshot(), indent=1).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class StatsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.http_server = StatsHTTPServer((host, port), StatsHandler)
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        logging.info(f"Stats available at http://{host}:{self.http_server.server_address[1]}/stats")
@@ -0,0 +1,241 @@
+import collections
+import itertools
+import socket
+import threading
+import time
+
+# Default hard bound on bytes waiting for one TCP connection
+DEFAULT_MAX_BYTES = 1 << 20
+
+# Default backpressure thresholds on bytes waiting for one TCP connection
+DEFAULT_HIGH_WATERMARK = 256 * 1024
+DEFAULT_LOW_WATERMARK = 64 * 1024
+
+# Default bound on datagrams waiting for the UDP socket
+DEFAULT_MAX_DATAGRAMS = 4096
+
+# Most buffers handed to one sendmsg() call (Linux IOV_MAX is 1024)
+MAX_IOVECS = 1024
+
+# Whether the platform has scatter-gather sends (Windows does not)
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+def send_buffers(client_socket, buffers):
+    """Write buffers with a single system call, returning the bytes sent"""
+    if HAVE_SENDMSG:
+        return client_socket.sendmsg(buffers)
+    return client_socket.send(b''.join(buffers))
+
+
+def send_front(client_socket, outbound, coalesce=True):
+    """Write the front of a queue with one system call, returning the buffers it covered.
+
+    Legacy clients read one JSON message per recv(), so unless coalesce is
+    set only the first buffer goes out, never several messages in one segment.
+    """
+    if coalesce:
+        buffers = outbound.front_buffers()
+    else:
+        buffer = outbound.front()
+        buffers = [buffer] if buffer is not None else []
+    if buffers:
+        outbound.consume(send_buffers(client_socket, buffers))
+    return len(buffers)
+
+
+class OutboundQueue:
+    """Bounded queue of encoded buffers waiting to be written to one TCP peer.
+
+    Buffers are shared between every recipient of a broadcast and never
+    copied; producers only append references, the single writer of the
+    connection sends them and consumes what the socket accepted. A buffer
+    may carry a Delivery, told when the buffer was written or discarded.
+
+    The queue is congested once it holds more than high_watermark bytes
+    and stays so until the writer drains it below low_watermark.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES,
+                 high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK):
+        self.max_bytes = max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+
+        self.buffers = collections.deque()  # (data, droppable, delivery or None)
+        self.offset = 0  # bytes of the first buffer already sent
+        self.pending_bytes = 0
+        self.congested = False
+        self.closed = False
+
+        # When the oldest unsent buffer was queued (time.monotonic())
+        self.queued_at = 0
+
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+        # Called when the queue goes from empty to non-empty
+        self.on_ready = None
+
+        # Called when a congested queue drains below the low watermark
+        self.on_drained = None
+
+    def put(self, data, droppable=False, delivery=None):
+        """Queue a buffer, returning False if the queue is full or closed.
+
+        Droppable buffers may later be discarded by drop_oldest().
+        """
+        with self.lock:
+            if self.closed or self.pending_bytes + len(data) > self.max_bytes:
+                return False
+
+            was_empty = not self.buffers
+            if was_empty:
+                self.queued_at = time.monotonic()
+            if delivery is not None:
+                delivery.add()
+            self.buffers.append((data, droppable, delivery))
+            self.pending_bytes += len(data)
+            if self.pending_bytes > self.high_watermark:
+                self.congested = True
+            self.ready.notify()
+
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def front(self):
+        """Return the unsent part of the first buffer, or None if empty"""
+        with self.lock:
+            if not self.buffers:
+                return None
+            return memoryview(self.buffers[0][0])[self.offset:]
+
+    def front_buffers(self, max_buffers=MAX_IOVECS):
+        """Return the unsent parts of up to max_buffers buffers, for one scatter-gather write"""
+        with self.lock:
+            if not self.buffers:
+                return []
+            buffers = [memoryview(self.buffers[0][0])[self.offset:]]
+            buffers.extend(data for data, droppable, delivery
+                           in itertools.islice(self.buffers, 1, max_buffers))
+            return buffers
+
+    def consume(self, sent):
+        """Drop bytes the socket accepted from the front of the queue"""
+        with self.lock:
+            self.pending_bytes -= sent
+            sent += self.offset
+            while self.buffers and sent >= len(self.buffers[0][0]):
+                data, droppable, delivery = self.buffers.popleft()
+                sent -= len(data)
+                if delivery is not None:
+                    delivery.done()
+            self.offset = sent
+
+            drained = self.congested and self.pending_bytes <= self.low_watermark
+            if drained:
+                self.congested = False
+
+        if drained and self.on_drained:
+            self.on_drained()
+
+    def drop_oldest(self):
+        """Discard the oldest droppable buffers until below the low watermark.
+
+        Returns the number of buffers dropped.
+        """
+        with self.lock:
+            kept = collections.deque()
+            dropped = 0
+
+            # The writer may be sending the first buffer right now
+            if self.buffers:
+                kept.append(self.buffers.popleft())
+
+            while self.buffers:
+                data, droppable, delivery = self.buffers.popleft()
+                if droppable and self.pending_bytes > self.low_watermark:
+                    self.pending_bytes -= len(data)
+                    dropped += 1
+                    if delivery is not None:
+                        delivery.done()
+                else:
+                    kept.append((data, droppable, delivery))
+            self.buffers = kept
+
+            drained = self.congested and self.pending_bytes <= self.low_watermark
+            if drained:
+                self.congested = False
+
+        if drained and self.on_drained:
+            self.on_drained()
+        return dropped
+
+    def wait(self):
+        """Block until there is data to write; False once the queue is closed"""
+        with self.lock:
+            while not self.buffers and not self.closed:
+                self.ready.wait()
+            return not self.closed
+
+    def close(self):
+        """Discard queued data and wake up the writer"""
+        with self.lock:
+            self.closed = True
+            for data, droppable, delivery in self.buffers:
+                if delivery is not None:
+                    delivery.done()
+            self.buffers.clear()
+            self.pending_bytes = 0
+            self.congested = False
+            self.ready.notify_all()
+
+
+class DatagramQueue:
+    """Bounded queue of (datagram, address) pairs waiting for the UDP socket"""
+
+    def __init__(self, max_datagrams=DEFAULT_MAX_DATAGRAMS):
+        self.max_datagrams = max_datagrams
+        self.datagrams = collections.deque()  # (data, address, delivery or None)
+
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+        # Called when the queue goes from empty to non-empty
+        self.on_ready = None
+
+    def put(self, data, address, delivery=None):
+        """Queue a datagram, returning False if the queue is full"""
+        with self.lock:
+            if len(self.datagrams) >= self.max_datagrams:
+                return False
+
+            was_empty = not self.datagrams
+            if delivery is not None:
+                delivery.add()
+            self.datagrams.append((data, address, delivery))
+            self.ready.notify()
+
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def front(self):
+        """Return the next (datagram, address) pair, or None if empty"""
+        with self.lock:
+            return self.datagrams[0][:2] if self.datagrams else None
+
+    def pop(self):
+        """Drop the datagram returned by front() once it was sent"""
+        with self.lock:
+            delivery = self.datagrams.popleft()[2]
+        if delivery is not None:
+            delivery.done()
+
+    def wait(self):
+        """Block until there is a datagram to send"""
+        with self.lock:
+            while not self.datagrams:
+                self.ready.wait()
@@ -0,0 +1,121 @@
+import threading
+import time
+
+# Kinds of client messages with their own budget
+TRAFFIC_CLASSES = ('public', 'private', 'control')
+
+# Default messages per second per user for each class (0 is unlimited)
+DEFAULT_RATES = {'public': 20, 'private': 20, 'control': 50}
+
+# Default seconds of traffic a client may send at once after being idle
+DEFAULT_BURST_SECONDS = 2
+
+# Default budget of an IP address, as a multiple of a user's (0 disables IP limits)
+DEFAULT_IP_FACTOR = 10
+
+# Seconds between two throttled replies to the same client
+NOTICE_INTERVAL = 1
+
+# Seconds between two sweeps of idle buckets
+SWEEP_INTERVAL = 10
+
+
+class TokenBuckets:
+    """One token bucket per key, all with the same rate and burst.
+
+    Buckets are refilled lazily when a key takes a token; a bucket that
+    would be full again is forgotten by sweep(), so idle users cost nothing.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.buckets = {}  # {key: [tokens, updated]}
+        self.lock = threading.Lock()
+
+    def take(self, key, now):
+        """Take a token for key, returning False if its bucket is empty"""
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = [self.burst - 1, now]
+                return True
+
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+    def sweep(self, now):
+        """Forget the buckets that refilled completely"""
+        with self.lock:
+            for key, (tokens, updated) in list(self.buckets.items()):
+                if tokens + (now - updated) * self.rate >= self.burst:
+                    del self.buckets[key]
+
+
+class RateLimiter:
+    """Per-user and per-IP budgets for public, private and control messages.
+
+    A message is let through only if both its sender's bucket and its
+    source address's bucket for its class have a token. Addresses get
+    ip_factor times a user's budget, since several users may share one.
+    Throttled messages are counted in stats as throttled_<class>.
+    """
+
+    def __init__(self, rates=None, burst_seconds=DEFAULT_BURST_SECONDS,
+                 ip_factor=DEFAULT_IP_FACTOR, stats=None):
+        rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.stats = stats if stats is not None else {}
+
+        self.users = {}  # {class: TokenBuckets}
+        self.addresses = {}  # {class: TokenBuckets}
+        for traffic_class in TRAFFIC_CLASSES:
+            rate = rates[traffic_class]
+            if not rate:
+                continue
+            self.users[traffic_class] = TokenBuckets(rate, rate * burst_seconds)
+            if ip_factor:
+                self.addresses[traffic_class] = TokenBuckets(
+                    rate * ip_factor, rate * ip_factor * burst_seconds)
+
+        self.notified = {}  # {client: time of the last throttled reply}
+        self.swept = time.monotonic()
+
+    def allow(self, traffic_class, username, ip):
+        """Take a token for a message of username (None if unknown) from ip"""
+        now = time.monotonic()
+        users = self.users.get(traffic_class)
+        if users is not None and username is not None and not users.take(username, now):
+            self.stats[f"throttled_{traffic_class}"] += 1
+            return False
+
+        addresses = self.addresses.get(traffic_class)
+        if addresses is not None and not addresses.take(ip, now):
+            self.stats[f"throttled_{traffic_class}"] += 1
+            self.stats['throttled_by_ip'] += 1
+            return False
+        return True
+
+    def should_notify(self, client):
+        """Whether a throttled client is due a reply, at most one per NOTICE_INTERVAL"""
+        now = time.monotonic()
+        if now - self.notified.get(client, 0) < NOTICE_INTERVAL:
+            return False
+        self.notified[client] = now
+        return True
+
+    def sweep(self):
+        """Forget idle buckets and old notices every SWEEP_INTERVAL"""
+        now = time.monotonic()
+        if now - self.swept < SWEEP_INTERVAL:
+            return
+        self.swept = now
+        for buckets in list(self.users.values()) + list(self.addresses.values()):
+            buckets.sweep(now)
+        for client, notified in list(self.notified.items()):
+            if now - notified >= NOTICE_INTERVAL:
+                del self.notified[client]
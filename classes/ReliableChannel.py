@@ -0,0 +1,276 @@
+import collections
+import os
+import struct
+import threading
+import time
+
+# Datagram kinds of the reliable mode; plain datagrams are JSON or text and
+# never start with these bytes
+DATA = 1
+ACK = 2
+
+# kind, sender's connection id, sequence number, oldest sequence number not
+# acknowledged yet, fragment index, fragment count
+DATA_HEADER = struct.Struct('!BIIIHH')
+
+# kind, connection id acknowledged, next expected sequence number, bitmap of
+# the SACK_BITS sequence numbers after it that were received out of order
+ACK_HEADER = struct.Struct('!BIII')
+SACK_BITS = 32
+
+# Payload bytes per datagram, small enough to avoid IP fragmentation
+DEFAULT_FRAGMENT_SIZE = 1200
+
+# Largest message accepted for fragmentation
+MAX_MESSAGE_SIZE = 1 << 20
+
+# Datagrams sent but not acknowledged yet
+DEFAULT_WINDOW = 128
+
+# Datagrams waiting for room in the window before new messages are refused
+DEFAULT_MAX_BACKLOG = 4096
+
+# Retransmission timeout bounds, in seconds
+INITIAL_RTO = 0.3
+MIN_RTO = 0.05
+MAX_RTO = 5.0
+
+# Retransmissions of one datagram before the peer is considered gone
+MAX_RETRANSMITS = 10
+
+# Duplicate acknowledgements that trigger a retransmission without waiting
+FAST_RETRANSMIT_ACKS = 3
+
+
+def is_reliable(datagram):
+    """Whether a datagram belongs to the reliable mode"""
+    return datagram[:1] in (b'\x01', b'\x02')
+
+
+class ReliableChannel:
+    """Reliable, ordered message stream with one UDP peer.
+
+    The channel never touches a socket: send(), receive() and poll() return
+    the datagrams to transmit, so the same code serves the server (one
+    channel per client address) and ChatClient.
+
+    Messages are split into fragments of at most fragment_size bytes, each
+    carrying its own sequence number. The receiver delivers fragments in
+    sequence order, drops duplicates, reassembles messages and acknowledges
+    every datagram with the next sequence number it expects plus a bitmap of
+    what it already holds beyond it. The sender keeps up to window datagrams
+    in flight and retransmits them after an RTT-based timeout (RFC 6298, with
+    exponential backoff), or right away after repeated selective ACKs.
+
+    Each side picks a random connection id. A receiver seeing a new id (the
+    peer restarted, or this end did) starts over from the oldest sequence
+    number the sender still holds, which every data datagram carries.
+    """
+
+    def __init__(self, stats=None, fragment_size=DEFAULT_FRAGMENT_SIZE,
+                 window=DEFAULT_WINDOW, max_backlog=DEFAULT_MAX_BACKLOG):
+        self.fragment_size = fragment_size
+        self.window = window
+        self.max_backlog = max_backlog
+
+        # Counters, possibly shared with the owner
+        self.stats = stats if stats is not None else collections.Counter()
+
+        self.lock = threading.Lock()
+        self.failed = False
+
+        # Sending side
+        self.connection_id = struct.unpack('!I', os.urandom(4))[0]
+        self.next_seq = 0
+        self.in_flight = collections.OrderedDict()  # {seq: [index, count, payload, sent_at, retransmits]}
+        self.backlog = collections.deque()  # (seq, index, count, payload) waiting for the window
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.last_cumulative = 0
+        self.duplicate_acks = 0
+
+        # Receiving side
+        self.peer_id = None
+        self.expected = 0  # next sequence number to deliver
+        self.out_of_order = {}  # {seq: (index, count, payload)}
+        self.fragments = None  # parts of the message being reassembled
+
+    def send(self, payload, now=None):
+        """Queue a message; returns the datagrams to transmit now, or None if refused"""
+        if len(payload) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Message of {len(payload)} bytes exceeds {MAX_MESSAGE_SIZE}")
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            count = max(1, -(-len(payload) // self.fragment_size))
+            if self.failed or len(self.backlog) + count > self.max_backlog:
+                self.stats['reliable_refused'] += 1
+                return None
+
+            for index in range(count):
+                part = payload[index * self.fragment_size:(index + 1) * self.fragment_size]
+                self.backlog.append((self.next_seq, index, count, part))
+                self.next_seq += 1
+
+            return self.fill_window(now)
+
+    def fill_window(self, now):
+        """Move backlog datagrams into the window, returning them"""
+        datagrams = []
+        while self.backlog and len(self.in_flight) < self.window:
+            seq, index, count, part = self.backlog.popleft()
+            self.in_flight[seq] = [index, count, part, now, 0]
+            datagrams.append(self.datagram(seq))
+        return datagrams
+
+    def datagram(self, seq):
+        """Encode an in-flight fragment with the current oldest unacknowledged seq"""
+        index, count, part = self.in_flight[seq][:3]
+        base = next(iter(self.in_flight))
+        return DATA_HEADER.pack(DATA, self.connection_id, seq, base, index, count) + part
+
+    def receive(self, datagram, now=None):
+        """Handle a reliable datagram.
+
+        Returns (messages, datagrams): the complete messages now deliverable
+        in order, and the acknowledgements or data to transmit in response.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            if datagram[0] == ACK:
+                if len(datagram) < ACK_HEADER.size:
+                    return [], []
+                _, connection_id, cumulative, bitmap = ACK_HEADER.unpack_from(datagram)
+                if connection_id != self.connection_id:
+                    # Acknowledges an earlier incarnation of our stream
+                    return [], []
+                return [], self.acknowledge(cumulative, bitmap, now)
+
+            if len(datagram) < DATA_HEADER.size:
+                return [], []
+            _, connection_id, seq, base, index, count = DATA_HEADER.unpack_from(datagram)
+            payload = datagram[DATA_HEADER.size:]
+
+            if connection_id != self.peer_id:
+                # New stream: everything before base was acknowledged already
+                self.peer_id = connection_id
+                self.expected = base
+                self.out_of_order.clear()
+                self.fragments = None
+
+            messages = []
+            if seq < self.expected or seq in self.out_of_order:
+                self.stats['reliable_duplicates'] += 1
+            elif seq == self.expected:
+                self.deliver(index, count, payload, messages)
+                while self.expected in self.out_of_order:
+                    self.deliver(*self.out_of_order.pop(self.expected), messages)
+            elif seq - self.expected < self.max_backlog:
+                self.out_of_order[seq] = (index, count, payload)
+                self.stats['reliable_out_of_order'] += 1
+
+            return messages, [self.ack()]
+
+    def deliver(self, index, count, payload, messages):
+        """Take the next in-order fragment, completing a message with the last one"""
+        self.expected += 1
+        if index == 0:
+            self.fragments = []
+        elif self.fragments is None:
+            # Tail of a message whose start predates this stream
+            return
+
+        self.fragments.append(payload)
+        if index == count - 1:
+            messages.append(b''.join(self.fragments))
+            self.fragments = None
+
+    def ack(self):
+        """Build the acknowledgement of everything received so far"""
+        bitmap = 0
+        for bit in range(SACK_BITS):
+            if self.expected + 1 + bit in self.out_of_order:
+                bitmap |= 1 << bit
+        return ACK_HEADER.pack(ACK, self.peer_id, self.expected, bitmap)
+
+    def acknowledge(self, cumulative, bitmap, now):
+        """Forget acknowledged datagrams and return what to transmit next"""
+        acked = []
+        for seq in self.in_flight:
+            if seq >= cumulative:
+                break
+            acked.append(seq)
+        for bit in range(SACK_BITS):
+            if bitmap >> bit & 1 and cumulative + 1 + bit in self.in_flight:
+                acked.append(cumulative + 1 + bit)
+
+        # Karn's algorithm: only time datagrams that were sent once
+        sample = None
+        for seq in acked:
+            sent_at, retransmits = self.in_flight.pop(seq)[3:]
+            if not retransmits:
+                sample = now - sent_at
+        if sample is not None:
+            self.update_rto(sample)
+
+        datagrams = []
+        if cumulative == self.last_cumulative and bitmap and cumulative in self.in_flight:
+            # The receiver holds later datagrams but still misses this one
+            self.duplicate_acks += 1
+            if self.duplicate_acks == FAST_RETRANSMIT_ACKS:
+                entry = self.in_flight[cumulative]
+                entry[3] = now
+                entry[4] += 1
+                datagrams.append(self.datagram(cumulative))
+                self.stats['reliable_fast_retransmits'] += 1
+        else:
+            self.last_cumulative = cumulative
+            self.duplicate_acks = 0
+
+        datagrams.extend(self.fill_window(now))
+        return datagrams
+
+    def update_rto(self, sample):
+        """Fold an RTT sample into the retransmission timeout"""
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def poll(self, now=None):
+        """Return the datagrams whose retransmission timeout expired.
+
+        Marks the channel failed once a datagram was retransmitted
+        MAX_RETRANSMITS times without being acknowledged.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        datagrams = []
+        with self.lock:
+            if self.failed:
+                return datagrams
+
+            for seq, entry in self.in_flight.items():
+                sent_at, retransmits = entry[3:]
+                if now - sent_at < min(MAX_RTO, self.rto * 2 ** retransmits):
+                    continue
+
+                if retransmits >= MAX_RETRANSMITS:
+                    self.failed = True
+                    self.stats['reliable_failures'] += 1
+                    return []
+
+                entry[3] = now
+                entry[4] += 1
+                datagrams.append(self.datagram(seq))
+
+            self.stats['reliable_retransmits'] += len(datagrams)
+        return datagrams
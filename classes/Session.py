@@ -0,0 +1,93 @@
+TCP = 'TCP'
+UDP = 'UDP'
+
+# Bytes read per recv() on TCP connections, by every engine
+TCP_RECV_SIZE = 65536
+
+# Largest datagram read from the UDP socket, by every engine
+UDP_RECV_SIZE = 65535
+
+
+class Session:
+    """One client connection, over TCP (TcpSession) or UDP (UdpSession).
+
+    Slots keep a session to a fixed handful of fields instead of a
+    per-connection dict, which matters with tens of thousands of clients;
+    each protocol only carries the fields it uses.
+    """
+
+    __slots__ = ('endpoint', 'username', 'user_id', 'presence_deltas', 'binary',
+                 'compressed', 'messages_in', 'messages_out', 'bytes_out')
+
+    protocol = None
+
+    def __init__(self, endpoint, username, user_id, presence_deltas=False,
+                 binary=False, compressed=False):
+        self.endpoint = endpoint
+        self.username = username
+        self.user_id = user_id
+
+        # Whether the client understands user_joined/user_left deltas
+        self.presence_deltas = presence_deltas
+
+        # Whether the client asked for the binary codec and for compression
+        # (see WireCodec)
+        self.binary = binary
+        self.compressed = compressed
+
+        # Counters
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.username} {self.address}>"
+
+
+class TcpSession(Session):
+    """A TCP client, whose endpoint is its socket"""
+
+    __slots__ = ('address', 'decoder', 'outbound', 'paused_publishers', 'pauses',
+                 'readable', 'fallback')
+
+    protocol = TCP
+
+    def __init__(self, client_socket, username, user_id, address, decoder=None,
+                 outbound=None, readable=None, **options):
+        super().__init__(client_socket, username, user_id, **options)
+
+        # Peer address of the client
+        self.address = address
+
+        # FrameDecoder or None for unframed clients, the OutboundQueue and
+        # the event cleared while reading is paused
+        self.decoder = decoder
+        self.outbound = outbound
+        self.readable = readable
+
+        # TCP publishers paused until this client drains, and how many
+        # clients paused this one
+        self.paused_publishers = None
+        self.pauses = 0
+
+        # The user's UDP session, routed to once this one ends (see ClientRegistry)
+        self.fallback = None
+
+
+class UdpSession(Session):
+    """A UDP client, whose endpoint is its (host, port) address or socket path"""
+
+    __slots__ = ('multicast',)
+
+    protocol = UDP
+
+    def __init__(self, address, username, user_id, multicast=False, **options):
+        super().__init__(address, username, user_id, **options)
+
+        # Whether public messages and presence reach the client through the
+        # server's multicast group instead of its own address
+        self.multicast = multicast
+
+    @property
+    def address(self):
+        return self.endpoint
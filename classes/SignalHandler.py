@@ -6,3 +6,5 @@ class SignalHandler(QObject):
     message_received = pyqtSignal(dict)
     connection_error = pyqtSignal(str)
     user_list_updated = pyqtSignal(list)
+    user_joined = pyqtSignal(str)
+    user_left = pyqtSignal(str)
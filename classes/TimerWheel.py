@@ -0,0 +1,77 @@
+import threading
+import time
+
+# Default number of slots; deadlines further away wrap around the wheel
+DEFAULT_SLOTS = 64
+
+
+class TimerWheel:
+    """Hashed timer wheel keeping one deadline per key.
+
+    Scheduling and cancelling are O(1) dict operations. Keys are hashed into
+    the slot their deadline falls in, and advancing the wheel only visits the
+    slots that ended since the last call, so keys expire up to one
+    slot_duration late and tracking many of them costs nothing in between.
+    """
+
+    def __init__(self, slot_duration, slots=DEFAULT_SLOTS):
+        self.slot_duration = slot_duration
+        self.slots = [{} for _ in range(slots)]  # [{key: deadline}]
+        self.slot_of = {}  # {key: slot index}
+
+        # Index and start time of the slot covering the current time
+        self.current = 0
+        self.current_start = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def schedule(self, key, deadline):
+        """Expire key at the given time.monotonic() deadline, replacing any earlier one"""
+        with self.lock:
+            self._discard(key)
+            ahead = int((deadline - self.current_start) // self.slot_duration)
+            index = (self.current + max(0, ahead)) % len(self.slots)
+            self.slots[index][key] = deadline
+            self.slot_of[key] = index
+
+    def cancel(self, key):
+        """Forget key if it is scheduled"""
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now=None):
+        """Move the wheel to now and return the keys whose deadline passed"""
+        if now is None:
+            now = time.monotonic()
+
+        expired = []
+        with self.lock:
+            # Expire the slots that ended, each at most once per call
+            for _ in range(len(self.slots)):
+                if self.current_start + self.slot_duration > now:
+                    break
+
+                slot = self.slots[self.current]
+                for key, deadline in list(slot.items()):
+                    # Keys a full turn or more away stay for a later round
+                    if deadline <= now:
+                        del slot[key]
+                        del self.slot_of[key]
+                        expired.append(key)
+
+                self.current = (self.current + 1) % len(self.slots)
+                self.current_start += self.slot_duration
+
+            # After a long pause, restart the wheel at the present time
+            if self.current_start + self.slot_duration <= now:
+                self.current_start = now
+
+        return expired
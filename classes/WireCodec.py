@@ -0,0 +1,237 @@
+import collections
+import json
+import struct
+import time
+import zlib
+
+# Codecs a client may ask for in its handshake ("codec": ...)
+JSON_CODEC = 'json'
+BINARY_CODEC = 'binary'
+
+# First byte of every binary message: never valid in UTF-8, so it cannot
+# start a JSON or text message and both kinds can share a connection
+MAGIC = 0xC1
+
+# Compression a client may ask for in its handshake ("compression": ...)
+ZLIB_COMPRESSION = 'zlib'
+
+# First byte of a compressed message, followed by the raw deflate stream of
+# the message in its codec; like MAGIC it never starts UTF-8
+COMPRESSED = 0xC0
+
+# Default size from which messages are compressed (smaller ones rarely shrink)
+DEFAULT_COMPRESSION_THRESHOLD = 512
+
+# zlib level: 6 is zlib's default, lower trades ratio for CPU
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Raw deflate (negative) with a 4 KiB window and small internal state: a
+# compressor is set up for every message, and zlib's default 32 KiB window
+# costs more to set up than compressing a chat line does
+WINDOW_BITS = -12
+MEMORY_LEVEL = 4
+
+# Largest message a compressed one may inflate to (the frame size cap)
+MAX_DECOMPRESSED_SIZE = 0xFFFFFF
+
+# Preset dictionary shared by both ends: the envelopes and phrases that
+# recur in chat traffic, most frequent last as zlib finds them cheapest
+# there. Changing it breaks compatibility with existing clients.
+COMPRESSION_DICTIONARY = (
+    b' the and you for that this with have not are was but what just like '
+    b'know think will can about there would your they get all one out '
+    b'{"type": "error", "message": "User  is not online."}'
+    b'{"type": "channel_list", "channels": ['
+    b'{"type": "history", "with": "", "truncated": true, "messages": [{"seq": '
+    b'{"type": "private_sent", "to": "", "stored": false}'
+    b'"sent_at": 17'
+    b'{"type": "presence", "joined": [], "left": [], "version": '
+    b'{"type": "user_joined", "user": "", "version": '
+    b'{"type": "user_left", "user": "", "version": '
+    b' joined via TCP! joined via UDP! left the chat!SERVER: '
+    b'{"type": "user_list", "users": ["", "'
+    b'{"type": "private", "from": "", "message": "'
+    b'{"type": "public", "from": "", "channel": "", "message": "'
+)
+
+# Magic byte, type code, user id of the sender (0 when unknown). Senders
+# whose id the recipient was told in a presence message may have their name
+# left out (an empty 'from').
+HEADER = struct.Struct('!BBI')
+
+# Length of a name or channel (at most 255 bytes), and of the message body
+SHORT_LENGTH = struct.Struct('!B')
+BODY_LENGTH = struct.Struct('!I')
+
+# Bare text notices from the server ("SERVER: ..."), body only
+NOTICE = 7
+
+# Binary type codes: (JSON type, string fields in wire order); every one
+# carries its text as the body. Messages of any other shape are sent as JSON.
+MESSAGE_CODES = {
+    1: ('public', ('from',)),              # public chat line
+    2: ('public', ('channel', 'from')),    # channel chat line
+    3: ('private', ('from',)),             # private message received
+    4: ('message', ()),                    # client: public chat line
+    5: ('message', ('channel',)),          # client: channel chat line
+    6: ('private', ('to',)),               # client: private message
+}
+
+# {(type, frozenset of string fields): code}
+CODES_BY_SHAPE = {(message_type, frozenset(fields)): code
+                  for code, (message_type, fields) in MESSAGE_CODES.items()}
+
+# Message kinds (see Metrics.message_kind) that may have a binary form
+COMPACT_KINDS = {'public', 'private', 'message', 'notice'}
+
+
+class Compressor:
+    """Compresses messages of at least threshold bytes with the shared dictionary.
+
+    Each message is compressed on its own, so any message can be inflated
+    alone and a broadcast is compressed once for all its recipients.
+    Counts the bytes before and after and the time spent in the shared stats.
+    """
+
+    def __init__(self, threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 level=DEFAULT_COMPRESSION_LEVEL, stats=None):
+        self.threshold = threshold
+        self.level = level
+        self.stats = stats if stats is not None else collections.Counter()
+
+    def compress(self, payload):
+        """The compressed message, or the payload itself if small or incompressible"""
+        if len(payload) < self.threshold:
+            return payload
+
+        began = time.perf_counter()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WINDOW_BITS, MEMORY_LEVEL,
+                                      zdict=COMPRESSION_DICTIONARY)
+        compressed = bytes((COMPRESSED,)) + compressor.compress(payload) + compressor.flush()
+        self.stats['compression_us'] += int((time.perf_counter() - began) * 1e6)
+        if len(compressed) >= len(payload):
+            self.stats['compression_skipped'] += 1
+            return payload
+
+        self.stats['compressed_messages'] += 1
+        self.stats['compression_bytes_in'] += len(payload)
+        self.stats['compression_bytes_out'] += len(compressed)
+        return compressed
+
+
+def is_compressed(payload):
+    """Whether a message payload is compressed"""
+    return payload[:1] == b'\xc0'
+
+
+def decompress(payload, max_size=MAX_DECOMPRESSED_SIZE):
+    """Inflate a compressed message, raising ValueError if corrupt or too large"""
+    decompressor = zlib.decompressobj(WINDOW_BITS, zdict=COMPRESSION_DICTIONARY)
+    try:
+        data = decompressor.decompress(bytes(payload[1:]), max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Compressed message exceeds {max_size} bytes")
+        return data + decompressor.flush()
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed message: {e}")
+
+
+def is_binary(payload):
+    """Whether a message payload is in the binary codec"""
+    return payload[:1] == b'\xc1'
+
+
+def encode_binary(message, user_id=0, interned=False):
+    """Encode a message dict, or None if it has no binary form.
+
+    An interned message leaves the sender's name empty: the recipient knows
+    it from user_id.
+    """
+    body = message.get('message')
+    if not isinstance(body, str):
+        return None
+    fields = message.keys() - {'type', 'message'}
+    code = CODES_BY_SHAPE.get((message.get('type'), frozenset(fields)))
+    if code is None:
+        return None
+
+    parts = [HEADER.pack(MAGIC, code, user_id)]
+    for field in MESSAGE_CODES[code][1]:
+        value = message[field]
+        if not isinstance(value, str):
+            return None
+        value = b'' if interned and field == 'from' else value.encode('utf-8')
+        if len(value) > 255:
+            return None
+        parts.append(SHORT_LENGTH.pack(len(value)))
+        parts.append(value)
+    body = body.encode('utf-8')
+    parts.append(BODY_LENGTH.pack(len(body)))
+    parts.append(body)
+    return b''.join(parts)
+
+
+def encode_notice(text):
+    """Encode a bare text notice"""
+    body = text.encode('utf-8') if isinstance(text, str) else bytes(text)
+    return HEADER.pack(MAGIC, NOTICE, 0) + BODY_LENGTH.pack(len(body)) + body
+
+
+def compact(payload, kind, user_id=0, interned=False):
+    """The binary form of an encoded JSON or text message, else the payload itself"""
+    if kind not in COMPACT_KINDS:
+        return payload
+    if kind == 'notice':
+        return encode_notice(payload)
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        return payload
+    return encode_binary(message, user_id, interned) or payload
+
+
+def decode_binary(payload):
+    """Decode a binary message.
+
+    Returns the same dict as its JSON form, with the sender's user id as
+    'from_id' when known (and 'from' empty if the message was interned), or
+    the text of a notice. Raises ValueError on a malformed message.
+    """
+    try:
+        magic, code, user_id = HEADER.unpack_from(payload)
+        offset = HEADER.size
+        message_type, fields = MESSAGE_CODES[code] if code != NOTICE else (None, ())
+
+        message = {"type": message_type}
+        for field in fields:
+            (length,) = SHORT_LENGTH.unpack_from(payload, offset)
+            offset += SHORT_LENGTH.size
+            message[field] = bytes(payload[offset:offset + length]).decode('utf-8')
+            offset += length
+        (length,) = BODY_LENGTH.unpack_from(payload, offset)
+        offset += BODY_LENGTH.size
+        body = bytes(payload[offset:offset + length]).decode('utf-8')
+    except (struct.error, KeyError) as e:
+        raise ValueError(f"Malformed binary message: {e}")
+    if offset + length != len(payload):
+        raise ValueError("Malformed binary message: length mismatch")
+
+    if code == NOTICE:
+        return body
+    message['message'] = body
+    if user_id:
+        message['from_id'] = user_id
+    return message
+
+
+def decode_message(payload):
+    """Decode a message in either codec, compressed or not, into a dict (or
+    a notice's text).
+
+    Raises ValueError (json.JSONDecodeError for JSON) when it is neither.
+    """
+    if is_compressed(payload):
+        payload = decompress(payload)
+    if is_binary(payload):
+        return decode_binary(payload)
+    return json.loads(payload)
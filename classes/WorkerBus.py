@@ -0,0 +1,218 @@
+import json
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from classes.FrameDecoder import FrameDecoder, encode_frame
+from classes.OutboundQueue import OutboundQueue
+
+# Bytes read per recv() on bus connections
+BUS_RECV_SIZE = 65536
+
+# Bytes queued for a worker, or for the broker, before the connection is
+# dropped (and the worker resynced)
+BUS_MAX_BYTES = 16 << 20
+
+# Attempts to reach the broker again after it dropped a worker, and seconds
+# between two; a worker that cannot lost its supervisor
+RECONNECT_ATTEMPTS = 5
+RECONNECT_INTERVAL = 0.2
+
+
+def bus_queue():
+    """Bounded queue of frames waiting for one bus connection"""
+    return OutboundQueue(max_bytes=BUS_MAX_BYTES, high_watermark=BUS_MAX_BYTES,
+                         low_watermark=BUS_MAX_BYTES)
+
+
+def write_frames(connection, outbound):
+    """Send what is queued for a bus connection until the queue is closed"""
+    try:
+        while outbound.wait():
+            data = outbound.front()
+            if data is not None:
+                outbound.consume(connection.send(data))
+    except OSError:
+        pass
+
+
+def send_frame(connection, outbound, frame):
+    """Queue a frame, dropping the connection if its peer cannot keep up"""
+    if outbound.put(frame) or outbound.closed:
+        return
+    logging.error("Bus connection overflowed, dropping it")
+    outbound.close()
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class BusBroker:
+    """Relays bus messages between the worker processes of one server.
+
+    Runs in the supervising process. Every message is a length-prefixed JSON
+    object naming its sending worker as 'node'; it goes to the worker named
+    in 'to_node', or to every other worker. When a worker's connection
+    closes the others get {"op": "gone"} on its behalf.
+
+    Every worker has its own bounded queue and writer thread, so a worker
+    that stops reading is dropped (and reconnects and resyncs) instead of
+    stalling the relay for all the others.
+    """
+
+    def __init__(self, path):
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+
+        self.workers = {}  # {worker: connection}
+        self.connections = {}  # {connection: {'decoder': FrameDecoder, 'worker': worker or None,
+                               #               'outbound': OutboundQueue}}
+
+    def accept(self, listener):
+        """Start relaying for a worker that just connected"""
+        connection, _ = listener.accept()
+        outbound = bus_queue()
+        self.connections[connection] = {'decoder': FrameDecoder(), 'worker': None,
+                                        'outbound': outbound}
+        self.selector.register(connection, selectors.EVENT_READ, self.read)
+        threading.Thread(target=write_frames, args=(connection, outbound), daemon=True).start()
+
+    def read(self, connection):
+        """Relay every complete message a worker sent"""
+        try:
+            data = connection.recv(BUS_RECV_SIZE)
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(connection)
+            return
+
+        state = self.connections[connection]
+        for payload in state['decoder'].feed(data):
+            message = json.loads(payload.decode('utf-8'))
+            if state['worker'] is None:
+                state['worker'] = message.get('node')
+                self.workers[state['worker']] = connection
+            self.relay(connection, message.get('to_node'), encode_frame(payload))
+
+    def relay(self, sender, to_node, frame):
+        """Send a frame to one worker, or to all but its sender"""
+        if to_node is not None:
+            targets = [self.workers[to_node]] if to_node in self.workers else []
+        else:
+            targets = [connection for connection in self.workers.values()
+                       if connection is not sender]
+
+        for connection in targets:
+            send_frame(connection, self.connections[connection]['outbound'], frame)
+
+    def drop(self, connection):
+        """Forget a worker whose connection closed and tell the others"""
+        self.selector.unregister(connection)
+        state = self.connections.pop(connection)
+        state['outbound'].close()
+        connection.close()
+        worker = state['worker']
+        if self.workers.get(worker) is connection:
+            del self.workers[worker]
+            logging.error(f"Worker {worker} left the bus")
+            self.relay(None, None, encode_frame(json.dumps(
+                {"op": "gone", "node": worker}).encode('utf-8')))
+
+    def serve_forever(self):
+        """Relay messages until interrupted"""
+        while True:
+            for key, mask in self.selector.select():
+                key.data(key.fileobj)
+
+
+class WorkerBus:
+    """One worker's connection to the BusBroker.
+
+    Messages are queued and written by a thread of their own, so publishing
+    never blocks the server. If the broker drops the connection (or the
+    queue overflows), the worker connects again, forgets what it knew of the
+    other workers ({"op": "rejoined"}) and says hello to be resynced.
+    """
+
+    def __init__(self, path, worker, on_message, on_closed=None):
+        self.path = path
+        self.worker = worker
+        self.on_message = on_message
+
+        # Called once the broker went away
+        self.on_closed = on_closed
+
+        self.connect()
+
+    def connect(self):
+        """Open a connection to the broker with its queue and writer thread"""
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+        except OSError:
+            connection.close()
+            raise
+        self.decoder = FrameDecoder()
+        self.outbound = bus_queue()
+        self.socket = connection
+        threading.Thread(target=write_frames, args=(connection, self.outbound),
+                         daemon=True).start()
+
+    def reconnect(self):
+        """Connect again after the connection dropped, False if the broker is gone"""
+        for _ in range(RECONNECT_ATTEMPTS):
+            try:
+                self.connect()
+            except OSError:
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+
+            logging.error("Worker bus connection dropped, resyncing")
+            # What the other workers said meanwhile was lost
+            self.on_message({"op": "rejoined"})
+            self.publish({"op": "hello"})
+            return True
+        return False
+
+    def start(self):
+        """Start receiving and introduce this worker to the others"""
+        threading.Thread(target=self.receive, daemon=True).start()
+        self.publish({"op": "hello"})
+
+    def publish(self, message, to_node=None):
+        """Send a message to one worker, or to all the others"""
+        message = dict(message, node=self.worker)
+        if to_node is not None:
+            message['to_node'] = to_node
+        send_frame(self.socket, self.outbound, encode_frame(json.dumps(message).encode('utf-8')))
+
+    def receive(self):
+        """Hand every message from the other workers to on_message"""
+        while True:
+            try:
+                data = self.socket.recv(BUS_RECV_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                self.outbound.close()
+                self.socket.close()
+                if self.reconnect():
+                    continue
+                logging.error("Worker bus closed")
+                if self.on_closed:
+                    self.on_closed()
+                return
+
+            for payload in self.decoder.feed(data):
+                try:
+                    self.on_message(json.loads(payload.decode('utf-8')))
+                except Exception as e:
+                    logging.error(f"Bus message error: {str(e)}")
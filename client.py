@@ -15,14 +15,18 @@ FormClass, BaseClass = uic.loadUiType(resource_path('assets/chat_client.ui'))
 
 
 class ChatTab(QWidget):
-    """Tab for either public chat or a private conversation"""
+    """Tab for public chat, a channel or a private conversation"""
 
-    def __init__(self, recipient=None, is_public=False):
+    def __init__(self, recipient=None, is_public=False, channel=None):
         super().__init__()
         self.recipient = recipient
         self.is_public = is_public
+        self.channel = channel
         self.unread_count = 0
 
+        # Tab title
+        self.name = f"#{channel}" if channel else recipient
+
         layout = QVBoxLayout()
 
         # Chat display
@@ -31,12 +35,12 @@ class ChatTab(QWidget):
         layout.addWidget(self.chat_display)
 
         # Message input area (only for active tabs)
-        if recipient is not None or is_public:
+        if recipient is not None or is_public or channel:
             input_layout = QHBoxLayout()
 
             self.message_input = QLineEdit()
             self.message_input.setPlaceholderText(
-                f"Type your message to {'everyone' if is_public else recipient}...")
+                f"Type your message to {'everyone' if is_public else self.name}...")
 
             self.send_btn = QPushButton("Send")
 
@@ -92,8 +96,11 @@ class ChatWindow(BaseClass, FormClass):
         self.signal_handler.connection_error.connect(
             self.handle_connection_error)
         self.signal_handler.user_list_updated.connect(self.update_user_list)
+        self.signal_handler.user_joined.connect(self.add_user)
+        self.signal_handler.user_left.connect(self.remove_user)
 
         self.private_chats = {}  # {username: tab_index}
+        self.channel_tabs = {}  # {channel: tab_index}
 
         # Connect UI signals
         self.connectButton.clicked.connect(self.toggle_connection)
@@ -174,6 +181,10 @@ class ChatWindow(BaseClass, FormClass):
                 self.add_message_to_public_chat(
                     "SERVER:", f"Connecting to server via {protocol}...")
 
+                # Subscriptions do not survive a reconnection
+                for channel in self.channel_tabs:
+                    self.client.join_channel(channel)
+
                 # Update protocol info
                 protocol_text = f"<b>Currently using: {protocol}</b><br><br>"
                 if protocol == "TCP":
@@ -201,11 +212,65 @@ class ChatWindow(BaseClass, FormClass):
         if not message:
             return
 
+        if message.startswith('/'):
+            self.run_command(message)
+            self.publicMessageInput.clear()
+            return
+
         if self.client.send_message(message):
             self.add_message_to_public_chat(
                 self.client.username, message, is_self=True)
             self.publicMessageInput.clear()
 
+    def run_command(self, command):
+        """Run a /join, /leave or /channels command typed in the public chat"""
+        parts = command.split(None, 1)
+        name = parts[0].lower()
+        argument = parts[1].strip() if len(parts) > 1 else ''
+
+        if name == '/join' and argument:
+            self.client.join_channel(argument)
+        elif name == '/leave' and argument:
+            self.client.leave_channel(argument)
+        elif name == '/channels':
+            self.client.list_channels()
+        else:
+            self.add_message_to_public_chat(
+                "SERVER:", "Commands: /join <channel>, /leave <channel>, /channels")
+
+    def send_channel_message(self, channel):
+        """Send a message to a channel from its tab"""
+        if not self.client or not self.client.connected:
+            return
+
+        if channel in self.channel_tabs:
+            tab = self.chatTabs.widget(self.channel_tabs[channel])
+
+            message = tab.message_input.text().strip()
+            if not message:
+                return
+
+            if self.client.send_message(message, channel=channel):
+                tab.add_message(self.client.username, message, is_self=True)
+                tab.message_input.clear()
+
+    def open_channel_tab(self, channel):
+        """Open or focus the tab of a channel we joined"""
+        if channel in self.channel_tabs:
+            self.chatTabs.setCurrentIndex(self.channel_tabs[channel])
+            return
+
+        new_tab = ChatTab(channel=channel)
+        tab_index = self.chatTabs.addTab(new_tab, new_tab.name)
+        self.channel_tabs[channel] = tab_index
+
+        new_tab.message_input.returnPressed.connect(
+            lambda: self.send_channel_message(channel))
+        new_tab.send_btn.clicked.connect(
+            lambda: self.send_channel_message(channel))
+
+        self.chatTabs.setCurrentIndex(tab_index)
+
     def send_private_message(self, recipient):
         """Send a private message to a specific recipient"""
         if not self.client or not self.client.connected:
@@ -267,6 +332,9 @@ class ChatWindow(BaseClass, FormClass):
         tab_index = self.chatTabs.addTab(new_tab, recipient)
         self.private_chats[recipient] = tab_index
 
+        if self.client.history_available:
+            self.client.request_history(with_user=recipient)
+
         # Connect signals for this tab
         new_tab.message_input.returnPressed.connect(
             lambda: self.send_private_message(recipient))
@@ -282,21 +350,26 @@ class ChatWindow(BaseClass, FormClass):
         if index == 0:
             return
 
-        # Find which user this tab belongs to
+        # Find which user or channel this tab belongs to
         tab = self.chatTabs.widget(index)
         recipient = tab.recipient
 
         # Remove from tracking
         if recipient in self.private_chats:
             del self.private_chats[recipient]
+        if tab.channel in self.channel_tabs:
+            del self.channel_tabs[tab.channel]
+            if self.client and self.client.connected:
+                self.client.leave_channel(tab.channel)
 
         # Close the tab
         self.chatTabs.removeTab(index)
 
-        # Update indices for remaining private chats
-        for username, tab_idx in list(self.private_chats.items()):
-            if tab_idx > index:
-                self.private_chats[username] = tab_idx - 1
+        # Update indices for remaining private chats and channels
+        for tabs in (self.private_chats, self.channel_tabs):
+            for key, tab_idx in list(tabs.items()):
+                if tab_idx > index:
+                    tabs[key] = tab_idx - 1
 
     def tab_changed(self, index):
         """Reset unread counter when switching to a tab"""
@@ -306,8 +379,8 @@ class ChatWindow(BaseClass, FormClass):
                 tab.unread_count = 0
                 if index == 0:
                     self.chatTabs.setTabText(index, "Public Chat")
-                elif hasattr(tab, 'recipient'):
-                    self.chatTabs.setTabText(index, tab.recipient)
+                elif hasattr(tab, 'name'):
+                    self.chatTabs.setTabText(index, tab.name)
 
     def update_tab_title(self, index):
         """Update tab title with unread message count"""
@@ -316,9 +389,9 @@ class ChatWindow(BaseClass, FormClass):
             if index == 0:
                 self.chatTabs.setTabText(
                     index, f"Public Chat ({tab.unread_count})")
-            elif hasattr(tab, 'recipient'):
+            elif hasattr(tab, 'name'):
                 self.chatTabs.setTabText(
-                    index, f"{tab.recipient} ({tab.unread_count})")
+                    index, f"{tab.name} ({tab.unread_count})")
 
     def update_user_list(self, users):
         """Update the list of online users"""
@@ -328,11 +401,60 @@ class ChatWindow(BaseClass, FormClass):
             if self.client and username != self.client.username:
                 self.userList.addItem(username)
 
+    def add_user(self, username):
+        """Insert a user who came online, keeping the list sorted"""
+        if not self.client or username == self.client.username:
+            return
+        if self.userList.findItems(username, QtCore.Qt.MatchExactly):
+            return
+
+        row = 0
+        while row < self.userList.count() and self.userList.item(row).text() < username:
+            row += 1
+        self.userList.insertItem(row, username)
+
+    def remove_user(self, username):
+        """Remove a user who went offline"""
+        for item in self.userList.findItems(username, QtCore.Qt.MatchExactly):
+            self.userList.takeItem(self.userList.row(item))
+
     def handle_message(self, data):
         """Handle received messages based on their type"""
         message_type = data.get('type', 'legacy')
 
-        if message_type == 'public':
+        if message_type == 'public' and data.get('channel') is not None:
+            # Message to a channel we joined
+            channel = data['channel']
+            if channel not in self.channel_tabs:
+                self.open_channel_tab(channel)
+            tab_index = self.channel_tabs[channel]
+            tab = self.chatTabs.widget(tab_index)
+            tab.add_message(data.get('from', 'Unknown'), data.get('message', ''))
+
+            if self.chatTabs.currentIndex() != tab_index:
+                tab.increment_unread()
+                self.update_tab_title(tab_index)
+
+        elif message_type == 'joined':
+            self.open_channel_tab(data.get('channel', ''))
+            if self.client and self.client.history_available:
+                self.client.request_history(channel=data.get('channel'))
+
+        elif message_type == 'history':
+            self.show_history(data)
+
+        elif message_type == 'left':
+            self.add_message_to_public_chat(
+                "SERVER:", f"You left #{data.get('channel', '')}")
+
+        elif message_type == 'channel_list':
+            channels = ', '.join(
+                f"#{channel['name']} ({channel['members']})"
+                for channel in data.get('channels', []))
+            self.add_message_to_public_chat(
+                "SERVER:", f"Channels: {channels or 'none'}")
+
+        elif message_type == 'public':
             # Public message
             sender = data.get('from', 'Unknown')
             message = data.get('message', '')
@@ -387,14 +509,23 @@ class ChatWindow(BaseClass, FormClass):
         elif message_type == 'private_sent':
             # Confirmation of private message sent
             # We don't need to display anything here since we already
-            # displayed the message when sending
-            pass
+            # displayed the message when sending, unless it waits for an
+            # offline recipient
+            recipient = data.get('to')
+            if data.get('stored') and recipient in self.private_chats:
+                tab = self.chatTabs.widget(self.private_chats[recipient])
+                tab.add_message(
+                    "SERVER:", f"{recipient} is offline, they will get it when they connect.")
 
         elif message_type == 'server':
             # Server message
             message = data.get('message', '')
             self.add_message_to_public_chat("SERVER:", message)
 
+            # Scrollback of the public chat from before we connected
+            if data.get('history') and self.client:
+                self.client.request_history()
+
         elif message_type == 'error':
             # Error message
             message = data.get('message', '')
@@ -421,6 +552,31 @@ class ChatWindow(BaseClass, FormClass):
                     # Just display as is
                     self.add_message_to_public_chat("SERVER:", message)
 
+    def show_history(self, data):
+        """Display the earlier messages of the public chat, a channel or a private chat"""
+        username = self.client.username if self.client else None
+
+        if data.get('channel') is not None:
+            if data['channel'] not in self.channel_tabs:
+                return
+            tab = self.chatTabs.widget(self.channel_tabs[data['channel']])
+        elif data.get('with') is not None:
+            if data['with'] not in self.private_chats:
+                return
+            tab = self.chatTabs.widget(self.private_chats[data['with']])
+        else:
+            tab = None
+
+        for message in data.get('messages', []):
+            sender = message.get('from', 'Unknown')
+            if tab is None:
+                self.add_message_to_public_chat(
+                    sender, message.get('message', ''), is_self=sender == username)
+            else:
+                tab.add_message(sender, message.get('message', ''),
+                                is_private=data.get('with') is not None,
+                                is_self=sender == username)
+
     def handle_connection_error(self, error_message):
         QMessageBox.warning(self, "Connection Error", error_message)
 
@@ -1,246 +1,1609 @@
+import argparse
+import collections
+import functools
+import multiprocessing
+import os
+import shutil
+import signal
 import socket
+import stat
+import sys
+import tempfile
 import threading
+import time
 import json
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+from classes.ChannelIndex import ChannelIndex, valid_channel_name
+from classes.ClientRegistry import ClientRegistry
+from classes.Session import TCP, TCP_RECV_SIZE, UDP, UDP_RECV_SIZE, TcpSession, UdpSession
+from classes.EventLoopEngine import EventLoopEngine
+from classes.EncodedMessage import EncodedBatch, EncodedMessage
+from classes.FrameDecoder import FrameDecoder, split_handshake
+from classes.Mailbox import DEFAULT_MAX_MESSAGES, DEFAULT_MAX_STORED_BYTES, DEFAULT_TTL, Mailbox
+from classes.LogQueue import (DEFAULT_MESSAGE_RATE, DEFAULT_MESSAGE_SAMPLE,
+                              DEFAULT_QUEUE_SIZE, LOG_FORMAT, MESSAGE_LOGGER,
+                              LogQueue, log_chat)
+from classes.MessageLog import MessageLog
+from classes.Metrics import DEFAULT_SUMMARY_INTERVAL, Metrics
+from classes.RateLimiter import (DEFAULT_BURST_SECONDS, DEFAULT_IP_FACTOR, DEFAULT_RATES,
+                                 RateLimiter)
+from classes.ReliableChannel import DATA, ReliableChannel, is_reliable
+from classes.TimerWheel import TimerWheel
+from classes.ClusterBus import ClusterBus
+from classes.WorkerBus import BusBroker, WorkerBus
+from classes.WireCodec import (BINARY_CODEC, DEFAULT_COMPRESSION_LEVEL,
+                               DEFAULT_COMPRESSION_THRESHOLD, JSON_CODEC, ZLIB_COMPRESSION,
+                               Compressor, decode_message, decompress, is_compressed)
+from classes.OutboundQueue import (DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK,
+                                   DEFAULT_MAX_BYTES, DatagramQueue, OutboundQueue,
+                                   send_front)
+
+# Seconds between two calls to ChatServer.tick()
+TICK_INTERVAL = 0.05
+
+# Default seconds a TCP client's queued data may wait for more before it is
+# written (0 writes whatever is queued as soon as the writer wakes up)
+DEFAULT_FLUSH_DELAY = 0
+
+# Default seconds during which join/leave notifications are coalesced
+DEFAULT_PRESENCE_INTERVAL = 0.25
+
+# Usernames spelled out in a coalesced join/leave notice
+PRESENCE_SUMMARY_NAMES = 5
+
+# Seconds between two heartbeats of a UDP client (see ChatClient)
+DEFAULT_UDP_HEARTBEAT_INTERVAL = 5
+
+# Heartbeats a UDP client may miss before its session is reaped
+DEFAULT_UDP_MISSED_HEARTBEATS = 3
+
+# Messages returned by a history request that gives no limit, and the most it may ask for
+DEFAULT_HISTORY_LIMIT = 50
+MAX_HISTORY_LIMIT = 1000
+
+# Largest history reply sent to a plain UDP client, oldest messages are left out
+UDP_HISTORY_BYTES = 60000
+
+# Conversation key of the public room in the message log
+PUBLIC_HISTORY = 'public'
+
+# Bytes of stored private messages queued for a TCP client in one write
+MAILBOX_CHUNK_BYTES = 64 * 1024
+
+# Stored private messages sent to a UDP client per tick
+MAILBOX_DATAGRAMS_PER_TICK = 256
+
+# Seconds between two sweeps of expired stored messages
+MAILBOX_SWEEP_INTERVAL = 60
+
+# Client message types counted against the control budget of the rate
+# limiter; private messages have their own, anything else is public
+CONTROL_TYPES = {'join', 'leave', 'list', 'history', 'presence_sync',
+                 'register', 'heartbeat'}
+
+# Default port of the multicast group, and hops its datagrams may take (1
+# keeps them on the local network)
+DEFAULT_MULTICAST_PORT = 9092
+DEFAULT_MULTICAST_TTL = 1
+
+# Address given to clients of the Unix sockets in place of an IP address:
+# like loopback clients, all local processes share one IP budget
+UNIX_PEER = 'unix'
+
+# Fields each bus operation must carry, with their types; optional fields
+# are checked when present. Messages that do not match are dropped.
+BUS_FIELDS = {
+    'hello': {},
+    'rejoined': {},
+    'gone': {},
+    'sync': {},
+    'presence': {'action': str, 'user': str, 'present': bool},
+    'public': {'message': str},
+    'subscribe': {'channel': str},
+    'unsubscribe': {'channel': str},
+    'channel': {'channel': str, 'message': str},
+    'mailbox': {'to': str, 'messages': list},
+    'private': {'from': str, 'to': str, 'message': str},
+}
+BUS_OPTIONAL_FIELDS = {'notice': (str, type(None)), 'tcp': bool, 'udp': bool,
+                       'users': list, 'channels': list}
+
+# Interface the stats endpoint listens on, never reachable from other hosts
+STATS_HOST = '127.0.0.1'
+
+# Interface cluster links are accepted on unless told otherwise, and the
+# environment variable holding the cluster secret if not given as an option
+DEFAULT_CLUSTER_HOST = '127.0.0.1'
+CLUSTER_SECRET_VARIABLE = 'CHATTER_CLUSTER_SECRET'
+
+# What to do with a TCP client whose outbound queue crosses its high watermark
+BACKPRESSURE_POLICIES = ['drop_oldest', 'disconnect', 'pause']
+
+# Configure logging (replaced by a LogQueue when run as a script)
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+# Per-message lines, sampled and rate-limited, with bodies only at debug level
+message_logger = logging.getLogger(MESSAGE_LOGGER)
 
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', tcp_port=9090, udp_port=9091):
+    def __init__(self, host='0.0.0.0', tcp_port=9090, udp_port=9091,
+                 backpressure_policy='drop_oldest',
+                 high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK,
+                 max_outbound_bytes=DEFAULT_MAX_BYTES,
+                 flush_delay=DEFAULT_FLUSH_DELAY, tcp_nodelay=True,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 presence_interval=DEFAULT_PRESENCE_INTERVAL,
+                 udp_heartbeat_interval=DEFAULT_UDP_HEARTBEAT_INTERVAL,
+                 udp_missed_heartbeats=DEFAULT_UDP_MISSED_HEARTBEATS,
+                 history_dir=None, mailbox_ttl=DEFAULT_TTL,
+                 mailbox_size=DEFAULT_MAX_MESSAGES, mailbox_dir=None,
+                 mailbox_bytes=DEFAULT_MAX_STORED_BYTES,
+                 stats_port=None, stats_interval=DEFAULT_SUMMARY_INTERVAL,
+                 public_rate=DEFAULT_RATES['public'],
+                 private_rate=DEFAULT_RATES['private'],
+                 control_rate=DEFAULT_RATES['control'],
+                 rate_burst=DEFAULT_BURST_SECONDS, ip_rate_factor=DEFAULT_IP_FACTOR,
+                 multicast_group=None, multicast_port=DEFAULT_MULTICAST_PORT,
+                 multicast_ttl=DEFAULT_MULTICAST_TTL, multicast_interface=None,
+                 unix_path=None, unix_datagram_path=None, reuse_port=False):
         self.host = host
         self.tcp_port = tcp_port
         self.udp_port = udp_port
 
+        # Slow consumer handling
+        if backpressure_policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {backpressure_policy}")
+        self.backpressure_policy = backpressure_policy
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_outbound_bytes = max_outbound_bytes
+
+        # Writes to TCP clients: everything queued goes out in one
+        # scatter-gather call, at most flush_delay seconds after the oldest
+        # part was queued, and Nagle's algorithm is off unless tcp_nodelay
+        # is False
+        self.flush_delay = flush_delay
+        self.tcp_nodelay = tcp_nodelay
+
         # TCP setup
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Worker processes share the port, the kernel spreads connections
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.tcp_socket.bind((self.host, self.tcp_port))
 
         # UDP setup
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            # Datagrams of one client address keep going to the same worker
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.udp_socket.bind((self.host, self.udp_port))
 
-        # Client management
-        self.tcp_clients = {}  # {client_socket: {'username': username, 'address': address}}
-        self.udp_clients = {}  # {address: username}
-
-        # Username to socket/address mapping for private messaging
-        self.username_to_tcp_socket = {}  # {username: client_socket}
-        self.username_to_udp_address = {}  # {username: address}
+        # Unix domain sockets for processes on this host: clients of the
+        # stream socket at unix_path are served exactly like TCP clients, and
+        # those of the datagram socket at unix_datagram_path like UDP clients
+        # (each must bind a path of its own to get replies)
+        self.unix_socket = None
+        self.unix_address = (UNIX_PEER, unix_path)
+        if unix_path:
+            self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            bind_unix(self.unix_socket, unix_path)
+        self.unix_datagram_socket = None
+        if unix_datagram_path:
+            self.unix_datagram_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            bind_unix(self.unix_datagram_socket, unix_datagram_path)
+
+        # LAN multicast: public messages and presence reach the UDP clients
+        # that joined multicast_group:multicast_port in one datagram per
+        # broadcast, sent from the UDP socket through multicast_interface
+        # (the kernel's choice if None); private messages, channels and
+        # replies stay unicast
+        self.multicast_address = None
+        if multicast_group:
+            self.multicast_address = (multicast_group, multicast_port)
+            self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if multicast_interface:
+                self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                           socket.inet_aton(multicast_interface))
+
+        # Client management, safe to update from any handler thread and
+        # iterated through snapshots; registering and removing sessions goes
+        # through the registry, lookups use its maps directly, and private
+        # messages find a user's session through registry.route()
+        self.registry = ClientRegistry()
+        self.tcp_clients = self.registry.tcp_clients  # {client_socket: Session}
+        self.udp_clients = self.registry.udp_clients  # {address: Session}
 
         # Online users list
-        self.online_users = set()
+        self.online_users = self.registry.online_users
+
+        # Named channels: who is subscribed to what (members are TCP sockets
+        # and UDP addresses)
+        self.channels = ChannelIndex()
+
+        # Multi-process or cluster mode: users connected to the other
+        # workers or nodes
+        self.bus = None  # WorkerBus or ClusterBus
+        self.remote_users = {}  # {username: {node}}
+        self.remote_channels = {}  # {channel: {node with members in it}}
+
+        # Presence: bumped on every membership change, with the serialized
+        # user list cached until the next change. The lock keeps the cache,
+        # the version and the online users consistent across handler threads.
+        self.presence_version = 0
+        self.user_list_cache = None
+        self.user_list_lock = threading.Lock()
+
+        # Local users whose user id every client has been told, by the user
+        # list or a presence delta: {username: user_id}. Binary envelopes
+        # from these users carry the id without the name.
+        self.announced_ids = {}
+
+        # Join/leave announcements waiting for the coalescing window to close
+        self.presence_interval = presence_interval
+        self.presence_events = []
+        self.presence_batch_started = 0
+        self.presence_lock = threading.Lock()
+
+        # UDP sessions are reaped after missing this many seconds of
+        # heartbeats (0 keeps them forever); the wheel holds one deadline per
+        # address and is only pushed back when it fires for a live client
+        self.udp_session_timeout = udp_heartbeat_interval * udp_missed_heartbeats
+        self.udp_last_seen = {}  # {address: time.monotonic()}
+        self.udp_expiry = TimerWheel(max(udp_heartbeat_interval, TICK_INTERVAL))
+
+        # Periodic housekeeping driven by the engine
+        self.tick_interval = TICK_INTERVAL
+
+        # Reliable mode state of the UDP clients that use it
+        self.udp_reliable = {}  # {address: ReliableChannel}
+
+        # Encoded datagrams waiting for the UDP socket
+        self.udp_outbound = DatagramQueue()
+
+        # I/O engine driving the sockets (None for the threaded engine)
+        self.engine = None
+
+        # Event counters, e.g. how often each backpressure policy fired
+        self.stats = collections.Counter()
+
+        # Traffic counters and latency histograms, served as JSON on
+        # STATS_HOST:stats_port if given and logged every stats_interval
+        # seconds (0 never logs them)
+        self.metrics = Metrics(self.stats, self.queue_depths)
+        if stats_port is not None:
+            self.metrics.serve(STATS_HOST, stats_port)
+        self.stats_interval = stats_interval
+        self.stats_logged = time.monotonic()
+
+        # Messages of compression_threshold bytes or more are compressed for
+        # the clients that asked for it, once per broadcast (0 disables it)
+        self.compressor = None
+        if compression_threshold:
+            self.compressor = Compressor(compression_threshold, compression_level, self.stats)
+
+        # Messages per second each user may send, per class (0 is
+        # unlimited), with rate_burst seconds of slack; each IP address
+        # gets ip_rate_factor times as much. Checked before any fan-out.
+        self.rate_limiter = RateLimiter(
+            {'public': public_rate, 'private': private_rate, 'control': control_rate},
+            rate_burst, ip_rate_factor, self.stats)
+
+        # Durable history of the public room, channels and private
+        # conversations (None keeps no history)
+        self.history = MessageLog(history_dir, self.stats) if history_dir else None
+
+        # Private messages to offline users who connected before, kept for
+        # mailbox_ttl seconds, at most mailbox_size per user (0 refuses them
+        # as before) and mailbox_bytes in all, and journaled in mailbox_dir
+        # if given
+        self.mailbox = None
+        if mailbox_size:
+            path = None
+            if mailbox_dir:
+                os.makedirs(mailbox_dir, exist_ok=True)
+                path = os.path.join(mailbox_dir, 'mailbox.journal')
+            self.mailbox = Mailbox(mailbox_ttl, mailbox_size, path, self.stats, mailbox_bytes)
+        self.mailbox_swept = time.monotonic()
+
+        # Stored messages being streamed to recipients who just connected
+        self.mailbox_deliveries = {}  # {client_socket or address: (username, deque of (expires, message))}
+        self.mailbox_lock = threading.Lock()
 
         logging.info(
             f"Server initialized on {host} (TCP: {tcp_port}, UDP: {udp_port})")
 
-    def broadcast_tcp(self, message, exclude_client=None):
-        """Send message to all TCP clients except the sender"""
-        disconnected_clients = []
+    def send_tcp(self, client_socket, message, delivery=None):
+        """Send a message to a single TCP client"""
+        return self.queue_tcp(client_socket, EncodedMessage(message, delivery=delivery))
+
+    def queue_tcp(self, client_socket, encoded, publisher=None):
+        """Queue an encoded message on a TCP client's outbound queue.
+
+        publisher is the TCP client whose message this is, if any; it may be
+        paused when the recipient cannot keep up.
+        """
+        session = self.tcp_clients.get(client_socket)
+        if session is None or session.outbound.closed:
+            return False
+
+        outbound = session.outbound
+        data = encoded.for_tcp(session.decoder is not None, session.binary,
+                               self.compressor if session.compressed else None)
+        self.stats['tcp_messages_out'] += 1
+        self.stats['tcp_bytes_out'] += len(data)
+        self.metrics.sent(TCP, encoded.kind, len(data))
+        session.messages_out += 1
+        session.bytes_out += len(data)
+        if not outbound.put(data, encoded.droppable, encoded.delivery):
+            # Hard limit reached whatever the policy, drop the client
+            logging.warning(
+                f"Outbound queue full for TCP client {session.username}, disconnecting")
+            self.stats['outbound_overflow_disconnects'] += 1
+            self.disconnect_tcp(client_socket)
+            return False
+
+        if outbound.congested:
+            self.apply_backpressure(client_socket, session, publisher)
+        return True
+
+    def apply_backpressure(self, client_socket, session, publisher):
+        """Apply the backpressure policy to a TCP client above its high watermark"""
+        outbound = session.outbound
+
+        if self.backpressure_policy == 'disconnect':
+            logging.warning(
+                f"TCP client {session.username} is too slow, disconnecting")
+            self.stats['backpressure_disconnects'] += 1
+            self.disconnect_tcp(client_socket)
+            return
+
+        if self.backpressure_policy == 'pause' and publisher in self.tcp_clients:
+            # Stop reading from the publisher until this client catches up
+            if session.paused_publishers is None:
+                session.paused_publishers = set()
+            if publisher not in session.paused_publishers:
+                session.paused_publishers.add(publisher)
+                self.pause_tcp_reading(publisher)
+            return
+
+        # Drop oldest public messages; also the fallback for UDP publishers
+        self.stats['backpressure_dropped_messages'] += outbound.drop_oldest()
+
+    def pause_tcp_reading(self, client_socket):
+        """Stop reading from a TCP client until every pause is released"""
+        session = self.tcp_clients.get(client_socket)
+        if session is None:
+            return
+
+        session.pauses += 1
+        if session.pauses == 1:
+            self.stats['backpressure_pauses'] += 1
+            if self.engine:
+                self.engine.pause_reading(client_socket)
+            else:
+                session.readable.clear()
+
+    def resume_tcp_reading(self, client_socket, force=False):
+        """Release one pause (or all of them) on a TCP client"""
+        session = self.tcp_clients.get(client_socket)
+        if session is None or session.pauses == 0:
+            return
+
+        session.pauses = 0 if force else session.pauses - 1
+        if session.pauses == 0:
+            self.stats['backpressure_resumes'] += 1
+            if self.engine:
+                self.engine.resume_reading(client_socket)
+            else:
+                session.readable.set()
+
+    def release_publishers(self, client_socket):
+        """Resume the publishers paused on behalf of a TCP client"""
+        session = self.tcp_clients.get(client_socket)
+        if session is not None:
+            self.release_paused_publishers(session)
+
+    def release_paused_publishers(self, session):
+        """Resume the publishers paused on behalf of a TCP session"""
+        publishers = session.paused_publishers
+        if not publishers:
+            return
+        session.paused_publishers = None
+        for publisher in publishers:
+            self.resume_tcp_reading(publisher)
+
+    def disconnect_tcp(self, client_socket):
+        """Shut a TCP connection down; its engine notices and cleans up"""
+        session = self.tcp_clients.get(client_socket)
+        if session is not None:
+            session.outbound.close()
+
+            # A paused reader must run again to notice the shutdown
+            self.resume_tcp_reading(client_socket, force=True)
 
-        for client_socket in self.tcp_clients:
-            if client_socket != exclude_client:
-                try:
-                    client_socket.send(message.encode('utf-8'))
-                except:
-                    disconnected_clients.append(client_socket)
-
-        # Clean up disconnected clients
-        for client in disconnected_clients:
-            self.remove_tcp_client(client)
-
-    def broadcast_udp(self, message, exclude_address=None):
-        """Send message to all UDP clients except the sender"""
-        for address in self.udp_clients:
-            if address != exclude_address:
-                self.udp_socket.sendto(message.encode('utf-8'), address)
-
-    def broadcast_user_list(self):
-        """Broadcast the list of online users to all clients"""
-        user_list = list(self.online_users)
-        user_list_msg = json.dumps({
-            "type": "user_list",
-            "users": user_list
-        })
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_udp(self, message, address, delivery=None):
+        """Send a message to a single UDP client"""
+        return self.queue_udp(address, EncodedMessage(message, delivery=delivery))
+
+    def queue_udp(self, address, encoded):
+        """Queue an encoded message for a UDP client"""
+        session = self.udp_clients.get(address)
+        if session is not None:
+            data = encoded.for_udp(session.binary,
+                                   self.compressor if session.compressed else None)
+        else:
+            data = encoded.for_udp()
+        self.stats['udp_messages_out'] += 1
+        self.stats['udp_bytes_out'] += len(data)
+        self.metrics.sent(UDP, encoded.kind, len(data))
+        if session is not None:
+            session.messages_out += 1
+            session.bytes_out += len(data)
+
+        channel = self.udp_reliable.get(address)
+        if channel is None:
+            return self.transmit_udp([data], address, encoded.delivery)
+
+        # Lost datagrams of a reliable client are retransmitted later
+        datagrams = channel.send(data)
+        if datagrams is None:
+            logging.warning(f"Reliable UDP backlog full, dropped message to {address}")
+            return False
+        self.transmit_udp(datagrams, address, encoded.delivery)
+        return True
+
+    def transmit_udp(self, datagrams, address, delivery=None):
+        """Put raw datagrams on the UDP outbound queue"""
+        for datagram in datagrams:
+            if not self.udp_outbound.put(datagram, address, delivery):
+                logging.warning(f"UDP outbound queue full, dropped datagram to {address}")
+                return False
+        return True
+
+    def encode(self, message, droppable=False, delivery=None, sender=None):
+        """Encode a message once for all its recipients.
+
+        Binary envelopes carry the user id of the sender, a local username,
+        and leave their name out once their id was announced.
+        """
+        user_id = self.registry.user_id(sender, 0) if sender is not None else 0
+        return EncodedMessage(message, droppable, delivery, user_id,
+                              user_id and self.announced_ids.get(sender) == user_id)
+
+    def queue_multicast(self, encoded):
+        """Queue one datagram for every UDP client in the multicast group.
+
+        Members all use the binary codec, compressed if the server
+        compresses, and names are never left out: a member may have joined
+        after the user's id was announced.
+        """
+        data = encoded.for_udp(True, self.compressor)
+        self.stats['multicast_datagrams'] += 1
+        self.stats['udp_bytes_out'] += len(data)
+        self.metrics.sent('MULTICAST', encoded.kind, len(data))
+        return self.transmit_udp([data], self.multicast_address, encoded.delivery)
+
+    def broadcast(self, message, exclude=None, public=False, delivery=None, sender=None,
+                  tcp=True, udp=True):
+        """Send message to all TCP and UDP clients except the sender.
+
+        The message is encoded (and compressed) once for every recipient.
+        exclude is the sender's socket or address. Public chat messages may
+        be shed under backpressure, and a TCP sender is their publisher.
+        """
+        encoded = self.encode(message, public, delivery, sender)
+
+        if tcp:
+            publisher = exclude if public and exclude in self.tcp_clients else None
+            for client_socket in self.tcp_clients.keys():
+                if client_socket != exclude:
+                    self.queue_tcp(client_socket, encoded, publisher)
+
+        if udp:
+            multicast = False
+            for address, session in self.udp_clients.items():
+                if session.multicast:
+                    multicast = True
+                elif address != exclude:
+                    self.queue_udp(address, encoded)
+            if multicast:
+                # The sender gets its own message back and skips it
+                self.queue_multicast(encoded)
+
+    def broadcast_channel(self, channel, message, exclude=None, delivery=None, sender=None):
+        """Send a chat message to the local members of a channel except the sender"""
+        encoded = self.encode(message, True, delivery, sender)
+
+        for member in self.channels.members(channel):
+            if member == exclude:
+                continue
+            if member in self.tcp_clients:
+                self.queue_tcp(member, encoded, exclude)
+            elif member in self.udp_clients:
+                self.queue_udp(member, encoded)
+
+    def user_list_snapshot(self):
+        """Return the versioned list of online users, serialized once per change.
+
+        The list may already hold users whose join is still waiting to be
+        announced; the delta that announces it is harmless to apply again.
+        """
+        snapshot = self.user_list_cache
+        if snapshot is not None:
+            return snapshot
+
+        with self.user_list_lock:
+            if self.user_list_cache is None:
+                users = list(self.online_users)
+                self.user_list_cache = EncodedMessage(json.dumps({
+                    "type": "user_list",
+                    "users": users,
+                    "ids": self.user_ids_of(users),
+                    "version": self.presence_version
+                }))
+            return self.user_list_cache
+
+    def user_ids_of(self, usernames):
+        """The user ids of the local users among usernames: {username: user_id}"""
+        user_ids = {}
+        for username in usernames:
+            user_id = self.registry.user_id(username)
+            if user_id is not None:
+                user_ids[username] = user_id
+        return user_ids
+
+    def user_online(self, username):
+        """Mark a user online, returning True if they were not already"""
+        with self.user_list_lock:
+            if username in self.online_users:
+                return False
+            self.online_users.add(username)
+            self.user_list_cache = None
 
-        # Send to all TCP clients
-        for client_socket in self.tcp_clients:
+        if self.mailbox is not None:
+            # Users who were online may get mail once offline
+            self.mailbox.remember(username)
+        return True
+
+    def user_offline(self, username):
+        """Mark a user offline, returning True if they were online"""
+        with self.user_list_lock:
+            if username not in self.online_users or username in self.remote_users:
+                return False
+            self.online_users.discard(username)
+            self.user_list_cache = None
+        return True
+
+    def announce_presence(self, action, username, notice=None, changed=False,
+                          tcp=True, udp=True, exclude=None, local=True):
+        """Announce a user who 'joined' or 'left'.
+
+        changed tells whether the set of online users changed, notice is the
+        text sent to TCP and/or UDP clients except exclude. Announcements made
+        within presence_interval of each other are delivered as one batch.
+        Local announcements are also passed on to the other workers or nodes.
+        """
+        if local and self.bus:
+            self.bus.publish({
+                "op": "presence", "action": action, "user": username,
+                "present": self.user_connected(username),
+                "notice": notice, "tcp": tcp, "udp": udp
+            })
+
+        event = (action, username, notice, changed, tcp, udp, exclude)
+        if not self.presence_interval:
+            self.deliver_presence([event])
+            return
+
+        with self.presence_lock:
+            if not self.presence_events:
+                self.presence_batch_started = time.monotonic()
+            self.presence_events.append(event)
+
+    def user_connected(self, username):
+        """Whether a user is connected to this process over TCP or UDP"""
+        return self.registry.connected(username)
+
+    def flush_presence(self):
+        """Deliver pending announcements once the coalescing window closed"""
+        with self.presence_lock:
+            if not self.presence_events:
+                return
+            if time.monotonic() - self.presence_batch_started < self.presence_interval:
+                return
+            events, self.presence_events = self.presence_events, []
+
+        self.deliver_presence(events)
+
+    def deliver_presence(self, events):
+        """Send the notices and membership changes of a batch of announcements"""
+        if len(events) == 1:
+            # A lone announcement goes out exactly as it was made
+            action, username, notice, changed, tcp, udp, exclude = events[0]
+            if changed:
+                if action == 'joined':
+                    self.broadcast_presence(joined=[username])
+                else:
+                    self.broadcast_presence(left=[username])
+            if notice:
+                self.broadcast(notice, exclude, tcp=tcp, udp=udp)
+            return
+
+        self.stats['presence_batches'] += 1
+        self.stats['presence_events_coalesced'] += len(events)
+
+        # Net membership change: compare each user's state before the batch with now
+        was_online = {}
+        joined_names = []
+        left_names = []
+        for action, username, notice, changed, tcp, udp, exclude in events:
+            if changed:
+                was_online.setdefault(username, action == 'left')
+            if notice:
+                names = joined_names if action == 'joined' else left_names
+                if username not in names:
+                    names.append(username)
+
+        joined = [username for username, was in was_online.items()
+                  if not was and username in self.online_users]
+        left = [username for username, was in was_online.items()
+                if was and username not in self.online_users]
+        summary = self.presence_summary(joined_names, left_names)
+
+        if joined or left:
+            self.broadcast_presence(joined, left, summary)
+        elif summary:
+            self.broadcast(f"SERVER: {summary}")
+
+    def presence_summary(self, joined_names, left_names):
+        """Build one notice for many users joining and leaving"""
+        parts = []
+        for names, verb in ((joined_names, 'joined'), (left_names, 'left')):
+            if names:
+                shown = ', '.join(names[:PRESENCE_SUMMARY_NAMES])
+                if len(names) > PRESENCE_SUMMARY_NAMES:
+                    shown += f" and {len(names) - PRESENCE_SUMMARY_NAMES} others"
+                parts.append(f"{shown} {verb} the chat!")
+        return ' '.join(parts)
+
+    def broadcast_presence(self, joined=(), left=(), summary=None):
+        """Announce membership changes to all clients.
+
+        Clients that negotiated presence deltas get one small versioned
+        event (user_joined/user_left, or presence for a coalesced batch that
+        also carries the summary notice), older clients the cached full list
+        followed by the summary notice.
+        """
+        with self.user_list_lock:
+            self.presence_version += 1
+            version = self.presence_version
+            self.user_list_cache = None
+
+        # Every client learns the ids of the local users who joined
+        joined_ids = self.user_ids_of(joined)
+        if summary is None and len(joined) + len(left) == 1:
+            delta = {
+                "type": "user_joined" if joined else "user_left",
+                "user": (joined or left)[0],
+                "version": version
+            }
+            if joined_ids:
+                delta["id"] = joined_ids[joined[0]]
+        else:
+            delta = {
+                "type": "presence",
+                "joined": list(joined),
+                "ids": joined_ids,
+                "left": list(left),
+                "version": version
+            }
+            if summary:
+                delta["message"] = summary
+        delta = EncodedMessage(json.dumps(delta))
+        notice = EncodedMessage(f"SERVER: {summary}") if summary else None
+
+        for client_socket, session in self.tcp_clients.items():
+            if session.presence_deltas:
+                self.queue_tcp(client_socket, delta)
+            else:
+                self.queue_tcp(client_socket, self.user_list_snapshot())
+                if notice:
+                    self.queue_tcp(client_socket, notice)
+
+        multicast = False
+        for address, session in self.udp_clients.items():
+            if session.multicast:
+                multicast = True
+            elif session.presence_deltas:
+                self.queue_udp(address, delta)
+            else:
+                self.queue_udp(address, self.user_list_snapshot())
+                if notice:
+                    self.queue_udp(address, notice)
+        if multicast:
+            self.queue_multicast(delta)
+
+        # Only now that every client has been told may envelopes omit the names
+        for username in left:
+            self.announced_ids.pop(username, None)
+        self.announced_ids.update(joined_ids)
+
+    def tick(self):
+        """Periodic housekeeping, called every tick_interval by the engine"""
+        self.flush_presence()
+        self.reap_udp_sessions()
+        self.retransmit_udp()
+        self.pump_mailboxes()
+        self.rate_limiter.sweep()
+        self.log_stats()
+
+    def log_stats(self):
+        """Log the metrics summary line every stats_interval seconds"""
+        now = time.monotonic()
+        if self.stats_interval and now - self.stats_logged >= self.stats_interval:
+            self.stats_logged = now
+            logging.info(self.metrics.summary_line())
+
+    def queue_depths(self):
+        """Current backlog of the outbound queues, mailbox deliveries and history"""
+        pending = [session.outbound.pending_bytes for session in self.tcp_clients.values()]
+        return {
+            "tcp_clients": len(pending),
+            "udp_clients": len(self.udp_clients),
+            "tcp_queued_bytes": sum(pending),
+            "tcp_max_queued_bytes": max(pending, default=0),
+            "tcp_congested": sum(pending_bytes > self.high_watermark
+                                 for pending_bytes in pending),
+            "udp_queued_datagrams": len(self.udp_outbound.datagrams),
+            "udp_reliable_backlog": sum(len(channel.backlog)
+                                        for channel in list(self.udp_reliable.values())),
+            "mailbox_deliveries": len(self.mailbox_deliveries),
+            "history_pending_bytes": self.history.pending_bytes if self.history else 0,
+        }
+
+    def touch_udp_session(self, address):
+        """Record that a registered UDP client was heard from"""
+        if not self.udp_session_timeout:
+            return
+
+        now = time.monotonic()
+        if address not in self.udp_last_seen:
+            self.udp_expiry.schedule(address, now + self.udp_session_timeout)
+        self.udp_last_seen[address] = now
+
+    def reap_udp_sessions(self):
+        """Remove the UDP clients that missed too many heartbeats.
+
+        Returns the number of sessions reaped.
+        """
+        if not self.udp_session_timeout:
+            return 0
+
+        now = time.monotonic()
+        reaped = 0
+        for address in self.udp_expiry.advance(now):
+            last_seen = self.udp_last_seen.get(address)
+            if last_seen is None:
+                continue
+
+            deadline = last_seen + self.udp_session_timeout
+            if deadline > now:
+                # Heard from since it was scheduled
+                self.udp_expiry.schedule(address, deadline)
+                continue
+
+            logging.info(f"UDP session expired: {address}")
+            self.remove_udp_client(address)
+            reaped += 1
+
+        self.stats['udp_sessions_reaped'] += reaped
+        return reaped
+
+    def run_housekeeping(self):
+        """Call tick() periodically (threaded engine)"""
+        while True:
+            time.sleep(self.tick_interval)
             try:
-                client_socket.send(user_list_msg.encode('utf-8'))
-            except:
-                pass
+                self.tick()
+            except Exception as e:
+                logging.error(f"Housekeeping error: {str(e)}")
 
-        # Send to all UDP clients
-        for address in self.udp_clients:
+    def configure_tcp_client(self, client_socket):
+        """Set the options of an accepted TCP connection"""
+        if self.tcp_nodelay and client_socket.family != socket.AF_UNIX:
+            # Writes are coalesced here, the kernel must not hold them back
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def write_tcp_client(self, client_socket, outbound, coalesce):
+        """Drain a TCP client's outbound queue (threaded engine), several
+        buffers per write if coalesce is set"""
+        try:
+            while outbound.wait():
+                if self.flush_delay:
+                    # Let a burst build up until the oldest byte's deadline
+                    delay = outbound.queued_at + self.flush_delay - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                written = send_front(client_socket, outbound, coalesce)
+                if written:
+                    self.stats['tcp_writes'] += 1
+                    self.stats['tcp_buffers_written'] += written
+        except OSError:
+            # The reader thread notices the shutdown and removes the client
+            self.disconnect_tcp(client_socket)
+
+    def write_udp(self):
+        """Drain the UDP outbound queue (threaded engine)"""
+        while True:
+            self.udp_outbound.wait()
+            data, address = self.udp_outbound.front()
             try:
-                self.udp_socket.sendto(user_list_msg.encode('utf-8'), address)
-            except:
-                pass
+                self.datagram_socket(address).sendto(data, address)
+            except OSError as e:
+                logging.error(f"UDP send error to {address}: {str(e)}")
+            self.udp_outbound.pop()
+
+    def datagram_socket(self, address):
+        """The socket datagrams to address are sent from: the Unix datagram
+        socket for a socket path, else the UDP socket"""
+        return self.unix_datagram_socket if isinstance(address, str) else self.udp_socket
+
+    def retransmit_udp(self):
+        """Resend unacknowledged reliable datagrams, dropping unreachable clients"""
+        now = time.monotonic()
+        for address, channel in list(self.udp_reliable.items()):
+            datagrams = channel.poll(now)
+            if channel.failed:
+                logging.info(f"Reliable UDP client stopped acknowledging: {address}")
+                self.remove_udp_client(address)
+                continue
+            self.transmit_udp(datagrams, address)
 
     def remove_tcp_client(self, client_socket):
         """Remove a TCP client and update user lists"""
-        if client_socket in self.tcp_clients:
-            username = self.tcp_clients[client_socket]['username']
+        # Remove from mappings, once even if both engines' paths race here
+        session = self.registry.remove_tcp(client_socket)
+        if session is not None:
+            username = session.username
 
-            # Remove from mappings
-            del self.tcp_clients[client_socket]
-            if username in self.username_to_tcp_socket:
-                del self.username_to_tcp_socket[username]
+            # Stop the writer and drop whatever it had not sent yet
+            session.outbound.close()
+            self.release_paused_publishers(session)
+            self.leave_channels(client_socket)
 
             # Update online users if the user is not connected via UDP
-            if username not in self.username_to_udp_address:
-                self.online_users.discard(username)
-                self.broadcast_user_list()
+            changed = (not self.user_connected(username)
+                       and self.user_offline(username))
 
             # Inform other clients
-            self.broadcast_tcp(f"SERVER: {username} left the chat!")
+            self.announce_presence('left', username,
+                                   f"SERVER: {username} left the chat!",
+                                   changed, udp=False)
             logging.info(f"TCP client disconnected: {username}")
 
     def remove_udp_client(self, address):
         """Remove a UDP client and update user lists"""
-        if address in self.udp_clients:
-            username = self.udp_clients[address]
-
-            # Remove from mappings
-            del self.udp_clients[address]
-            if username in self.username_to_udp_address:
-                del self.username_to_udp_address[username]
+        self.udp_reliable.pop(address, None)
+        self.udp_last_seen.pop(address, None)
+        self.udp_expiry.cancel(address)
+        self.leave_channels(address)
+
+        # Remove from mappings
+        removed = self.registry.remove_udp(address)
+        if removed is not None:
+            session, current = removed
+            username = session.username
+            if not current:
+                # Stale session of a user who registered again from elsewhere
+                logging.info(f"UDP session replaced: {username} at {address}")
+                return
 
             # Update online users if the user is not connected via TCP
-            if username not in self.username_to_tcp_socket:
-                self.online_users.discard(username)
-                self.broadcast_user_list()
+            changed = (not self.user_connected(username)
+                       and self.user_offline(username))
 
             # Inform other clients
-            self.broadcast_udp(f"SERVER: {username} left the chat!")
+            self.announce_presence('left', username,
+                                   f"SERVER: {username} left the chat!",
+                                   changed, tcp=False)
             logging.info(f"UDP client disconnected: {username}")
 
-    def send_private_message_tcp(self, from_username, to_username, message_content):
-        """Send a private message to a TCP client"""
-        if to_username in self.username_to_tcp_socket:
-            try:
-                formatted_msg = json.dumps({
-                    "type": "private",
-                    "from": from_username,
-                    "message": message_content
-                })
-                self.username_to_tcp_socket[to_username].send(
-                    formatted_msg.encode('utf-8'))
-                return True
-            except:
-                logging.error(
-                    f"Failed to send private message to TCP user {to_username}")
-                return False
+    def send_private_message(self, from_username, to_username, message_content,
+                             received=None):
+        """Send a private message to a user connected here, over TCP if they can get it"""
+        session = self.registry.route(to_username)
+        if session is None:
+            return False
+
+        delivery = self.metrics.track('private', received)
+        encoded = self.encode(json.dumps({
+            "type": "private",
+            "from": from_username,
+            "message": message_content
+        }), delivery=delivery, sender=from_username)
+        if session.protocol == TCP:
+            sent = self.queue_tcp(session.endpoint, encoded)
+        else:
+            sent = self.queue_udp(session.endpoint, encoded)
+        if delivery is not None:
+            delivery.seal()
+        if not sent:
+            logging.error(
+                f"Failed to send private message to {session.protocol} user {to_username}")
+        return sent
+
+    def route_private_message(self, from_username, to_username, message_content,
+                              received=None):
+        """Deliver a private message to the recipient's session here, else through the node holding them"""
+        sent = self.send_private_message(from_username, to_username, message_content,
+                                         received)
+
+        nodes = self.remote_users.get(to_username)
+        if not sent and self.bus and nodes:
+            self.bus.publish({
+                "op": "private", "from": from_username, "to": to_username,
+                "message": message_content
+            }, to_node=min(nodes))
+            sent = True
+
+        if sent:
+            self.record_private(from_username, to_username, message_content)
+        return sent
+
+    def store_private_message(self, from_username, to_username, message_content):
+        """Keep a private message for an offline user, returning False if refused"""
+        if self.mailbox is None or not to_username:
+            return False
+
+        message = json.dumps({
+            "type": "private",
+            "from": from_username,
+            "message": message_content,
+            "sent_at": round(time.time(), 3)
+        })
+        if not self.mailbox.put(to_username, message):
+            return False
+
+        log_chat(message_logger, "Private message from %s to %s stored until they connect",
+                 from_username, to_username)
+        self.record_private(from_username, to_username, message_content)
+        return True
+
+    def deliver_mailbox(self, member, username):
+        """Start streaming the messages stored for a user who just connected"""
+        if self.mailbox is not None and username in self.mailbox:
+            self.start_mailbox_delivery(member, username, self.mailbox.take(username))
+
+    def start_mailbox_delivery(self, member, username, entries):
+        """Queue (expires, message) pairs for a TCP socket or UDP address"""
+        if not entries:
+            return
+
+        with self.mailbox_lock:
+            delivery = self.mailbox_deliveries.get(member)
+            if delivery is None:
+                self.mailbox_deliveries[member] = (username, collections.deque(entries))
+            else:
+                delivery[1].extend(entries)
+
+        logging.info(f"Delivering {len(entries)} stored messages to {username}")
+        self.pump_mailbox(member)
+
+    def pump_mailboxes(self):
+        """Continue the mailbox deliveries and drop expired stored messages"""
+        for member in list(self.mailbox_deliveries):
+            self.pump_mailbox(member)
+
+        now = time.monotonic()
+        if self.mailbox is not None and now - self.mailbox_swept >= MAILBOX_SWEEP_INTERVAL:
+            self.mailbox_swept = now
+            self.mailbox.expire()
+
+    def pump_mailbox(self, member):
+        """Send the next part of a mailbox delivery.
+
+        Framed TCP clients get up to MAILBOX_CHUNK_BYTES of messages per
+        write, as long as their queue stays below the low watermark so the
+        burst never triggers backpressure; UDP clients get a bounded number
+        of datagrams per tick. What a client that left did not get goes
+        back to the mailbox.
+        """
+        with self.mailbox_lock:
+            delivery = self.mailbox_deliveries.get(member)
+            if delivery is None:
+                return
+            username, entries = delivery
+
+            delivered = 0
+            session = self.tcp_clients.get(member)
+            if session is not None and not session.outbound.closed:
+                outbound = session.outbound
+                while entries and outbound.pending_bytes < self.low_watermark:
+                    if session.decoder is None:
+                        # Legacy clients read one JSON message per segment
+                        encoded = EncodedMessage(entries.popleft()[1])
+                        delivered += 1
+                    else:
+                        messages, size = [], 0
+                        while entries and size < MAILBOX_CHUNK_BYTES:
+                            messages.append(entries.popleft()[1])
+                            size += len(messages[-1])
+                        encoded = EncodedBatch(messages)
+                        delivered += len(messages)
+                    if not self.queue_tcp(member, encoded):
+                        break
+
+            elif member in self.udp_clients:
+                for _ in range(min(len(entries), MAILBOX_DATAGRAMS_PER_TICK)):
+                    self.queue_udp(member, EncodedMessage(entries.popleft()[1]))
+                    delivered += 1
+
+            else:
+                # The recipient left before getting everything
+                if self.mailbox is not None:
+                    self.mailbox.restore(username, list(entries))
+                entries.clear()
+
+            self.stats['mailbox_delivered'] += delivered
+            if not entries:
+                del self.mailbox_deliveries[member]
+
+    def record_history(self, key, message):
+        """Append a formatted message to the history of a conversation"""
+        if self.history:
+            self.history.append(key, message.encode('utf-8'))
+
+    def record_private(self, from_username, to_username, message_content):
+        """Append a private message to the history of its two users"""
+        if self.history:
+            self.record_history(private_history_key(from_username, to_username), json.dumps({
+                "type": "private",
+                "from": from_username,
+                "to": to_username,
+                "message": message_content
+            }))
+
+    def process_history_request(self, member, username, message_data, reply,
+                                max_bytes=None):
+        """Answer a history request with the last messages of a conversation.
+
+        The conversation is the channel named in 'channel', the private one
+        with the user named in 'with', or else the public room. 'limit' caps
+        the number of messages, and 'after' asks for the ones following that
+        sequence number instead of the last ones. Replies above max_bytes
+        leave out their oldest messages.
+        """
+        if self.history is None:
+            reply(json.dumps({
+                "type": "error",
+                "message": "History is not enabled on this server."
+            }))
+            return
+
+        channel = message_data.get('channel')
+        other = message_data.get('with')
+        if not isinstance(channel, (str, type(None))) or not isinstance(other, (str, type(None))):
+            reply(json.dumps({
+                "type": "error",
+                "message": "Invalid history request."
+            }))
+            return
+
+        response = {"type": "history"}
+        if channel is not None:
+            if not self.channels.is_member(channel, member):
+                reply(json.dumps({
+                    "type": "error",
+                    "message": f"You are not in channel {channel}."
+                }))
+                return
+            key = f"#{channel}"
+            response['channel'] = channel
+        elif other:
+            key = private_history_key(username, other)
+            response['with'] = other
+        else:
+            key = PUBLIC_HISTORY
+
+        try:
+            limit = min(max(int(message_data.get('limit', DEFAULT_HISTORY_LIMIT)), 1),
+                        MAX_HISTORY_LIMIT)
+            after = message_data.get('after')
+            after = int(after) if after is not None else None
+        except (TypeError, ValueError):
+            reply(json.dumps({
+                "type": "error",
+                "message": "Invalid history request."
+            }))
+            return
+
+        # Stored messages are JSON objects already, splice their sequence number in
+        messages = [f'{{"seq": {seq}, {payload[1:].decode("utf-8")}'
+                    for seq, payload in self.history.read(key, limit, after)]
+        if max_bytes is not None:
+            size = sum(len(message) + 2 for message in messages)
+            oldest = 0
+            while oldest < len(messages) and size > max_bytes:
+                size -= len(messages[oldest]) + 2
+                oldest += 1
+            if oldest:
+                messages = messages[oldest:]
+                response['truncated'] = True
+
+        reply(f'{json.dumps(response)[:-1]}, "messages": [{", ".join(messages)}]}}')
+
+    def forward_public(self, message):
+        """Hand a public message to the other workers or cluster nodes"""
+        if self.bus:
+            self.bus.publish({"op": "public", "message": message})
+
+    def process_channel_request(self, member, username, message_data, reply):
+        """Handle a join, leave or list request; reply sends a message back to member"""
+        message_type = message_data.get('type')
+
+        if message_type == 'list':
+            counts = self.channels.counts()
+            names = set(counts) | set(self.remote_channels)
+            reply(json.dumps({
+                "type": "channel_list",
+                "channels": [{"name": name, "members": counts.get(name, 0)}
+                             for name in sorted(names)],
+                "joined": self.channels.subscriptions(member)
+            }))
+            return
+
+        channel = message_data.get('channel')
+        if not valid_channel_name(channel):
+            reply(json.dumps({
+                "type": "error",
+                "message": "Invalid channel name."
+            }))
+            return
+
+        if message_type == 'join':
+            if self.channels.join(channel, member):
+                self.channel_opened(channel)
+            logging.info(f"{username} joined channel {channel}")
+            reply(json.dumps({"type": "joined", "channel": channel}))
+        else:
+            if self.channels.leave(channel, member):
+                self.channel_closed(channel)
+            logging.info(f"{username} left channel {channel}")
+            reply(json.dumps({"type": "left", "channel": channel}))
+
+    def publish_channel_message(self, member, username, message_data, reply,
+                                received=None):
+        """Fan a chat message out to the members of its channel, here and on other nodes"""
+        channel = message_data.get('channel')
+        if not self.channels.is_member(channel, member):
+            reply(json.dumps({
+                "type": "error",
+                "message": f"You are not in channel {channel}."
+            }))
+            return
+
+        formatted_msg = json.dumps({
+            "type": "public",
+            "from": username,
+            "channel": channel,
+            "message": message_data.get('message', '')
+        })
+        log_chat(message_logger, "Channel message from %s to %s", username, channel,
+                 body=message_data.get('message', ''))
+
+        self.record_history(f"#{channel}", formatted_msg)
+        delivery = self.metrics.track('channel', received)
+        self.broadcast_channel(channel, formatted_msg, member, delivery, username)
+        if delivery is not None:
+            delivery.seal()
+        if self.bus:
+            for node in sorted(self.remote_channels.get(channel, ())):
+                self.bus.publish({"op": "channel", "channel": channel,
+                                  "message": formatted_msg}, to_node=node)
+
+    def channel_opened(self, channel):
+        """Tell the other nodes this one now has members in channel"""
+        if self.bus:
+            self.bus.publish({"op": "subscribe", "channel": channel})
+
+    def channel_closed(self, channel):
+        """Tell the other nodes this one has no members left in channel"""
+        if self.bus:
+            self.bus.publish({"op": "unsubscribe", "channel": channel})
+
+    def leave_channels(self, member):
+        """Unsubscribe a disconnected client from all its channels"""
+        for channel in self.channels.remove(member):
+            self.channel_closed(channel)
+
+    def remote_channel(self, node, channel, subscribed):
+        """Track whether another node has members in a channel"""
+        nodes = self.remote_channels.setdefault(channel, set())
+        if subscribed:
+            nodes.add(node)
+        else:
+            nodes.discard(node)
+        if not nodes:
+            del self.remote_channels[channel]
+
+    def join_bus(self, path, worker):
+        """Link this process to the other workers through the broker at path"""
+        self.bus = WorkerBus(path, worker, self.receive_bus_message,
+                             self.leave_bus)
+
+    def join_cluster(self, node, port, peers, secret, host=DEFAULT_CLUSTER_HOST):
+        """Link this server to the other cluster nodes, listening on host:port.
+
+        Only nodes proving they know the same secret are linked with.
+        """
+        if not secret:
+            raise ValueError("A cluster needs a shared secret")
+        self.bus = ClusterBus(node, host, port, peers, self.receive_bus_message, secret)
+
+    def leave_bus(self):
+        """Stop the worker once its supervisor is gone"""
+        # Other workers may already be serving our port without us
+        logging.error("Supervisor gone, worker exiting")
+        os._exit(1)
+
+    def receive_bus_message(self, message):
+        """Handle a bus message on the thread owning the server state"""
+        if self.engine:
+            self.engine.call_soon(self.process_bus_message, message)
+        else:
+            self.process_bus_message(message)
+
+    def process_bus_message(self, message):
+        """Apply a message from another worker or cluster node"""
+        problem = bus_message_problem(message)
+        if problem:
+            logging.error(f"Dropped bus message: {problem}")
+            return
+
+        op = message.get('op')
+        node = message.get('node')
+
+        if op == 'hello':
+            # A node (re)joined, tell it who is connected here
+            self.bus.publish(self.sync_message(), to_node=node)
+
+        elif op == 'rejoined':
+            # Our bus connection was dropped: forget the other nodes, which
+            # were told we were gone, and tell them who is connected here
+            nodes = set()
+            for node_set in list(self.remote_users.values()) + list(self.remote_channels.values()):
+                nodes |= node_set
+            for gone in nodes:
+                self.process_bus_message({"op": "gone", "node": gone})
+            self.bus.publish(self.sync_message())
+
+        elif op == 'sync':
+            # The node's full state: whatever else we had for it is stale
+            users = set(message.get('users', []))
+            channels = set(message.get('channels', []))
+            for username, nodes in list(self.remote_users.items()):
+                if node in nodes and username not in users:
+                    self.remote_presence(node, 'left', username, False,
+                                         f"SERVER: {username} left the chat!")
+            for channel, nodes in list(self.remote_channels.items()):
+                if node in nodes and channel not in channels:
+                    self.remote_channel(node, channel, False)
+            for username in message.get('users', []):
+                self.remote_presence(node, 'joined', username, True)
+            for channel in message.get('channels', []):
+                self.remote_channel(node, channel, True)
+
+        elif op == 'presence':
+            self.remote_presence(node, message['action'], message['user'],
+                                 message['present'], message.get('notice'),
+                                 message.get('tcp', True), message.get('udp', True))
+
+        elif op == 'gone':
+            # The node died or lost its link, with its users
+            for username, nodes in list(self.remote_users.items()):
+                if node in nodes:
+                    self.remote_presence(node, 'left', username, False,
+                                         f"SERVER: {username} left the chat!")
+            for channel in list(self.remote_channels):
+                self.remote_channel(node, channel, False)
+
+        elif op == 'public':
+            self.record_history(PUBLIC_HISTORY, message['message'])
+            self.broadcast(message['message'], public=True)
+
+        elif op in ('subscribe', 'unsubscribe'):
+            self.remote_channel(node, message['channel'], op == 'subscribe')
+
+        elif op == 'channel':
+            self.record_history(f"#{message['channel']}", message['message'])
+            self.broadcast_channel(message['channel'], message['message'])
+
+        elif op == 'mailbox':
+            entries = [tuple(entry) for entry in message['messages']]
+            session = self.registry.route(message['to'])
+            if session is not None:
+                self.start_mailbox_delivery(session.endpoint, message['to'], entries)
+            elif self.mailbox is not None:
+                self.mailbox.restore(message['to'], entries)
+
+        elif op == 'private':
+            self.send_private_message(message['from'], message['to'], message['message'])
+            self.record_private(message['from'], message['to'], message['message'])
+
+    def sync_message(self):
+        """The users and channels of this node, for a node that (re)joined"""
+        return {"op": "sync", "users": sorted(self.registry.usernames()),
+                "channels": sorted(self.channels.counts())}
+
+    def remote_presence(self, node, action, username, present, notice=None,
+                        tcp=True, udp=True):
+        """Track a user joining or leaving another node and announce it here"""
+        nodes = self.remote_users.setdefault(username, set())
+        if present:
+            nodes.add(node)
+        else:
+            nodes.discard(node)
+        if not nodes:
+            del self.remote_users[username]
+
+        if present:
+            changed = self.user_online(username)
+        elif self.user_connected(username):
+            changed = False
+        else:
+            changed = self.user_offline(username)
+
+        self.announce_presence(action, username, notice, changed, tcp, udp,
+                               local=False)
+
+        if (present and self.mailbox is not None and username in self.mailbox
+                and not self.user_connected(username)):
+            # Hand what was stored here to the node the user connected to
+            self.bus.publish({"op": "mailbox", "to": username,
+                              "messages": self.mailbox.take(username)}, to_node=node)
+
+    def admit(self, member, username, ip, message_data, reply):
+        """Apply the rate limits to a client message before it is handled.
+
+        Returns False if the message is to be dropped, after telling the
+        client it is throttled (at most once per second).
+        """
+        message_type = message_data.get('type')
+        if message_type == 'private':
+            traffic_class = 'private'
+        elif message_type in CONTROL_TYPES:
+            traffic_class = 'control'
+        else:
+            traffic_class = 'public'
+
+        if self.rate_limiter.allow(traffic_class, username, ip):
+            return True
+
+        if self.rate_limiter.should_notify(member):
+            reply(json.dumps({
+                "type": "error",
+                "throttled": traffic_class,
+                "message": f"You are sending {traffic_class} messages too fast, "
+                           f"some were dropped. Please slow down."
+            }))
         return False
 
-    def send_private_message_udp(self, from_username, to_username, message_content):
-        """Send a private message to a UDP client"""
-        if to_username in self.username_to_udp_address:
+    def register_tcp_client(self, client_socket, address, username_info):
+        """Register a TCP client from its initial username message"""
+        username = username_info['username']
+
+        # Old clients send bare JSON messages, newer ones ask for framing
+        decoder = None
+        if username_info.get('framing') == 'length':
+            decoder = FrameDecoder()
+
+        # Framed clients may also ask for the binary codec and compression
+        binary = decoder is not None and username_info.get('codec') == BINARY_CODEC
+        compressed = (decoder is not None and self.compressor is not None
+                      and username_info.get('compression') == ZLIB_COMPRESSION)
+
+        # Outbound queue with this server's backpressure thresholds
+        outbound = OutboundQueue(self.max_outbound_bytes,
+                                 self.high_watermark, self.low_watermark)
+        outbound.on_drained = functools.partial(
+            self.release_publishers, client_socket)
+
+        # Reading is paused while 'pauses' > 0 ('readable' is cleared for the threaded engine)
+        readable = threading.Event()
+        readable.set()
+
+        # Store client info
+        self.registry.add(TcpSession(
+            client_socket, username, None, address, decoder=decoder,
+            outbound=outbound, readable=readable,
+            presence_deltas=username_info.get('presence') == 'delta', binary=binary,
+            compressed=compressed))
+
+        logging.info(f"New TCP connection: {username} from {address}")
+
+        # Send welcome message to the client, telling it whether history is
+        # kept, which codec it may send in and whether it may compress
+        self.send_tcp(client_socket, json.dumps({
+            "type": "server",
+            "message": f"Welcome {username}! You are connected via TCP.",
+            "user_id": self.registry.user_id(username),
+            "history": self.history is not None,
+            "codec": BINARY_CODEC if binary else JSON_CODEC,
+            "compression": ZLIB_COMPRESSION if compressed else None
+        }))
+
+        # Send the user list, with the user in it, then announce the user
+        changed = self.user_online(username)
+        self.queue_tcp(client_socket, self.user_list_snapshot())
+        self.announce_presence('joined', username,
+                               f"SERVER: {username} joined via TCP!",
+                               changed, udp=False, exclude=client_socket)
+
+        # Private messages sent while the user was offline
+        self.deliver_mailbox(client_socket, username)
+
+        return username
+
+    def receive_tcp_data(self, client_socket, data):
+        """Decode and route every complete message in data from a TCP client"""
+        received = time.monotonic()
+        decoder = self.tcp_clients[client_socket].decoder
+
+        # Legacy clients send one JSON message per segment
+        messages = decoder.feed(data) if decoder else [data]
+
+        for message in messages:
             try:
-                formatted_msg = json.dumps({
-                    "type": "private",
-                    "from": from_username,
-                    "message": message_content
+                self.process_tcp_message(client_socket, message, received)
+            except ValueError:
+                # Neither JSON nor a binary message
+                continue
+
+    def decompress(self, data):
+        """Inflate a compressed message from a client, counting the time spent"""
+        if not is_compressed(data):
+            return data
+        began = time.perf_counter()
+        data = decompress(data)
+        self.stats['decompressed_messages'] += 1
+        self.stats['decompression_us'] += int((time.perf_counter() - began) * 1e6)
+        return data
+
+    def process_tcp_message(self, client_socket, data, received=None):
+        """Route a single message received from a registered TCP client"""
+        session = self.tcp_clients[client_socket]
+        session.messages_in += 1
+        username = session.username
+
+        message_data = decode_message(self.decompress(data))
+        if not isinstance(message_data, dict):
+            raise ValueError("Not a request")
+        self.metrics.received(TCP, message_data.get('type', 'message'), len(data))
+
+        if not self.admit(client_socket, username, session.address[0], message_data,
+                          functools.partial(self.send_tcp, client_socket)):
+            return
+
+        # Handle different message types
+        if message_data.get('type') == 'presence_sync':
+            # Client missed a presence update, resend the full list
+            self.queue_tcp(client_socket, self.user_list_snapshot())
+
+        elif message_data.get('type') == 'private':
+            # Private message
+            to_username = message_data.get('to')
+            msg_content = message_data.get('message')
+
+            log_chat(message_logger, "Private message from %s to %s", username, to_username,
+                     body=msg_content)
+
+            # Try to send via TCP first, then UDP, then other nodes, else keep it
+            sent = self.route_private_message(username, to_username, msg_content,
+                                              received)
+            stored = not sent and self.store_private_message(
+                username, to_username, msg_content)
+
+            # Send confirmation to sender
+            if sent or stored:
+                confirm_msg = json.dumps({
+                    "type": "private_sent",
+                    "to": to_username,
+                    "message": msg_content,
+                    "stored": stored
                 })
-                self.udp_socket.sendto(formatted_msg.encode(
-                    'utf-8'), self.username_to_udp_address[to_username])
-                return True
-            except:
-                logging.error(
-                    f"Failed to send private message to UDP user {to_username}")
-                return False
-        return False
+                self.send_tcp(client_socket, confirm_msg)
+            else:
+                error_msg = json.dumps({
+                    "type": "error",
+                    "message": f"User {to_username} is not online."
+                })
+                self.send_tcp(client_socket, error_msg)
+
+        elif message_data.get('type') in ('join', 'leave', 'list'):
+            self.process_channel_request(client_socket, username, message_data,
+                                         functools.partial(self.send_tcp, client_socket))
+
+        elif message_data.get('type') == 'history':
+            self.process_history_request(client_socket, username, message_data,
+                                         functools.partial(self.send_tcp, client_socket))
+
+        elif message_data.get('channel') is not None:
+            # Message to a channel
+            self.publish_channel_message(client_socket, username, message_data,
+                                         functools.partial(self.send_tcp, client_socket),
+                                         received)
+
+        else:  # Public message
+            formatted_msg = json.dumps({
+                "type": "public",
+                "from": username,
+                "message": message_data.get('message', '')
+            })
+
+            log_chat(message_logger, "Public message from %s", username,
+                     body=message_data.get('message', ''))
+
+            self.record_history(PUBLIC_HISTORY, formatted_msg)
+            delivery = self.metrics.track('public', received)
+
+            # Broadcast to all TCP and UDP clients
+            self.broadcast(formatted_msg, client_socket, public=True, delivery=delivery,
+                           sender=username)
+            if delivery is not None:
+                delivery.seal()
+            self.forward_public(formatted_msg)
 
     def handle_tcp_client(self, client_socket, address):
-        """Handle TCP client connection"""
+        """Handle TCP client connection (threaded engine)"""
         try:
-            # Get username
-            username_data = client_socket.recv(1024).decode('utf-8')
-            username_info = json.loads(username_data)
-            username = username_info['username']
-
-            # Store client info
-            self.tcp_clients[client_socket] = {
-                'username': username, 'address': address}
-            self.username_to_tcp_socket[username] = client_socket
-            self.online_users.add(username)
-
-            # Welcome message
-            welcome_msg = f"SERVER: {username} joined via TCP!"
-            logging.info(f"New TCP connection: {username} from {address}")
-            self.broadcast_tcp(welcome_msg, client_socket)
-
-            # Send welcome message to the client
-            client_socket.send(json.dumps({
-                "type": "server",
-                "message": f"Welcome {username}! You are connected via TCP."
-            }).encode('utf-8'))
-
-            # Send user list to all clients
-            self.broadcast_user_list()
+            # Get username, keeping anything pipelined behind it
+            buffer = b''
+            username_info = None
+            while username_info is None:
+                data = client_socket.recv(TCP_RECV_SIZE)
+                if not data:
+                    return
+                buffer += data
+                username_info, buffer = split_handshake(buffer)
+
+            self.register_tcp_client(client_socket, address, username_info)
+
+            session = self.tcp_clients[client_socket]
+
+            # Writes go through the outbound queue so slow readers never block
+            # senders, coalesced only for framed clients
+            threading.Thread(
+                target=self.write_tcp_client,
+                args=(client_socket, session.outbound, session.decoder is not None),
+                daemon=True).start()
+
+            if buffer:
+                self.receive_tcp_data(client_socket, buffer)
 
             while True:
                 try:
-                    data = client_socket.recv(1024)
+                    # Wait while backpressure paused this publisher
+                    session.readable.wait()
+
+                    data = client_socket.recv(TCP_RECV_SIZE)
                     if not data:
                         break
 
-                    message = data.decode('utf-8')
-                    message_data = json.loads(message)
-
-                    # Handle different message types
-                    if message_data.get('type') == 'private':
-                        # Private message
-                        to_username = message_data.get('to')
-                        msg_content = message_data.get('message')
-
-                        logging.info(
-                            f"Private message from {username} to {to_username}")
-
-                        # Try to send via TCP first, then UDP
-                        tcp_sent = self.send_private_message_tcp(
-                            username, to_username, msg_content)
-                        udp_sent = False
-                        if not tcp_sent:
-                            udp_sent = self.send_private_message_udp(
-                                username, to_username, msg_content)
-
-                        # Send confirmation to sender
-                        if tcp_sent or udp_sent:
-                            confirm_msg = json.dumps({
-                                "type": "private_sent",
-                                "to": to_username,
-                                "message": msg_content
-                            })
-                            client_socket.send(confirm_msg.encode('utf-8'))
-                        else:
-                            error_msg = json.dumps({
-                                "type": "error",
-                                "message": f"User {to_username} is not online."
-                            })
-                            client_socket.send(error_msg.encode('utf-8'))
-
-                    else:  # Public message
-                        formatted_msg = json.dumps({
-                            "type": "public",
-                            "from": username,
-                            "message": message_data.get('message', '')
-                        })
-
-                        logging.info(
-                            f"Public message from {username}: {message_data.get('message', '')}")
-
-                        # Broadcast to all TCP clients
-                        self.broadcast_tcp(formatted_msg, client_socket)
+                    self.receive_tcp_data(client_socket, data)
 
-                        # Also broadcast to UDP clients
-                        self.broadcast_udp(formatted_msg)
-
-                except json.JSONDecodeError:
-                    continue
                 except Exception as e:
                     logging.error(f"TCP client error: {str(e)}")
                     break
@@ -251,147 +1614,539 @@ class ChatServer:
             self.remove_tcp_client(client_socket)
             client_socket.close()
 
-    def handle_udp(self):
-        """Handle UDP messages"""
+    def process_udp_datagram(self, data, address):
+        """Route a single datagram received on the UDP socket"""
+        received = time.monotonic()
+
+        if not address:
+            # Unix datagram client without a path of its own, cannot be answered
+            return
+
+        # Any datagram from a registered client proves it is alive
+        if address in self.udp_clients or address in self.udp_reliable:
+            self.touch_udp_session(address)
+
+        if not is_reliable(data):
+            self.process_udp_message(data, address, received)
+            return
+
+        channel = self.udp_reliable.get(address)
+        if channel is None:
+            if data[0] != DATA:
+                return
+            # Expires like a session if the client never registers
+            channel = self.udp_reliable[address] = ReliableChannel(self.stats)
+            self.touch_udp_session(address)
+
+        messages, datagrams = channel.receive(data)
+        self.transmit_udp(datagrams, address)
+        for message in messages:
+            self.process_udp_message(message, address, received)
+
+    def process_udp_message(self, data, address, received=None):
+        """Route one message from a UDP client"""
+        try:
+            message_data = decode_message(self.decompress(data))
+            if not isinstance(message_data, dict):
+                raise ValueError("Not a request")
+            message_type = message_data.get('type', '')
+            self.metrics.received(UDP, message_type, len(data))
+
+            # Unregistered addresses only have the budget of their IP
+            session = self.udp_clients.get(address)
+            if not self.admit(address, session.username if session is not None else None,
+                              peer_ip(address), message_data,
+                              lambda reply: self.send_udp(reply, address)):
+                return
+
+            if message_type == 'register':
+                # New UDP client registration
+                username = message_data['username']
+
+                # A client registering again under the same name, e.g. to
+                # give up multicast, is not announced a second time
+                previous = self.udp_clients.get(address)
+                rejoined = previous is not None and previous.username == username
+
+                # Store client info
+                binary = message_data.get('codec') == BINARY_CODEC
+                compressed = (self.compressor is not None
+                              and message_data.get('compression') == ZLIB_COMPRESSION)
+                presence_deltas = message_data.get('presence') == 'delta'
+
+                # Group datagrams are binary, compressed like the server's,
+                # and cannot be retransmitted to reliable clients
+                multicast = (self.multicast_address is not None
+                             and message_data.get('multicast') is True
+                             and binary and presence_deltas
+                             and compressed == (self.compressor is not None)
+                             and address not in self.udp_reliable
+                             and not isinstance(address, str))
+                self.registry.add(UdpSession(
+                    address, username, None, presence_deltas=presence_deltas,
+                    binary=binary, compressed=compressed, multicast=multicast))
+                self.touch_udp_session(address)
+
+                logging.info(
+                    f"New UDP client: {username} from {address}")
+
+                # Welcome the new client, telling it whether history is kept
+                self.send_udp(
+                    json.dumps({
+                        "type": "server",
+                        "message": f"Welcome {username}! You are connected via UDP.",
+                        "user_id": self.registry.user_id(username),
+                        "history": self.history is not None,
+                        "codec": BINARY_CODEC if binary else JSON_CODEC,
+                        "compression": ZLIB_COMPRESSION if compressed else None,
+                        "multicast": list(self.multicast_address) if multicast else None
+                    }),
+                    address
+                )
+
+                # Send the user list, with the user in it, then announce the user
+                changed = self.user_online(username)
+                self.queue_udp(address, self.user_list_snapshot())
+                if not rejoined:
+                    self.announce_presence('joined', username,
+                                           f"SERVER: {username} joined via UDP!",
+                                           changed, exclude=address)
+
+                # Private messages sent while the user was offline
+                self.deliver_mailbox(address, username)
+
+            elif message_type == 'presence_sync':
+                # Client missed a presence update, resend the full list
+                if address in self.udp_clients:
+                    self.queue_udp(address, self.user_list_snapshot())
+
+            elif message_type == 'heartbeat':
+                # Client is still alive
+                if address in self.udp_clients:
+                    # If this is a reconnection, update the mapping
+                    username = message_data.get('username')
+                    if username and self.udp_clients[address].username != username:
+                        old_username = self.registry.rename_udp(address, username)
+
+                        # Update online users
+                        if (not self.user_connected(old_username)
+                                and self.user_offline(old_username)):
+                            self.announce_presence('left', old_username, changed=True)
+                        if self.user_online(username):
+                            self.announce_presence('joined', username, changed=True)
+                else:
+                    # Session was reaped while the client was unreachable;
+                    # ChatClient registers again when told it expired
+                    self.send_udp(json.dumps({
+                        "type": "error",
+                        "message": "Your UDP session expired. Please reconnect.",
+                        "expired": True
+                    }), address)
+
+            elif message_type in ('join', 'leave', 'list'):
+                if address in self.udp_clients:
+                    self.process_channel_request(
+                        address, self.udp_clients[address].username, message_data,
+                        lambda reply: self.send_udp(reply, address))
+
+            elif message_type == 'history':
+                if address in self.udp_clients:
+                    # Plain datagrams cannot carry a long history
+                    max_bytes = None if address in self.udp_reliable else UDP_HISTORY_BYTES
+                    self.process_history_request(
+                        address, self.udp_clients[address].username, message_data,
+                        lambda reply: self.send_udp(reply, address), max_bytes)
+
+            elif message_type == 'message' and message_data.get('channel') is not None:
+                # Message to a channel
+                if address in self.udp_clients:
+                    self.publish_channel_message(
+                        address, self.udp_clients[address].username, message_data,
+                        lambda reply: self.send_udp(reply, address), received)
+
+            elif message_type == 'message':
+                # Regular public message
+                if address in self.udp_clients:
+                    username = self.udp_clients[address].username
+                    formatted_msg = json.dumps({
+                        "type": "public",
+                        "from": username,
+                        "message": message_data.get('message', '')
+                    })
+
+                    log_chat(message_logger, "UDP public message from %s", username,
+                             body=message_data.get('message', ''))
+
+                    self.record_history(PUBLIC_HISTORY, formatted_msg)
+                    delivery = self.metrics.track('public', received)
+
+                    # Send to all clients
+                    self.broadcast(formatted_msg, address, public=True, delivery=delivery,
+                                   sender=username)
+                    if delivery is not None:
+                        delivery.seal()
+                    self.forward_public(formatted_msg)
+
+            elif message_type == 'private':
+                # Private message
+                if address in self.udp_clients:
+                    from_username = self.udp_clients[address].username
+                    to_username = message_data.get('to')
+                    msg_content = message_data.get('message')
+
+                    log_chat(message_logger, "UDP private message from %s to %s",
+                             from_username, to_username, body=msg_content)
+
+                    # Try to send via TCP first, then UDP, then other nodes, else keep it
+                    sent = self.route_private_message(
+                        from_username, to_username, msg_content, received)
+                    stored = not sent and self.store_private_message(
+                        from_username, to_username, msg_content)
+
+                    # Send confirmation to sender
+                    if sent or stored:
+                        confirm_msg = json.dumps({
+                            "type": "private_sent",
+                            "to": to_username,
+                            "message": msg_content,
+                            "stored": stored
+                        })
+                        self.send_udp(confirm_msg, address)
+                    else:
+                        error_msg = json.dumps({
+                            "type": "error",
+                            "message": f"User {to_username} is not online."
+                        })
+                        self.send_udp(error_msg, address)
+
+        except ValueError:
+            logging.warning(f"Invalid message from UDP client: {address}")
+
+    def handle_udp(self, udp_socket):
+        """Handle datagrams of the UDP or Unix datagram socket (threaded engine)"""
         while True:
             try:
-                data, address = self.udp_socket.recvfrom(1024)
-                message = data.decode('utf-8')
-
-                try:
-                    message_data = json.loads(message)
-                    message_type = message_data.get('type', '')
-
-                    if message_type == 'register':
-                        # New UDP client registration
-                        username = message_data['username']
-
-                        # Store client info
-                        self.udp_clients[address] = username
-                        self.username_to_udp_address[username] = address
-                        self.online_users.add(username)
-
-                        # Inform clients
-                        welcome_msg = f"SERVER: {username} joined via UDP!"
-                        logging.info(
-                            f"New UDP client: {username} from {address}")
-
-                        # Broadcast join message
-                        self.broadcast_tcp(welcome_msg)
-                        self.broadcast_udp(welcome_msg, address)
-
-                        # Welcome the new client
-                        self.udp_socket.sendto(
-                            json.dumps({
-                                "type": "server",
-                                "message": f"Welcome {username}! You are connected via UDP."
-                            }).encode('utf-8'),
-                            address
-                        )
-
-                        # Send user list to all clients
-                        self.broadcast_user_list()
-
-                    elif message_type == 'heartbeat':
-                        # Client is still alive
-                        if address in self.udp_clients:
-                            # If this is a reconnection, update the mapping
-                            username = message_data.get('username')
-                            if username and self.udp_clients[address] != username:
-                                old_username = self.udp_clients[address]
-                                self.udp_clients[address] = username
-                                self.username_to_udp_address[username] = address
-
-                                # Remove old mapping
-                                if old_username in self.username_to_udp_address:
-                                    del self.username_to_udp_address[old_username]
-
-                                # Update online users
-                                self.online_users.discard(old_username)
-                                self.online_users.add(username)
-                                self.broadcast_user_list()
-
-                    elif message_type == 'message':
-                        # Regular public message
-                        if address in self.udp_clients:
-                            username = self.udp_clients[address]
-                            formatted_msg = json.dumps({
-                                "type": "public",
-                                "from": username,
-                                "message": message_data.get('message', '')
-                            })
-
-                            logging.info(
-                                f"UDP public message from {username}: {message_data.get('message', '')}")
-
-                            # Send to all clients
-                            self.broadcast_udp(formatted_msg, address)
-                            self.broadcast_tcp(formatted_msg)
-
-                    elif message_type == 'private':
-                        # Private message
-                        if address in self.udp_clients:
-                            from_username = self.udp_clients[address]
-                            to_username = message_data.get('to')
-                            msg_content = message_data.get('message')
-
-                            logging.info(
-                                f"UDP private message from {from_username} to {to_username}")
-
-                            # Try to send via TCP first, then UDP
-                            tcp_sent = self.send_private_message_tcp(
-                                from_username, to_username, msg_content)
-                            udp_sent = False
-                            if not tcp_sent:
-                                udp_sent = self.send_private_message_udp(
-                                    from_username, to_username, msg_content)
-
-                            # Send confirmation to sender
-                            if tcp_sent or udp_sent:
-                                confirm_msg = json.dumps({
-                                    "type": "private_sent",
-                                    "to": to_username,
-                                    "message": msg_content
-                                })
-                                self.udp_socket.sendto(
-                                    confirm_msg.encode('utf-8'), address)
-                            else:
-                                error_msg = json.dumps({
-                                    "type": "error",
-                                    "message": f"User {to_username} is not online."
-                                })
-                                self.udp_socket.sendto(
-                                    error_msg.encode('utf-8'), address)
-
-                except json.JSONDecodeError:
-                    logging.warning(f"Invalid JSON from UDP client: {address}")
+                data, address = udp_socket.recvfrom(UDP_RECV_SIZE)
+                self.process_udp_datagram(data, address)
 
             except Exception as e:
                 logging.error(f"UDP error: {str(e)}")
 
-    def run(self):
-        """Start the server"""
+    def run(self, engine='threaded', loops=1):
+        """Start the server with the selected I/O engine"""
+        if engine == 'eventloop':
+            # Multiplex every socket in one (or a few) selector loops
+            self.engine = EventLoopEngine(self, loops)
+            if self.bus:
+                self.bus.start()
+            self.engine.serve_forever()
+            return
+
+        if self.bus:
+            self.bus.start()
+
         # Start UDP handler
-        udp_thread = threading.Thread(target=self.handle_udp)
+        udp_thread = threading.Thread(target=self.handle_udp, args=(self.udp_socket,))
         udp_thread.daemon = True
         udp_thread.start()
 
+        # and the Unix socket handlers
+        if self.unix_datagram_socket:
+            threading.Thread(target=self.handle_udp, args=(self.unix_datagram_socket,),
+                             daemon=True).start()
+        if self.unix_socket:
+            self.unix_socket.listen(5)
+            threading.Thread(target=self.accept_unix, daemon=True).start()
+
+        # Start UDP writer
+        threading.Thread(target=self.write_udp, daemon=True).start()
+
+        # Start periodic housekeeping
+        threading.Thread(target=self.run_housekeeping, daemon=True).start()
+
         # Start TCP listener
         self.tcp_socket.listen(5)
         logging.info("Server is running and listening for connections...")
 
         while True:
             client_socket, address = self.tcp_socket.accept()
+            self.configure_tcp_client(client_socket)
             client_thread = threading.Thread(
                 target=self.handle_tcp_client, args=(client_socket, address))
             client_thread.daemon = True
             client_thread.start()
 
+    def accept_unix(self):
+        """Accept clients of the Unix stream socket (threaded engine)"""
+        while True:
+            client_socket, _ = self.unix_socket.accept()
+            threading.Thread(target=self.handle_tcp_client,
+                             args=(client_socket, self.unix_address), daemon=True).start()
+
+
+def bind_unix(unix_socket, path):
+    """Bind a Unix socket to path, replacing the socket file a previous run left"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    unix_socket.bind(path)
+
+
+def peer_ip(address):
+    """The IP address of a UDP client, UNIX_PEER for a Unix datagram client"""
+    return UNIX_PEER if isinstance(address, str) else address[0]
+
+
+def bus_message_problem(message):
+    """What makes a bus message unusable, or None if it can be applied"""
+    if not isinstance(message, dict):
+        return "not an object"
+    op = message.get('op')
+    fields = BUS_FIELDS.get(op) if isinstance(op, str) else None
+    if fields is None:
+        return f"unknown op {op!r}"
+    if not isinstance(message.get('node'), (str, int, type(None))):
+        return f"{op}: bad node"
+
+    for field, kind in fields.items():
+        if not isinstance(message.get(field), kind):
+            return f"{op}: missing or bad {field}"
+    for field, kind in BUS_OPTIONAL_FIELDS.items():
+        if field in message and not isinstance(message[field], kind):
+            return f"{op}: bad {field}"
+
+    if op == 'presence' and message['action'] not in ('joined', 'left'):
+        return f"presence: bad action {message['action']!r}"
+    for field in ('users', 'channels'):
+        if not all(isinstance(name, str) for name in message.get(field, ())):
+            return f"{op}: bad {field}"
+    if op == 'mailbox' and not all(
+            isinstance(entry, list) and len(entry) == 2
+            and isinstance(entry[0], (int, float)) and isinstance(entry[1], str)
+            for entry in message['messages']):
+        return "mailbox: bad messages"
+    return None
+
+
+def private_history_key(username, other):
+    """Conversation key of the private messages between two users"""
+    return '@' + '\0'.join(sorted((username, other)))
+
+
+def run_worker(worker, bus_path, engine, loops, server_args, server_kwargs,
+               log_settings=None):
+    """Serve a share of the connections in a worker process"""
+    # A LogQueue holds a lock and a writer thread, so each worker builds its
+    # own from the settings rather than inheriting one, whatever the start method
+    if log_settings is not None:
+        LogQueue(*log_settings)
+
+    # Every worker keeps its own log and mailbox
+    for option in ('history_dir', 'mailbox_dir'):
+        if server_kwargs.get(option):
+            server_kwargs = dict(server_kwargs, **{option: os.path.join(
+                server_kwargs[option], f"worker-{worker}")})
+
+    # and serves its own stats and multicast group, on consecutive ports
+    if server_kwargs.get('stats_port') is not None:
+        server_kwargs = dict(server_kwargs, stats_port=server_kwargs['stats_port'] + worker)
+    if server_kwargs.get('multicast_group'):
+        server_kwargs = dict(server_kwargs,
+                             multicast_port=server_kwargs['multicast_port'] + worker)
+
+    # Unix sockets cannot be shared, each worker gets its own paths
+    for option in ('unix_path', 'unix_datagram_path'):
+        if server_kwargs.get(option):
+            server_kwargs = dict(server_kwargs, **{option: f"{server_kwargs[option]}.{worker}"})
+    try:
+        server = ChatServer(*server_args, reuse_port=True, **server_kwargs)
+        server.join_bus(bus_path, worker)
+        logging.info(f"Worker {worker} started (pid {os.getpid()})")
+        server.run(engine, loops)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(workers, engine, loops, server_args, server_kwargs, log_settings=None):
+    """Start worker processes sharing the server ports and relay their bus.
+
+    log_settings are the LogQueue arguments (level, queue_size, message_rate,
+    message_sample) each worker sets up its logging with.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("Multiple workers need SO_REUSEPORT support")
+
+    bus_dir = tempfile.mkdtemp(prefix='chatter-wave-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    broker = BusBroker(bus_path)
+
+    # Terminate the workers when stopped with SIGTERM as well as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    processes = []
+    for worker in range(workers):
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(worker, bus_path, engine, loops, server_args, server_kwargs, log_settings),
+            daemon=True)
+        process.start()
+        processes.append(process)
+
+    try:
+        broker.serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
 
 if __name__ == '__main__':
-    server = ChatServer()
+    parser = argparse.ArgumentParser(description="Chatter Wave server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--tcp-port', type=int, default=9090)
+    parser.add_argument('--udp-port', type=int, default=9091)
+    parser.add_argument('--engine', choices=['threaded', 'eventloop'], default='threaded',
+                        help="thread per TCP client, or selector-based event loop(s)")
+    parser.add_argument('--loops', type=int, default=1,
+                        help="number of event loops for the eventloop engine")
+    parser.add_argument('--backpressure', choices=BACKPRESSURE_POLICIES, default='drop_oldest',
+                        help="what to do with a TCP client above its high watermark")
+    parser.add_argument('--high-watermark', type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help="queued outbound bytes at which backpressure starts")
+    parser.add_argument('--low-watermark', type=int, default=DEFAULT_LOW_WATERMARK,
+                        help="queued outbound bytes at which backpressure ends")
+    parser.add_argument('--max-outbound', type=int, default=DEFAULT_MAX_BYTES,
+                        help="queued outbound bytes at which a TCP client is dropped")
+    parser.add_argument('--flush-delay', type=float, default=DEFAULT_FLUSH_DELAY,
+                        help="seconds queued data may wait for more before a TCP write (0 writes at once)")
+    parser.add_argument('--nagle', action='store_true',
+                        help="leave Nagle's algorithm on for TCP clients (default: TCP_NODELAY)")
+    parser.add_argument('--compression-threshold', type=int,
+                        default=DEFAULT_COMPRESSION_THRESHOLD,
+                        help="bytes from which messages are compressed for clients "
+                             "that ask for it (0 disables compression)")
+    parser.add_argument('--compression-level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="zlib compression level, 1 (fastest) to 9 (smallest)")
+    parser.add_argument('--presence-interval', type=float, default=DEFAULT_PRESENCE_INTERVAL,
+                        help="seconds over which join/leave notifications are coalesced (0 disables)")
+    parser.add_argument('--udp-heartbeat-interval', type=float,
+                        default=DEFAULT_UDP_HEARTBEAT_INTERVAL,
+                        help="seconds between two heartbeats of a UDP client")
+    parser.add_argument('--udp-missed-heartbeats', type=int,
+                        default=DEFAULT_UDP_MISSED_HEARTBEATS,
+                        help="missed heartbeats after which a UDP session is reaped (0 disables)")
+    parser.add_argument('--history-dir',
+                        help="directory of the message log serving history requests (default: no history)")
+    parser.add_argument('--mailbox-size', type=int, default=DEFAULT_MAX_MESSAGES,
+                        help="private messages kept per offline user (0 refuses them)")
+    parser.add_argument('--mailbox-bytes', type=int, default=DEFAULT_MAX_STORED_BYTES,
+                        help="bytes of stored private messages over all users")
+    parser.add_argument('--mailbox-ttl', type=float, default=DEFAULT_TTL,
+                        help="seconds a private message waits for an offline user")
+    parser.add_argument('--mailbox-dir',
+                        help="directory of the journal keeping stored messages across restarts")
+    parser.add_argument('--stats-port', type=int,
+                        help="serve metrics as JSON on http://127.0.0.1:PORT/stats")
+    parser.add_argument('--stats-interval', type=float, default=DEFAULT_SUMMARY_INTERVAL,
+                        help="seconds between two metrics summary lines in the log (0 disables)")
+    parser.add_argument('--public-rate', type=float, default=DEFAULT_RATES['public'],
+                        help="public and channel messages per second per user (0 is unlimited)")
+    parser.add_argument('--private-rate', type=float, default=DEFAULT_RATES['private'],
+                        help="private messages per second per user (0 is unlimited)")
+    parser.add_argument('--control-rate', type=float, default=DEFAULT_RATES['control'],
+                        help="join, leave, list, history and heartbeat requests per second per user (0 is unlimited)")
+    parser.add_argument('--rate-burst', type=float, default=DEFAULT_BURST_SECONDS,
+                        help="seconds of messages a user may send at once")
+    parser.add_argument('--ip-rate-factor', type=float, default=DEFAULT_IP_FACTOR,
+                        help="budget of one IP address as a multiple of a user's (0 disables IP limits)")
+    parser.add_argument('--multicast-group',
+                        help="IP multicast group (e.g. 239.255.0.1) publishing public messages "
+                             "and presence to UDP clients on the LAN (default: unicast only)")
+    parser.add_argument('--multicast-port', type=int, default=DEFAULT_MULTICAST_PORT,
+                        help="port of the multicast group")
+    parser.add_argument('--multicast-ttl', type=int, default=DEFAULT_MULTICAST_TTL,
+                        help="router hops multicast datagrams may cross (1 stays on the LAN)")
+    parser.add_argument('--multicast-interface',
+                        help="address of the interface multicast is sent from (127.0.0.1 for loopback)")
+    parser.add_argument('--unix-socket',
+                        help="also serve stream clients on this Unix domain socket path, like TCP")
+    parser.add_argument('--unix-datagram',
+                        help="also serve datagram clients on this Unix domain socket path, like UDP")
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'],
+                        default='info', help="debug also logs the body of every message")
+    parser.add_argument('--log-queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="log records queued for the writer thread, dropped beyond (0 logs synchronously)")
+    parser.add_argument('--message-log-rate', type=float, default=DEFAULT_MESSAGE_RATE,
+                        help="per-message log lines written per second (0 writes them all)")
+    parser.add_argument('--message-log-sample', type=int, default=DEFAULT_MESSAGE_SAMPLE,
+                        help="keep 1 in N per-message log lines")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes sharing the ports with SO_REUSEPORT")
+    parser.add_argument('--cluster-port', type=int,
+                        help="port for links with the other nodes of a cluster")
+    parser.add_argument('--cluster-host', default=DEFAULT_CLUSTER_HOST,
+                        help="interface accepting links from the other nodes")
+    parser.add_argument('--cluster-secret', default=os.environ.get(CLUSTER_SECRET_VARIABLE),
+                        help=f"secret shared by the nodes of a cluster "
+                             f"(default: ${CLUSTER_SECRET_VARIABLE})")
+    parser.add_argument('--peers', default='',
+                        help="comma-separated host:cluster-port of nodes to link with")
+    parser.add_argument('--node-id',
+                        help="unique name of this node (default: hostname:tcp-port)")
+    args = parser.parse_args()
+    if args.cluster_port and args.workers > 1:
+        parser.error("--cluster-port cannot be combined with --workers")
+    if args.cluster_port and not args.cluster_secret:
+        parser.error(f"--cluster-port needs --cluster-secret or ${CLUSTER_SECRET_VARIABLE}")
+
+    log_settings = (getattr(logging, args.log_level.upper()), args.log_queue_size,
+                    args.message_log_rate, args.message_log_sample)
+    LogQueue(*log_settings)
+
+    server_args = (args.host, args.tcp_port, args.udp_port)
+    server_kwargs = dict(backpressure_policy=args.backpressure,
+                         high_watermark=args.high_watermark,
+                         low_watermark=args.low_watermark,
+                         max_outbound_bytes=args.max_outbound,
+                         flush_delay=args.flush_delay,
+                         tcp_nodelay=not args.nagle,
+                         compression_threshold=args.compression_threshold,
+                         compression_level=args.compression_level,
+                         presence_interval=args.presence_interval,
+                         udp_heartbeat_interval=args.udp_heartbeat_interval,
+                         udp_missed_heartbeats=args.udp_missed_heartbeats,
+                         history_dir=args.history_dir,
+                         mailbox_ttl=args.mailbox_ttl,
+                         mailbox_size=args.mailbox_size,
+                         mailbox_bytes=args.mailbox_bytes,
+                         mailbox_dir=args.mailbox_dir,
+                         stats_port=args.stats_port,
+                         stats_interval=args.stats_interval,
+                         public_rate=args.public_rate,
+                         private_rate=args.private_rate,
+                         control_rate=args.control_rate,
+                         rate_burst=args.rate_burst,
+                         ip_rate_factor=args.ip_rate_factor,
+                         multicast_group=args.multicast_group,
+                         multicast_port=args.multicast_port,
+                         multicast_ttl=args.multicast_ttl,
+                         multicast_interface=args.multicast_interface,
+                         unix_path=args.unix_socket,
+                         unix_datagram_path=args.unix_datagram)
     try:
-        server.run()
+        if args.workers > 1:
+            run_workers(args.workers, args.engine, args.loops, server_args, server_kwargs,
+                        log_settings)
+        else:
+            server = ChatServer(*server_args, **server_kwargs)
+            if args.cluster_port:
+                peers = [peer for peer in args.peers.split(',') if peer]
+                server.join_cluster(args.node_id or f"{socket.gethostname()}:{args.tcp_port}",
+                                    args.cluster_port, peers, args.cluster_secret,
+                                    args.cluster_host)
+            server.run(args.engine, args.loops)
     except KeyboardInterrupt:
         logging.info("Server shutting down...")
     except Exception as e:
@@ -0,0 +1,66 @@
+import json
+import logging
+import socket
+import threading
+import time
+import unittest
+
+from server import ChatServer
+
+
+class SplitHandshakeTest(unittest.TestCase):
+    """A username handshake split over several TCP segments still registers"""
+
+    def setUp(self):
+        logging.getLogger().setLevel(logging.WARNING)
+        self.sockets = []
+
+    def tearDown(self):
+        for client_socket in self.sockets:
+            client_socket.close()
+
+    def start_server(self, engine):
+        server = ChatServer('127.0.0.1', 0, 0, presence_interval=0, stats_interval=0)
+        threading.Thread(target=server.run, args=(engine,), daemon=True).start()
+        return server
+
+    def connect(self, server):
+        """Connect once the server listens"""
+        address = ('127.0.0.1', server.tcp_socket.getsockname()[1])
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                client_socket = socket.create_connection(address, timeout=5)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sockets.append(client_socket)
+        return client_socket
+
+    def assert_registers_in_parts(self, engine):
+        server = self.start_server(engine)
+        client_socket = self.connect(server)
+
+        handshake = json.dumps({"username": "bob"}).encode()
+        client_socket.sendall(handshake[:8])
+        time.sleep(0.2)
+        client_socket.sendall(handshake[8:])
+
+        # Legacy clients may get the welcome and the user list in one read
+        welcome, _ = json.JSONDecoder().raw_decode(client_socket.recv(4096).decode())
+        self.assertEqual(welcome['type'], 'server')
+        self.assertIn('Welcome bob', welcome['message'])
+        self.assertTrue(server.registry.connected('bob'))
+
+    def test_threaded(self):
+        self.assert_registers_in_parts('threaded')
+
+    def test_eventloop(self):
+        self.assert_registers_in_parts('eventloop')
+
+
+if __name__ == '__main__':
+    unittest.main()